@@ -19,6 +19,10 @@ import pandas as pd
 
 from histocc import (
     OccDatasetMixerInMemMultipleFiles,
+    LengthBucketBatchSampler,
+    ShardSampler,
+    collate_batch,
+    dynamic_padding_collate,
     load_tokenizer,
     Seq2SeqMixerOccCANINE,
     BlockOrderInvariantLoss,
@@ -82,6 +86,8 @@ def parse_args():
     parser.add_argument('--prefetch-factor', type=int, default=None, help='Number of batches loaded in advance by each worker (default: None uses PyTorch default of 2)')
     parser.add_argument('--pin-memory', action='store_true', default=False, help='Pin memory for faster data transfer to GPU')
     parser.add_argument('--persistent-workers', action='store_true', default=False, help='Keep workers alive between epochs (requires num_workers > 0)')
+    parser.add_argument('--dynamic-padding', action='store_true', default=False, help='Pad each batch to its longest input rather than to the max. input length')
+    parser.add_argument('--length-bucketing', action='store_true', default=False, help='Batch inputs of similar length together. Most useful with --dynamic-padding')
 
     # Model and optimizer parameters
     parser.add_argument('--learning-rate', type=float, default=2e-05)
@@ -271,6 +277,8 @@ def setup_datasets(
         map_code_label: dict[str, int],
         distributed: bool = False,
 ) -> tuple[OccDatasetMixerInMemMultipleFiles, OccDatasetMixerInMemMultipleFiles]:
+    # In distributed training, each rank loads only its own shard of the
+    # training data
     dataset_train = OccDatasetMixerInMemMultipleFiles(
         fnames_data=[os.path.join(save_path, 'data_train.csv')],
         formatter=formatter,
@@ -280,6 +288,9 @@ def setup_datasets(
         training=True,
         target_cols=target_cols,
         map_code_label=map_code_label,
+        batched=True,
+        num_replicas=dist.get_world_size() if distributed else 1,
+        rank=dist.get_rank() if distributed else 0,
     )
 
     dataset_val = OccDatasetMixerInMemMultipleFiles(
@@ -291,6 +302,7 @@ def setup_datasets(
         training=False,
         target_cols=target_cols,
         map_code_label=map_code_label,
+        batched=True,
     )
 
     return dataset_train, dataset_val
@@ -415,10 +427,39 @@ def main():
         'pin_memory': True,
         'persistent_workers': True if args.num_workers > 0 else False,
         'prefetch_factor': 4 if args.num_workers > 0 else None,
+        'collate_fn': dynamic_padding_collate if args.dynamic_padding else collate_batch,
     }
     
-    if distributed:
-        train_sampler = DistributedSampler(
+    if args.length_bucketing:
+        # Training batches are formed within the shard of each rank, while
+        # validation batches are sharded across ranks by the sampler itself
+        train_sampler = LengthBucketBatchSampler(
+            lengths=dataset_train.input_lengths(),
+            batch_size=args.batch_size,
+            shuffle=True,
+            drop_last=distributed,
+            sharded=distributed,
+        )
+        val_sampler = LengthBucketBatchSampler(
+            lengths=dataset_val.input_lengths(),
+            batch_size=args.batch_size,
+            shuffle=False,
+            num_replicas=world_size,
+            rank=dist.get_rank() if distributed else 0,
+        )
+        data_loader_train = DataLoader(
+            dataset_train,
+            batch_sampler=train_sampler,
+            **dataloader_kwargs,
+        )
+        data_loader_val = DataLoader(
+            dataset_val,
+            batch_sampler=val_sampler,
+            **dataloader_kwargs,
+        )
+    elif distributed:
+        # Training data is already sharded across ranks
+        train_sampler = ShardSampler(
             dataset_train,
             shuffle=True,
             drop_last=True,
@@ -15,6 +15,11 @@ from .dataloader import (
     OccDatasetV2InMem,
     OccDatasetV2InMemMultipleFiles,
     OccDatasetMixerInMemMultipleFiles,
+    OccDatasetMixerStreaming,
+    LengthBucketBatchSampler,
+    ShardSampler,
+    collate_batch,
+    dynamic_padding_collate,
 )
 from .loss import (
     Seq2SeqCrossEntropy,
@@ -7,11 +7,45 @@ Created on Wed Aug 16 13:33:15 2023
 """
 
 
+import collections
+import os
 import random
 import string
 
+from collections.abc import Iterable
+
+import numpy as np
 import pandas as pd
 
+from .utils.shared import StringArray
+
+
+def build_word_freq_table(texts: pd.Series | Iterable[str]) -> pd.DataFrame:
+    """
+    Counts the words of a collection of strings, one string at a time rather
+    than by joining all of them into one (potentially huge) string first.
+
+    Parameters:
+    texts (pd.Series or Iterable): The strings. For a pd.Series, each unique
+    string is split only once.
+
+    Returns:
+    pd.DataFrame: A DataFrame with two columns, "word" and "freq", in the
+    order the words are first seen; may be passed on as `word_freq_table`.
+    """
+    if isinstance(texts, pd.Series):
+        texts_counts = texts.value_counts(sort=False).items()
+    else:
+        texts_counts = ((text, 1) for text in texts)
+
+    counts = collections.Counter()
+
+    for text, count in texts_counts:
+        for word in text.split():
+            counts[word] += count
+
+    return pd.DataFrame({'word': list(counts.keys()), 'freq': list(counts.values())}, columns=['word', 'freq'])
+
 
 class AttackerClass:
     """
@@ -27,12 +61,16 @@ class AttackerClass:
         'z': 'asx',
     }
 
+    # Number of word indices drawn at once from the frequency table
+    word_block_size: int = 4096
+
     def __init__(
             self,
             alt_prob: float = 0.8,
             n_trans: int = 3,
             df: pd.DataFrame | None = None,
             word_freq_table: pd.DataFrame | None = None,
+            words: Iterable[str] | None = None,
     ):
         """
         Initializes the AttackerClass with a DataFrame.
@@ -40,7 +78,9 @@ class AttackerClass:
         Parameters:
         df (pd.DataFrame): A DataFrame containing text data in a column named 'occ1'.
         word_freq_table (pd.DataFrame): A DataFrame with two columns, "word" and "freq",
-        from which to draw random words. If this is applied, the argument df is ignored.
+        from which to draw random words. If this is applied, the arguments df and words are ignored.
+        words (Iterable): Unique words from which to draw random words uniformly, e.g.,
+        the "word" column of a word frequency table. If this is applied, the argument df is ignored.
         """
 
         self.alt_prob = alt_prob
@@ -59,17 +99,81 @@ class AttackerClass:
         if word_freq_table is not None:
             # Always use frequency table when available
             df = None
+            words = None
+
+        if words is not None:
+            df = None
+
+        # Cumulative distribution of words to draw; None to draw uniformly
+        self.word_cdf = None
+
+        self._word_block = np.empty(0, dtype=np.int64)
+        self._word_block_pos = 0
+        self._word_block_pid = None
 
         if df is not None:
-            all_text = ' '.join(item for item in df['occ1'].unique())
-            self.word_list = list(set(all_text.split()))
-            self.transformations.append(self.insert_random_word)
+            words = build_word_freq_table(df['occ1'])['word']
 
-        self.word_freq_table = word_freq_table
+        if words is not None:
+            # Kept in shared memory rather than as a list of str objects,
+            # which every DataLoader worker would end up copying
+            self.word_list = StringArray(words)
+            self.transformations.append(self.insert_random_word)
 
-        if self.word_freq_table is not None:
+        if word_freq_table is not None:
+            self._compile_word_freq_table(word_freq_table)
             self.transformations.append(self.insert_random_word)
 
+    def _compile_word_freq_table(self, word_freq_table: pd.DataFrame) -> None:
+        """
+        Compiles a word frequency table into a word list and the cumulative
+        distribution of the words, such that drawing a word does not require
+        normalizing the frequencies anew (as `pd.DataFrame.sample` does).
+
+        Parameters:
+        word_freq_table (pd.DataFrame): A DataFrame with two columns, "word" and "freq".
+        """
+        freq = np.nan_to_num(word_freq_table['freq'].to_numpy(dtype=np.float64))
+
+        if (freq < 0).any():
+            raise ValueError('word frequencies may not be negative')
+
+        if not (freq > 0).any():
+            raise ValueError('word frequencies must contain at least one positive value')
+
+        # Words never drawn need not be stored
+        keep = freq > 0
+
+        self.word_list = StringArray(word_freq_table['word'].astype(str).to_numpy()[keep])
+
+        cdf = np.cumsum(freq[keep])
+        self.word_cdf = cdf / cdf[-1]
+
+    def _draw_word(self) -> str:
+        """
+        Draws a random word, either uniformly from the word list or according
+        to the word frequencies. In the latter case, words are drawn in blocks
+        of `word_block_size` and handed out one at a time.
+
+        Returns:
+        str: The random word.
+        """
+        if self.word_cdf is None:
+            return random.choice(self.word_list)
+
+        # Blocks are drawn anew in each (forked) DataLoader worker, from the
+        # `random` state, which the DataLoader seeds differently per worker
+        if self._word_block_pos >= len(self._word_block) or self._word_block_pid != os.getpid():
+            rng = np.random.default_rng(random.getrandbits(64))
+            self._word_block = np.searchsorted(self.word_cdf, rng.random(self.word_block_size), side='right')
+            self._word_block_pos = 0
+            self._word_block_pid = os.getpid()
+
+        item = self._word_block[self._word_block_pos]
+        self._word_block_pos += 1
+
+        return self.word_list[item]
+
     @staticmethod
     def random_character_deletion(sentence: str) -> str:
         """
@@ -199,10 +303,7 @@ class AttackerClass:
         """
         occ_as_word_list = sentence.split()
 
-        if self.word_freq_table is not None:
-            random_word = self.word_freq_table.sample(n=1, weights='freq')['word'].iloc[0]
-        else:
-            random_word = random.choice(self.word_list)
+        random_word = self._draw_word()
 
         insert_index = random.randint(0, len(occ_as_word_list))
         occ_as_word_list.insert(insert_index, random_word)
@@ -266,6 +367,32 @@ class AttackerClass:
 
         return self.apply_transformations(input_string, n_trans=self.n_trans)
 
+    def attack_batch(self, input_strings: list[str]) -> list[str]:
+        """
+        Batched version of `attack`. Which strings to alter and the
+        transformations to apply are drawn for the whole batch at once.
+
+        Parameters:
+        input_strings (list): The input strings.
+
+        Returns:
+        list: The strings, each altered with probability `self.alt_prob`.
+        """
+        altered = [i for i in range(len(input_strings)) if random.random() <= self.alt_prob]
+        transformations = random.choices(self.transformations, k=len(altered) * self.n_trans)
+
+        output = list(input_strings)
+
+        for i, offset in zip(altered, range(0, len(transformations), self.n_trans)):
+            sentence = output[i]
+
+            for transformation in transformations[offset:offset + self.n_trans]:
+                sentence = transformation(sentence)
+
+            output[i] = sentence
+
+        return output
+
     def attack_multiple(self, x_string: str | list[str], alt_prob: float = 0.8, n_trans: int = 3) -> list[str]:
         """
         Performs an attack on the input strings by applying text transformations.
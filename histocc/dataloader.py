@@ -6,20 +6,32 @@ https://medium.com/@keruchen/train-a-xlm-roberta-model-for-text-classification-o
 """
 
 
+import csv
+import hashlib
 import io
 import math
+import mmap
 import os
 import random
 
 from functools import partial
+from itertools import islice
 from pathlib import Path
-from typing import Callable
+from typing import Any, Callable
 
 import torch
+import torch.distributed as dist
 
 from sklearn.model_selection import train_test_split
 from torch import Tensor
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import (
+    Dataset,
+    DataLoader,
+    IterableDataset,
+    Sampler,
+    default_collate,
+    get_worker_info,
+)
 from transformers import CanineTokenizer
 
 import numpy as np
@@ -31,7 +43,9 @@ import matplotlib.pyplot as plt
 # Custom modules
 from .datasets import DATASETS
 from .model_assets import load_tokenizer, update_tokenizer
-from .attacker import AttackerClass
+from .attacker import AttackerClass, build_word_freq_table
+from .utils.shared import SharedArrays, StringArray
+from .utils.tokenization import canine_encode, supports_canine_encode
 from .formatter import (
     BlockyHISCOFormatter,
     BlockyOCC1950Formatter,
@@ -87,6 +101,74 @@ def _read_data_file(
 
 
 # Returns training data path
+def _balance_row_groups(
+        num_rows: np.ndarray,
+        num_replicas: int,
+) -> list[list[int]]:
+    # Assign each row group to the replica with the fewest rows so far, such
+    # that replicas end up at most one row group apart
+    order = np.arange(len(num_rows))
+    loads = np.zeros(num_replicas, dtype=np.int64)
+    assignment = [[] for _ in range(num_replicas)]
+
+    for idx in order:
+        replica = int(np.argmin(loads))
+        assignment[replica].append(int(idx))
+        loads[replica] += num_rows[idx]
+
+    return assignment
+
+
+def _read_data_shard(
+    fpath: str | Path,
+    num_replicas: int = 1,
+    rank: int = 0,
+    usecols: list[str] = None,
+    dtype: dict = None,
+    converters: dict = None,
+) -> pd.DataFrame:
+    """
+    Read the `rank`-th of `num_replicas` shards of a data file, such that each
+    process in distributed training only parses and holds its own rows.
+
+    Parquet files are sharded by row groups (balancing the number of rows),
+    CSV files into contiguous ranges of rows of (nearly) equal size. Only the
+    bytes of these rows are read and parsed, located by the byte offset of
+    each row (see `create_index_file`).
+    """
+    if num_replicas == 1:
+        return _read_data_file(fpath, usecols=usecols, dtype=dtype, converters=converters)
+
+    if Path(fpath).suffix == '.parquet':
+        import pyarrow.parquet as pq # pylint: disable=C0415
+
+        parquet_file = pq.ParquetFile(fpath)
+        metadata = parquet_file.metadata
+        num_rows = np.array([metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)])
+        row_groups = _balance_row_groups(num_rows, num_replicas)[rank]
+
+        return parquet_file.read_row_groups(row_groups, columns=usecols).to_pandas()
+
+    offsets = _csv_row_offsets(fpath)
+    first, last = (len(offsets) * r // num_replicas for r in (rank, rank + 1))
+
+    with open(fpath, 'rb') as file:
+        file_size = file.seek(0, os.SEEK_END)
+        bounds = [int(offsets[i]) if i < len(offsets) else file_size for i in (0, first, last)]
+
+        file.seek(0)
+        header = file.read(bounds[0])
+        file.seek(bounds[1])
+        rows = file.read(bounds[2] - bounds[1])
+
+    return pd.read_csv(
+        io.BytesIO(header + rows),
+        usecols=usecols,
+        dtype=dtype,
+        converters=converters,
+    )
+
+
 def train_path(model_domain): # FIXME move to datasets.py and avoid hardcoded paths
     if model_domain == "DK_CENSUS":
         fname = "../Data/Training_data/DK_census_train.csv"
@@ -296,6 +378,31 @@ def subset_to_smaller(df, sample_size):
     return df
 
 
+def _codes_to_bin(values, max_value: int) -> np.ndarray:
+    ''' Binary (int) array of the codes of a single row
+    '''
+    labels = np.zeros(max_value, dtype=int)
+    for value in values:
+        if not np.isnan(value):
+            labels[int(value)] = 1
+
+    # 'No occupation' correction for single row
+    if labels[2] == 1 or labels[1] == 1 or labels[0] == 1:
+        if np.any(labels[3:] > 0):
+            labels[0] = 0
+
+    return labels
+
+
+def record_to_bin(record: dict[str, Any], max_value: int) -> np.ndarray:
+    ''' Returns binary array of a single record, as `labels_to_bin` does for
+    a 1-row pd.DataFrame, without building the data frame
+    '''
+    values = [record[f'code{i}'] for i in range(1, 6)]
+
+    return _codes_to_bin(values, max_value).astype(float)
+
+
 def labels_to_bin(df: pd.DataFrame, max_value: int):
     ''' Returns binary array
     '''
@@ -303,16 +410,7 @@ def labels_to_bin(df: pd.DataFrame, max_value: int):
 
     if len(df) == 1: # Handle single row efficiently
         # Directly work with the single row's values
-        row_values = df_codes.iloc[0].values
-        labels = np.zeros(max_value, dtype=int)
-        for value in row_values:
-            if not np.isnan(value):
-                labels[int(value)] = 1
-
-        # 'No occupation' correction for single row
-        if labels[2] == 1 or labels[1] == 1 or labels[0] == 1:
-            if np.any(labels[3:] > 0):
-                labels[0] = 0
+        labels = _codes_to_bin(df_codes.iloc[0].values, max_value)
     else:
         # Binarize
         labels_list = df_codes.values.tolist()
@@ -417,6 +515,104 @@ def concat_string_canine(occ1, lang):
     return(cat_sequence)
 
 
+def _na_str(value: str) -> str | float:
+    # Empty fields are missing values
+    return value if value else np.nan
+
+
+def _na_float(value: str) -> float:
+    return float(value) if value else np.nan
+
+
+def load_byte_offsets(fname_index: str) -> np.ndarray:
+    '''
+    Load the byte offset of each data row of a CSV file, as written by
+    `create_index_file`. NumPy `.npy` indices are memory-mapped, while legacy
+    text indices (one offset per line) are parsed.
+    '''
+    if str(fname_index).endswith('.npy'):
+        return np.load(fname_index, mmap_mode='r')
+
+    return np.loadtxt(fname_index, dtype=np.uint64, ndmin=1)
+
+
+class MmapCSVRows:
+    '''
+    Random access to the rows of a CSV file through a byte-offset index,
+    without reading the file into memory.
+
+    The file is memory-mapped on first access in each process (such that
+    every DataLoader worker maps it once), and rows are split with a light
+    CSV tokenizer rather than `pd.read_csv`. Each field is parsed by the
+    converter of its column in `converters` (`_na_str` if not specified).
+
+    Parameters
+    ----------
+    fname_data : str
+        Path to CSV file.
+    byte_offsets : np.ndarray
+        Byte offset of the start of each data row, see `load_byte_offsets`.
+    colnames : list[str]
+        Names of the columns of the CSV file.
+    converters : dict[str, Callable[[str], Any]] | None
+        Mapping from column name to function parsing a raw field.
+
+    '''
+    def __init__(
+            self,
+            fname_data: str,
+            byte_offsets: np.ndarray,
+            colnames: list[str],
+            converters: dict[str, Callable] | None = None,
+    ):
+        converters = converters or {}
+
+        self.fname_data = fname_data
+        self.byte_offsets = byte_offsets
+        self.colnames = list(colnames)
+        self.converters = [converters.get(col, _na_str) for col in self.colnames]
+
+        self._buffer: mmap.mmap | None = None
+
+    def __getstate__(self) -> dict:
+        # Memory maps cannot be pickled (e.g., to spawned workers); these
+        # simply map the file again on first access
+        state = self.__dict__.copy()
+        state['_buffer'] = None
+
+        return state
+
+    def _get_buffer(self) -> mmap.mmap:
+        if self._buffer is None:
+            with open(self.fname_data, 'rb') as file:
+                self._buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self._buffer
+
+    def __len__(self) -> int:
+        return len(self.byte_offsets)
+
+    def __getitem__(self, item: int) -> dict[str, Any]:
+        buffer = self._get_buffer()
+
+        start = int(self.byte_offsets[item])
+        end = buffer.find(b'\n', start)
+        line = buffer[start:end if end != -1 else len(buffer)].decode('utf-8').rstrip('\r')
+
+        if '"' in line:
+            fields = next(csv.reader([line]), [])
+        else:
+            fields = line.split(',')
+
+        # Missing trailing fields are missing values
+        fields += [''] * (len(self.colnames) - len(fields))
+
+        return {
+            col: converter(field)
+            for col, converter, field in zip(self.colnames, self.converters, fields)
+        }
+
+
 class OCCDataset(Dataset):
     transform_label: Callable
     # Constructor Function
@@ -452,13 +648,22 @@ class OCCDataset(Dataset):
         if not os.path.exists(os.path.dirname(df_path)):
             os.makedirs(os.path.dirname(df_path))
 
-        # Load and store index file in memory
-        with open(index_file_path, 'r', encoding='utf-8') as index_file:
-            self.index_data = index_file.readlines()
+        # Memory-mapped access to rows through byte-offset index
+        self.rows = MmapCSVRows(
+            df_path,
+            byte_offsets=load_byte_offsets(index_file_path),
+            colnames=self.colnames,
+            converters={
+                'occ1': str,
+                'lang': str,
+                **{col: _na_float for col in self.colnames if col.startswith('code')},
+            },
+        )
 
     def setup_target_formatter(self):
+        # Labels are transformed from records (dicts) rather than 1-row data frames
         if self.formatter is None:
-            self.transform_label = partial(labels_to_bin, max_value=self.n_classes)
+            self.transform_label = partial(record_to_bin, max_value=self.n_classes)
         else:
             self.transform_label = self.formatter.transform_label
 
@@ -466,23 +671,11 @@ class OCCDataset(Dataset):
         return self.n_obs
 
     def __getitem__(self, item):
-        # Get the byte offset from the stored index data
-        byte_offset_line = self.index_data[item].strip()
-
-        if not byte_offset_line:
-            raise ValueError(f"Empty line encountered in index file at item {item}")
-
-        byte_offset = int(byte_offset_line)
+        record = self.rows[item]
 
-        # Use the byte offset to read the specific row from the data file
-        with open(self.df_path, 'rb') as f:
-            f.seek(byte_offset)
-            row = f.readline()
-            df = pd.read_csv(io.StringIO(row.decode('utf-8')), names=self.colnames)
-
-        occ1 = str(df.occ1.tolist()[0])
-        target = self.transform_label(df)
-        lang = str(df.lang.tolist()[0])
+        occ1 = str(record['occ1'])
+        target = self.transform_label(record)
+        lang = str(record['lang'])
 
         # Implement Attack() here
         occ1 = self.attacker.attack(
@@ -528,12 +721,87 @@ class OCCDataset(Dataset):
         }
 
 
+def _factorize(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Integer codes (-1 for missing) in the smallest fitting dtype, along
+    # with the unique values
+    codes, categories = pd.factorize(values)
+    dtype = np.int16 if len(categories) < np.iinfo(np.int16).max else np.int32
+
+    return codes.astype(dtype), np.asarray(categories, dtype=object)
+
+
+class ColumnarRecords(SharedArrays):
+    '''
+    Column-wise storage of the records of a data frame with columns 'occ1',
+    'lang', and `target_cols`, such that fetching a record is plain array
+    indexing rather than building a `pd.Series` through `.iloc`.
+
+    Descriptions are kept as a `StringArray`, while languages and target
+    values are stored as categorical integer codes (int16 unless there are
+    too many unique values). All of these live in shared memory, such that
+    DataLoader workers do not each end up with a copy. Records are returned
+    as dicts holding the original values, with NaN for missing target values,
+    such that they can be passed on to `formatter.transform_label` as before.
+    '''
+    def __init__(self, frame: pd.DataFrame, target_cols: list[str]):
+        self.target_cols = list(target_cols)
+
+        self.occ1 = StringArray(map(str, frame['occ1']))
+
+        # Code -1 (missing) indexes the trailing NaN of the categories
+        self.lang_codes, lang_categories = _factorize(frame['lang'].to_numpy())
+        self.lang_categories = np.append(lang_categories, np.nan)
+
+        # Target columns share categories
+        target_codes, target_categories = _factorize(frame[self.target_cols].to_numpy().ravel())
+        self.target_codes = target_codes.reshape(len(frame), len(self.target_cols))
+        self.target_categories = np.append(target_categories, np.nan)
+
+        self._share_arrays('lang_codes', 'target_codes')
+
+    def __len__(self) -> int:
+        return len(self.occ1)
+
+    def __getitem__(self, item: int) -> dict[str, str | float]:
+        record = {
+            'occ1': self.occ1[item],
+            'lang': self.lang_categories[self.lang_codes[item]],
+        }
+        record.update(self.targets_from_codes(self.target_codes[item]))
+
+        return record
+
+    def get_inputs(self, items: np.ndarray) -> tuple[list[str], list[str]]:
+        ''' Descriptions and languages of the records at `items` '''
+        occ1 = self.occ1[items]
+        lang = self.lang_categories[self.lang_codes[items]]
+
+        return occ1, lang.tolist()
+
+    def targets_from_codes(self, codes: np.ndarray) -> dict[str, str | float]:
+        ''' Target values of one row of `self.target_codes`, keyed by column '''
+        targets = self.target_categories[codes]
+
+        return dict(zip(self.target_cols, targets))
+
+    def input_lengths(self) -> np.ndarray:
+        ''' Length of '<LANG>[SEP]<OCCUPATIONAL DESCRIPTION>' of each record '''
+        occ1_lengths = self.occ1.lengths()
+        lang_lengths = np.fromiter(map(len, map(str, self.lang_categories)), dtype=np.int64)
+
+        return occ1_lengths + lang_lengths[self.lang_codes] + len('[SEP]')
+
+
 class OccDatasetV2(Dataset):
     map_type_target_cols_default = {
         'hisco': ['code1', 'code2', 'code3', 'code4', 'code5'],
         'occ1950': ['OCC1950_1', 'OCC1950_2'],
     }
 
+    # When true, `__getitems__` returns whole, already collated batches,
+    # which requires a collate function such as `collate_batch`
+    batched: bool = False
+
     def __init__(
             self,
             fname_data: str,
@@ -547,49 +815,46 @@ class OccDatasetV2(Dataset):
             unk_lang_prob: float = 0.25,
             data: pd.DataFrame | None = None,
             word_freq_table: pd.DataFrame | None = None,
+            batched: bool = False,
+            words: list[str] | pd.Series | None = None,
     ):
         self.fname_data = fname_data
         self.formatter = formatter
         self.tokenizer = tokenizer
         self.max_input_len = max_input_len
+        self.use_canine_encode = supports_canine_encode(tokenizer)
+        self.batched = batched
 
         self.training = training
         self.unk_lang_prob = unk_lang_prob
+
+        # Inputs are only augmented during training, so only then is a
+        # vocabulary for random word insertion needed
         self.attacker = AttackerClass(
             alt_prob=alt_prob,
             n_trans=n_trans,
-            df=data,
-            word_freq_table=word_freq_table,
+            df=data if training else None,
+            word_freq_table=word_freq_table if training else None,
+            words=words if training else None,
         )
 
         self.colnames: pd.Index = pd.read_csv(fname_data, nrows=1).columns
         self.map_item_byte_index = self._setup_mapping(fname_index)
-        # FIXME current impl can mistakenly read an 'occ1' value as an int
-        # TODO have `self._get_record` pass in coltypes
-        # Example value for 'occ1': 42
-        # This is then read as an int; since we read 1 row at a time, we
-        # may wrongly infer type in such cases
-
-    def _setup_mapping(self, fname_index: str) -> dict[int, int]:
-        # TODO ask Vedel about structure. Is shuffling implemented?
-        # Cannot seem to grab expected elements
-
-        with open(fname_index, 'r', encoding='utf-8') as file:
-            byte_offsets = file.readlines()
 
-        return {idx: int(offset) for idx, offset in enumerate(byte_offsets)}
+        # Descriptions are always kept as str (e.g., 'nan' or '42'), other
+        # columns are str with empty fields as NaN
+        self.rows = MmapCSVRows(
+            fname_data,
+            byte_offsets=self.map_item_byte_index,
+            colnames=self.colnames,
+            converters={'occ1': str},
+        )
 
-    def _get_record(self, item: int) -> pd.Series:
-        with open(self.fname_data, 'rb') as file:
-            file.seek(self.map_item_byte_index[item])
-            row = file.readline()
-            data = pd.read_csv(
-                io.StringIO(row.decode('utf-8')),
-                names=self.colnames,
-                dtype={'occ1': str}, # TODO define full dtype-mapping in self.__init__
-                )
+    def _setup_mapping(self, fname_index: str) -> np.ndarray:
+        return load_byte_offsets(fname_index)
 
-        return data.iloc[0]
+    def _get_record(self, item: int) -> dict[str, str | float]:
+        return self.rows[item]
 
     def _augment_occ_descr_lang(self, occ_descr: str, lang: str) -> tuple[str, str]:
         if not self.training:
@@ -610,14 +875,56 @@ class OccDatasetV2(Dataset):
 
         return '[SEP]'.join((lang, occ_descr)) # TODO '[SEP]' should be a (global) const
 
+    def _prepare_inputs(self, occ_descrs: list[str], langs: list[str]) -> list[str]:
+        ''' Batched version of `_prepare_input` '''
+        if self.training:
+            occ_descrs = [x.strip("'[]'") for x in self.attacker.attack_batch(occ_descrs)]
+            # Same source of randomness as `_augment_occ_descr_lang`
+            langs = ['unk' if random.random() < self.unk_lang_prob else lang for lang in langs]
+
+        return ['[SEP]'.join(x) for x in zip(langs, occ_descrs)]
+
+    def _encode_inputs(self, input_seqs: list[str]) -> tuple[Tensor, Tensor]:
+        ''' Encode a batch of input sequences to `input_ids` and
+        `attention_mask` of shape `(len(input_seqs), max_input_len)`.
+        '''
+        if self.use_canine_encode:
+            input_ids, attention_mask = canine_encode(input_seqs, self.max_input_len)
+
+            return torch.from_numpy(input_ids).long(), torch.from_numpy(attention_mask).long()
+
+        encoded = self.tokenizer.batch_encode_plus(
+            list(input_seqs),
+            add_special_tokens=True,
+            padding='max_length',
+            max_length=self.max_input_len,
+            return_token_type_ids=False,
+            return_attention_mask=True,
+            return_tensors='pt',
+            truncation=True
+        )
+
+        return encoded['input_ids'], encoded['attention_mask']
+
+    def input_lengths(self) -> np.ndarray:
+        ''' Number of characters of each (non-augmented) input sequence,
+        used for length-bucketed batching.
+        '''
+        raise NotImplementedError(f'{type(self).__name__} does not support length-bucketed batching')
+
+    def _encode_input(self, input_seq: str) -> tuple[Tensor, Tensor]:
+        input_ids, attention_mask = self._encode_inputs([input_seq])
+
+        return input_ids[0], attention_mask[0]
+
     def __len__(self) -> int:
         return len(self.map_item_byte_index)
 
     def __getitem__(self, item: int) -> dict[str, str | Tensor]:
         record = self._get_record(item)
 
-        occ_descr: str = record.occ1
-        lang: str = record.lang
+        occ_descr: str = record['occ1']
+        lang: str = record['lang']
         target = self.formatter.transform_label(record)
 
         # Augment occupational description and language and
@@ -625,27 +932,48 @@ class OccDatasetV2(Dataset):
         input_seq = self._prepare_input(occ_descr, lang)
 
         # Encode input sequence
-        encoded_input_seq = self.tokenizer.encode_plus(
-            input_seq,
-            add_special_tokens=True,
-            padding='max_length',
-            max_length=self.max_input_len,
-            return_token_type_ids=False,
-            return_attention_mask=True,
-            return_tensors='pt',
-            truncation = True
-        )
+        input_ids, attention_mask = self._encode_input(input_seq)
 
         batch_data = {
             'occ1': input_seq, # Legacy name of 'input_seq'
             'input_seq': input_seq,
-            'input_ids': encoded_input_seq['input_ids'].flatten(),
-            'attention_mask': encoded_input_seq['attention_mask'].flatten(),
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
             'targets': torch.tensor(target, dtype=torch.long),
         }
 
         return batch_data
 
+    def _get_batch(self, items: list[int]) -> dict[str, list[str] | Tensor]:
+        records = [self._get_record(item) for item in items]
+
+        input_seqs = self._prepare_inputs(
+            [record['occ1'] for record in records],
+            [record['lang'] for record in records],
+        )
+        input_ids, attention_mask = self._encode_inputs(input_seqs)
+        targets = np.stack([self.formatter.transform_label(record) for record in records])
+
+        batch_data = {
+            'occ1': input_seqs, # Legacy name of 'input_seq'
+            'input_seq': input_seqs,
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'targets': torch.from_numpy(targets.astype(np.int64)),
+        }
+
+        return batch_data
+
+    def __getitems__(self, items: list[int]) -> dict[str, list[str] | Tensor] | list[dict[str, str | Tensor]]:
+        ''' Fetch all samples of a batch at once. If `self.batched`, inputs
+        are augmented and encoded for the whole batch in one pass, and the
+        batch is returned already collated.
+        '''
+        if not self.batched:
+            return [self[item] for item in items]
+
+        return self._get_batch(items)
+
 
 class OccDatasetV2InMem(OccDatasetV2):
     def __init__(
@@ -660,11 +988,12 @@ class OccDatasetV2InMem(OccDatasetV2):
             n_trans: int = 3,
             unk_lang_prob: float = 0.25,
             target_cols: str | list[str] = 'hisco',
+            batched: bool = False,
     ):
         if isinstance(target_cols, str):
             target_cols = self.map_type_target_cols_default[target_cols]
 
-        self.frame = _read_data_file(
+        frame = _read_data_file(
             fname_data,
             usecols=['occ1', 'lang', *target_cols],
             dtype={'lang': str, **{x: str for x in target_cols}},
@@ -681,20 +1010,26 @@ class OccDatasetV2InMem(OccDatasetV2):
             alt_prob=alt_prob,
             n_trans=n_trans,
             unk_lang_prob=unk_lang_prob,
-            data=self.frame[['occ1']],
+            data=frame[['occ1']],
+            batched=batched,
         )
 
+        self.records = ColumnarRecords(frame, target_cols)
+
     def _setup_mapping(self, fname_index: str) -> dict[int, int]:
         ''' We avoid using any mapping when loading dataset into memory,
         hence overwrite with ghost method
         '''
         return {}
 
-    def _get_record(self, item: int) -> pd.Series:
-        return self.frame.iloc[item]
+    def _get_record(self, item: int) -> dict[str, str | float]:
+        return self.records[item]
 
     def __len__(self) -> int:
-        return len(self.frame)
+        return len(self.records)
+
+    def input_lengths(self) -> np.ndarray:
+        return self.records.input_lengths()
 
 
 class OccDatasetV2InMemMultipleFiles(OccDatasetV2):
@@ -709,6 +1044,7 @@ class OccDatasetV2InMemMultipleFiles(OccDatasetV2):
             n_trans: int = 3,
             unk_lang_prob: float = 0.25,
             target_cols: str | list[str] = 'hisco',
+            batched: bool = False,
     ):
         if isinstance(target_cols, str):
             target_cols = self.map_type_target_cols_default[target_cols]
@@ -721,7 +1057,7 @@ class OccDatasetV2InMemMultipleFiles(OccDatasetV2):
                 converters={'occ1': lambda x: x}, # ensure to do not read the str 'nan' as NaN
             ) for f in fnames_data
         ]
-        self.frame = pd.concat(frames)
+        frame = pd.concat(frames)
 
         super().__init__(
             fname_data=fnames_data[0], # we define self.colnames in parent class by reading 1 row
@@ -733,23 +1069,60 @@ class OccDatasetV2InMemMultipleFiles(OccDatasetV2):
             alt_prob=alt_prob,
             n_trans=n_trans,
             unk_lang_prob=unk_lang_prob,
-            data=self.frame[['occ1']],
+            data=frame[['occ1']],
+            batched=batched,
         )
 
+        self.records = ColumnarRecords(frame, target_cols)
+
     def _setup_mapping(self, fname_index: str) -> dict[int, int]:
         ''' We avoid using any mapping when loading dataset into memory,
         hence overwrite with ghost method
         '''
         return {}
 
-    def _get_record(self, item: int) -> pd.Series:
-        return self.frame.iloc[item]
+    def _get_record(self, item: int) -> dict[str, str | float]:
+        return self.records[item]
 
     def __len__(self) -> int:
-        return len(self.frame)
+        return len(self.records)
+
+    def input_lengths(self) -> np.ndarray:
+        return self.records.input_lengths()
+
 
+def _target_linear_indices(
+        record: dict[str, str | float | None],
+        target_cols: list[str],
+        map_code_label: dict[str, int] | None = None,
+) -> list[int]:
+    # Flat (multi-label) class index of each code of a record
+    indices = []
 
-class OccDatasetMixerInMemMultipleFiles(OccDatasetV2):
+    for target_col in target_cols:
+        code = record[target_col]
+
+        if code is None:
+            break
+
+        if isinstance(code, float):
+            # Due to missings/None/NaN, type might be float. In such
+            # cases, we want to either break if NaN or convert back
+            # to integer
+            if math.isnan(code):
+                break
+
+            code = int(code)
+
+        if map_code_label is not None:
+            indices.append(map_code_label[str(code)])
+        else:
+            indices.append(int(float(code))) # column may have type str or float -> cast
+
+    return indices
+
+
+class OccDatasetMixerInMemMultipleFiles(OccDatasetV2, SharedArrays):
     def __init__(
             self,
             fnames_data: list[str],
@@ -764,19 +1137,35 @@ class OccDatasetMixerInMemMultipleFiles(OccDatasetV2):
             target_cols: str | list[str] = 'hisco',
             map_code_label: dict[str, int] | None = None,
             word_freq_table: pd.DataFrame | None = None,
+            cache_targets: bool = False,
+            batched: bool = False,
+            num_replicas: int = 1,
+            rank: int = 0,
+            cache_word_freq: bool = False,
     ):
         if isinstance(target_cols, str):
             target_cols = self.map_type_target_cols_default[target_cols]
 
+        # In distributed training, each rank may load only its own shard
+        self.num_replicas = num_replicas
+        self.rank = rank
+
         frames = [
-            _read_data_file(
+            _read_data_shard(
                 f,
+                num_replicas=num_replicas,
+                rank=rank,
                 usecols=['occ1', 'lang', *target_cols],
                 dtype={'lang': str, **{x: str for x in target_cols}},
                 converters={'occ1': lambda x: x}, # ensure to do not read the str 'nan' as NaN
             ) for f in fnames_data
         ]
-        self.frame = pd.concat(frames)
+        frame = pd.concat(frames)
+
+        if training and word_freq_table is None:
+            words = self._setup_word_freq_table(fnames_data, frames, cache_word_freq)['word']
+        else:
+            words = None
 
         super().__init__(
             fname_data=fnames_data[0], # we define self.colnames in parent class by reading 1 row
@@ -788,78 +1177,213 @@ class OccDatasetMixerInMemMultipleFiles(OccDatasetV2):
             alt_prob=alt_prob,
             n_trans=n_trans,
             unk_lang_prob=unk_lang_prob,
-            data=self.frame[['occ1']],
             word_freq_table=word_freq_table,
+            batched=batched,
+            words=words,
         )
 
+        self.records = ColumnarRecords(frame, target_cols)
         self.target_cols = target_cols
         self.num_classes_flat = num_classes_flat
         self.map_code_label = map_code_label
 
+        # Targets do not change between epochs, so encode them once
+        self.targets_seq2seq, self.targets_linear = self._setup_targets(
+            fnames_data=fnames_data,
+            lengths=[len(f) for f in frames],
+            cache_targets=cache_targets,
+        )
+        self._share_arrays('targets_seq2seq', 'targets_linear')
+
     def _setup_mapping(self, fname_index: str) -> dict[int, int]:
         ''' We avoid using any mapping when loading dataset into memory,
         hence overwrite with ghost method
         '''
         return {}
 
-    def _get_record(self, item: int) -> pd.Series:
-        return self.frame.iloc[item]
+    def _get_record(self, item: int) -> dict[str, str | float]:
+        return self.records[item]
 
-    def _get_target_linear(self, record: pd.Series) -> np.ndarray:
-        target = np.zeros(self.num_classes_flat)
+    def _targets_cache_fname(self, fname_data: str) -> str:
+        ''' Cache file next to `fname_data`, named by a digest of everything
+        the encoded targets depend on, such that a changed data file or
+        formatter never hits a stale cache
+        '''
+        stat = os.stat(fname_data)
+        formatter_state = sorted(
+            (k, repr(v)) for k, v in vars(self.formatter).items() if not callable(v)
+        )
+        key = repr((
+            stat.st_size,
+            stat.st_mtime_ns,
+            type(self.formatter).__name__,
+            formatter_state,
+            list(self.target_cols),
+            self.num_classes_flat,
+            None if self.map_code_label is None else sorted(self.map_code_label.items()),
+            self.num_replicas,
+            self.rank,
+        ))
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+        return f'{fname_data}.targets-{digest}.npz'
+
+    def _word_freq_cache_fname(self, fname_data: str) -> str:
+        ''' Word frequency file next to `fname_data`, named by a digest of
+        the data file and the shard of it that is loaded
+        '''
+        stat = os.stat(fname_data)
+        key = repr((stat.st_size, stat.st_mtime_ns, self.num_replicas, self.rank))
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
 
-        for target_col in self.target_cols:
-            code = record[target_col]
+        return f'{fname_data}.word-freq-{digest}.csv'
 
-            if isinstance(code, float):
-                # Due to missings/None/NaN, type might be float. In such
-                # cases, we want to either break if NaN or convert back
-                # to integer
-                if math.isnan(code):
-                    break
+    def _setup_word_freq_table(
+            self,
+            fnames_data: list[str],
+            frames: list[pd.DataFrame],
+            cache_word_freq: bool,
+    ) -> pd.DataFrame:
+        ''' Word frequencies of the descriptions of all files, optionally
+        read from or written to a file next to each data file, in the format
+        expected by `--fn-word-freq`
+        '''
+        tables = []
 
-                code = int(code)
+        for fname_data, frame in zip(fnames_data, frames):
+            fname_cache = self._word_freq_cache_fname(fname_data) if cache_word_freq else None
 
-            if self.map_code_label is not None:
-                target[self.map_code_label[str(code)]] = 1
+            if fname_cache is not None and os.path.isfile(fname_cache):
+                table = pd.read_csv(fname_cache, converters={'word': lambda x: x}) # Ensure 'nan' is not treated as NaN
             else:
-                target[int(float(code))] = 1 # column may have type str or float -> cast
+                table = build_word_freq_table(frame['occ1'])
+
+                if fname_cache is not None:
+                    # Write to a temporary file first since several processes
+                    # (e.g., one per rank) may be caching the same file
+                    fname_tmp = f'{fname_cache}.{os.getpid()}.tmp'
+                    table.to_csv(fname_tmp, index=False)
+                    os.replace(fname_tmp, fname_cache)
+
+            tables.append(table)
+
+        if len(tables) == 1:
+            return tables[0]
+
+        return pd.concat(tables).groupby('word', as_index=False, sort=False)['freq'].sum()
+
+    def _encode_targets(self, target_codes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        ''' Encode seq2seq targets (N x `max_seq_len`) and flat targets as
+        code indices (N x number of target columns, padded with -1). Many
+        records share their codes, so each unique combination is encoded once.
+        '''
+        seq2seq_dtype = np.uint8 if max(self.formatter.num_classes) <= 256 else np.int16
+        linear_dtype = np.int16 if self.num_classes_flat <= np.iinfo(np.int16).max else np.int32
+
+        unique_codes, inverse = np.unique(target_codes, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        seq2seq = np.zeros((len(unique_codes), self.formatter.max_seq_len), dtype=seq2seq_dtype)
+        linear = np.full((len(unique_codes), len(self.target_cols)), -1, dtype=linear_dtype)
+
+        for i, codes in enumerate(unique_codes):
+            targets = self.records.targets_from_codes(codes)
+            indices = self._get_target_linear_indices(targets)
+
+            seq2seq[i] = self.formatter.transform_label(targets)
+            linear[i, :len(indices)] = indices
+
+        return seq2seq[inverse], linear[inverse]
+
+    def _setup_targets(
+            self,
+            fnames_data: list[str],
+            lengths: list[int],
+            cache_targets: bool,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        targets_seq2seq, targets_linear = [], []
+        start = 0
+
+        for fname_data, length in zip(fnames_data, lengths):
+            target_codes = self.records.target_codes[start:start + length]
+            start += length
+
+            fname_cache = self._targets_cache_fname(fname_data) if cache_targets else None
+
+            if fname_cache is not None and os.path.isfile(fname_cache):
+                with np.load(fname_cache) as cached:
+                    seq2seq, linear = cached['seq2seq'], cached['linear']
+            else:
+                seq2seq, linear = self._encode_targets(target_codes)
+
+                if fname_cache is not None:
+                    # Write to a temporary file first since several processes
+                    # (e.g., one per rank) may be caching the same file
+                    fname_tmp = f'{fname_cache}.{os.getpid()}.tmp.npz'
+                    np.savez(fname_tmp, seq2seq=seq2seq, linear=linear)
+                    os.replace(fname_tmp, fname_cache)
+
+            targets_seq2seq.append(seq2seq)
+            targets_linear.append(linear)
+
+        return np.concatenate(targets_seq2seq), np.concatenate(targets_linear)
+
+    def _get_target_linear_indices(self, record: dict[str, str | float]) -> list[int]:
+        return _target_linear_indices(record, self.target_cols, self.map_code_label)
+
+    def _get_target_linear(self, record: dict[str, str | float]) -> np.ndarray:
+        target = np.zeros(self.num_classes_flat)
+        target[self._get_target_linear_indices(record)] = 1
 
         return target
 
     def __len__(self) -> int:
-        return len(self.frame)
+        return len(self.records)
+
+    def input_lengths(self) -> np.ndarray:
+        return self.records.input_lengths()
 
     def __getitem__(self, item: int) -> dict[str, str | Tensor]:
         record = self._get_record(item)
 
-        occ_descr: str = record.occ1
-        lang: str = record.lang
-        targets_seq2seq = self.formatter.transform_label(record)
-        target_linear = self._get_target_linear(record)
+        occ_descr: str = record['occ1']
+        lang: str = record['lang']
+
+        # Precomputed targets. The flat target is passed on as its (padded)
+        # code indices and only expanded to multi-hot on the training device
+        targets_seq2seq = torch.from_numpy(self.targets_seq2seq[item].astype(np.int64))
+        targets_linear_indices = torch.from_numpy(self.targets_linear[item].astype(np.int64))
 
         # Augment occupational description and language and
         # return '<LANG>[SEP]<OCCUPATIONAL DESCRIPTION>'
         input_seq = self._prepare_input(occ_descr, lang)
 
         # Encode input sequence
-        encoded_input_seq = self.tokenizer.encode_plus(
-            input_seq,
-            add_special_tokens=True,
-            padding='max_length',
-            max_length=self.max_input_len,
-            return_token_type_ids=False,
-            return_attention_mask=True,
-            return_tensors='pt',
-            truncation = True
-        )
+        input_ids, attention_mask = self._encode_input(input_seq)
 
         batch_data = {
             'occ1': input_seq,
-            'input_ids': encoded_input_seq['input_ids'].flatten(),
-            'attention_mask': encoded_input_seq['attention_mask'].flatten(),
-            'targets_seq2seq': torch.tensor(targets_seq2seq, dtype=torch.long),
-            'targets_linear': torch.tensor(target_linear, dtype=torch.float),
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'targets_seq2seq': targets_seq2seq,
+            'targets_linear_indices': targets_linear_indices,
+        }
+
+        return batch_data
+
+    def _get_batch(self, items: list[int]) -> dict[str, list[str] | Tensor]:
+        items = np.asarray(items)
+        occ_descrs, langs = self.records.get_inputs(items)
+
+        input_seqs = self._prepare_inputs(occ_descrs, langs)
+        input_ids, attention_mask = self._encode_inputs(input_seqs)
+
+        batch_data = {
+            'occ1': input_seqs,
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'targets_seq2seq': torch.from_numpy(self.targets_seq2seq[items].astype(np.int64)),
+            'targets_linear_indices': torch.from_numpy(self.targets_linear[items].astype(np.int64)),
         }
 
         return batch_data
@@ -887,13 +1411,14 @@ class OccDatasetV2FromAlreadyLoadedInputs(OccDatasetV2): # TODO: Check with Torb
         self.formatter = formatter
         self.tokenizer = tokenizer
         self.max_input_len = max_input_len
+        self.use_canine_encode = supports_canine_encode(tokenizer)
 
         self.training = training
         self.unk_lang_prob = unk_lang_prob
         self.attacker = AttackerClass(
             alt_prob=alt_prob,
             n_trans=n_trans,
-            df=data,
+            df=data if training else None,
         )
 
         # Handle singular lang
@@ -904,6 +1429,11 @@ class OccDatasetV2FromAlreadyLoadedInputs(OccDatasetV2): # TODO: Check with Torb
         self.colnames = ['occ1', 'lang']
         self.map_item_byte_index = self._setup_mapping(fname_index)
 
+        # Populated lazily on first access when not training
+        self.input_seqs: list[str] | None = None
+        self.input_ids: Tensor | None = None
+        self.attention_mask: Tensor | None = None
+
     def _get_record(self, item: int) -> dict:
         occ_descr = self.inputs[item]
         lang = self.lang[item]
@@ -918,12 +1448,19 @@ class OccDatasetV2FromAlreadyLoadedInputs(OccDatasetV2): # TODO: Check with Torb
     def __len__(self) -> int:
         return len(self.inputs)
 
-    def __getitem__(self, item: int) -> dict[str, str | Tensor]:
+    def input_lengths(self) -> np.ndarray:
+        lengths = [
+            len(occ_descr[0] if isinstance(occ_descr, list) else occ_descr) + len(lang)
+            for occ_descr, lang in zip(self.inputs, self.lang)
+        ]
+
+        return np.array(lengths, dtype=np.int64) + len('[SEP]')
+
+    def _get_input_seq(self, item: int) -> str:
         record = self._get_record(item)
 
         occ_descr: str = record['occ1']
         lang: str = record['lang']
-        # target = self.formatter.transform_label(record)
 
         # Ensure list
         if isinstance(occ_descr, list):
@@ -933,29 +1470,536 @@ class OccDatasetV2FromAlreadyLoadedInputs(OccDatasetV2): # TODO: Check with Torb
 
         # Augment occupational description and language and
         # return '<LANG>[SEP]<OCCUPATIONAL DESCRIPTION>'
-        input_seq = self._prepare_input(occ_descr, lang)
+        return self._prepare_input(occ_descr, lang)
+
+    def _pre_encode(self) -> None:
+        ''' Without augmentation, inputs are fixed, so we encode all of them
+        up front in one vectorized pass and only slice in `self.__getitem__`.
+        '''
+        self.input_seqs = [self._get_input_seq(item) for item in range(len(self))]
+        self.input_ids, self.attention_mask = self._encode_inputs(self.input_seqs)
+
+    def __getitem__(self, item: int) -> dict[str, str | Tensor]:
+        if not self.training:
+            if self.input_ids is None:
+                self._pre_encode()
+
+            return {
+                'occ1': self.input_seqs[item],  # Legacy name...
+                'input_ids': self.input_ids[item],
+                'attention_mask': self.attention_mask[item],
+            }
+
+        input_seq = self._get_input_seq(item)
 
         # Encode input sequence
-        encoded_input_seq = self.tokenizer.encode_plus(
-            input_seq,
-            add_special_tokens=True,
-            padding='max_length',
-            max_length=self.max_input_len,
-            return_token_type_ids=False,
-            return_attention_mask=True,
-            return_tensors='pt',
-            truncation=True
-        )
+        input_ids, attention_mask = self._encode_input(input_seq)
 
         batch_data = {
             'occ1': input_seq,  # Legacy name...
-            'input_ids': encoded_input_seq['input_ids'].flatten(),
-            'attention_mask': encoded_input_seq['attention_mask'].flatten()
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
         }
 
         return batch_data
 
 
+class OccDatasetMixerStreaming(IterableDataset):
+    '''
+    Streaming counterpart of `OccDatasetMixerInMemMultipleFiles` for Parquet
+    files too large to hold in memory (on every rank and in every worker).
+
+    Row groups are read one at a time with `pyarrow`. Each epoch, the row
+    groups of all files are shuffled, and their rows split into equal
+    contiguous ranges across DDP ranks (splitting row groups at the ends of
+    the ranges), which are then split across DataLoader workers. Rows are mixed
+    through a shuffle buffer of `shuffle_buffer_size` rows before being
+    augmented and encoded in blocks of `encode_block_size` rows, yielding
+    samples in the same format as `OccDatasetMixerInMemMultipleFiles`.
+
+    Every rank yields the same number of samples per epoch, see `__len__`,
+    such that DDP processes stay in sync. Call `set_epoch` before each epoch
+    to reshuffle; the epoch is shared with (persistent) DataLoader workers.
+
+    Note that, unlike the in-memory datasets, no vocabulary is built from the
+    data for random word insertion; pass `word_freq_table` to enable it.
+    '''
+    def __init__(
+            self,
+            fnames_data: list[str],
+            formatter: BlockyHISCOFormatter | BlockyOCC1950Formatter | BlockyFormatter,
+            tokenizer: CanineTokenizer,
+            max_input_len: int,
+            num_classes_flat: int,
+            training: bool = True,
+            alt_prob: float = 0.3,
+            n_trans: int = 3,
+            unk_lang_prob: float = 0.25,
+            target_cols: str | list[str] = 'hisco',
+            map_code_label: dict[str, int] | None = None,
+            word_freq_table: pd.DataFrame | None = None,
+            shuffle: bool | None = None,
+            shuffle_buffer_size: int = 100_000,
+            encode_block_size: int = 256,
+            seed: int = 0,
+            num_replicas: int = 1,
+            rank: int = 0,
+    ):
+        import pyarrow.parquet as pq # pylint: disable=C0415
+
+        if isinstance(target_cols, str):
+            target_cols = OccDatasetV2.map_type_target_cols_default[target_cols]
+
+        self.fnames_data = list(fnames_data)
+        self.formatter = formatter
+        self.tokenizer = tokenizer
+        self.max_input_len = max_input_len
+        self.use_canine_encode = supports_canine_encode(tokenizer)
+        self.num_classes_flat = num_classes_flat
+        self.target_cols = target_cols
+        self.map_code_label = map_code_label
+
+        self.training = training
+        self.unk_lang_prob = unk_lang_prob
+        self.attacker = AttackerClass(
+            alt_prob=alt_prob,
+            n_trans=n_trans,
+            word_freq_table=word_freq_table if training else None,
+        )
+
+        self.shuffle = training if shuffle is None else shuffle
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.encode_block_size = encode_block_size
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+        # (file index, row group index) and number of rows of each row group
+        row_groups, num_rows = [], []
+
+        for file_idx, fname in enumerate(self.fnames_data):
+            metadata = pq.ParquetFile(fname).metadata
+
+            for row_group in range(metadata.num_row_groups):
+                row_groups.append((file_idx, row_group))
+                num_rows.append(metadata.row_group(row_group).num_rows)
+
+        self.row_groups = row_groups
+        self.num_rows = np.array(num_rows, dtype=np.int64)
+
+        # Shared with DataLoader workers, see `set_epoch`
+        self._epoch = torch.zeros(1, dtype=torch.long).share_memory_()
+
+        self._parquet_files = {}
+        self._target_cache = {}
+
+    # Augmentation and encoding of inputs is shared with map-style datasets
+    _prepare_inputs = OccDatasetV2._prepare_inputs
+    _encode_inputs = OccDatasetV2._encode_inputs
+
+    def __getstate__(self) -> dict:
+        # Open Parquet files are not shared with (spawned) workers
+        state = self.__dict__.copy()
+        state['_parquet_files'] = {}
+
+        return state
+
+    def set_epoch(self, epoch: int) -> None:
+        self._epoch.fill_(epoch)
+
+    def __len__(self) -> int:
+        ''' Number of samples yielded by each rank per epoch. As ranks get
+        equal ranges of rows, the last `total % num_replicas` rows (fewer
+        than `num_replicas`) of each epoch's order of row groups are dropped
+        '''
+        return int(self.num_rows.sum()) // self.num_replicas
+
+    def _rank_segments(self, epoch: int) -> list[tuple[int, int, int]]:
+        ''' Rows of this rank as (row group index, start, stop) segments,
+        where all but the first and last segment are whole row groups
+        '''
+        order = np.arange(len(self.row_groups))
+
+        if self.shuffle:
+            order = np.random.default_rng(self.seed + epoch).permutation(order)
+
+        # Position of the rows of each row group in the order of this epoch
+        ends = np.cumsum(self.num_rows[order])
+        begins = ends - self.num_rows[order]
+
+        start, stop = self.rank * len(self), (self.rank + 1) * len(self)
+        segments = []
+
+        for idx, begin, end in zip(order, begins, ends):
+            lower, upper = max(begin, start), min(end, stop)
+
+            if lower < upper:
+                segments.append((int(idx), int(lower - begin), int(upper - begin)))
+
+        return segments
+
+    def _worker_segments(self, epoch: int, worker_id: int, num_workers: int) -> list[tuple[int, int, int]]:
+        ''' Segments of a DataLoader worker, such that the rank's workers
+        together yield `len(self)` rows
+        '''
+        return self._rank_segments(epoch)[worker_id::num_workers]
+
+    def _read_rows(self, idx: int) -> list[tuple[str, str, tuple]]:
+        import pyarrow.parquet as pq # pylint: disable=C0415
+
+        file_idx, row_group = self.row_groups[idx]
+
+        if file_idx not in self._parquet_files:
+            self._parquet_files[file_idx] = pq.ParquetFile(self.fnames_data[file_idx])
+
+        table = self._parquet_files[file_idx].read_row_group(
+            row_group,
+            columns=['occ1', 'lang', *self.target_cols],
+        )
+
+        return list(zip(
+            table.column('occ1').to_pylist(),
+            table.column('lang').to_pylist(),
+            zip(*(table.column(col).to_pylist() for col in self.target_cols)),
+        ))
+
+    def _iter_rows(self, segments: list[tuple[int, int, int]], rng: random.Random):
+        if not self.shuffle:
+            for idx, start, stop in segments:
+                yield from self._read_rows(idx)[start:stop]
+
+            return
+
+        buffer = []
+
+        for idx, start, stop in segments:
+            for row in self._read_rows(idx)[start:stop]:
+                if len(buffer) < self.shuffle_buffer_size:
+                    buffer.append(row)
+                    continue
+
+                # Emit a random buffered row and keep the new one instead
+                pos = rng.randrange(len(buffer))
+                yield buffer[pos]
+                buffer[pos] = row
+
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def _get_targets(self, codes: tuple) -> tuple[Tensor, Tensor]:
+        ''' Encoded seq2seq target and padded flat code indices, cached
+        since many rows share their codes
+        '''
+        # NaN never compares equal, so use None for missing codes in keys
+        codes = tuple(None if isinstance(code, float) and math.isnan(code) else code for code in codes)
+
+        if codes not in self._target_cache:
+            record = dict(zip(self.target_cols, codes))
+            indices = _target_linear_indices(record, self.target_cols, self.map_code_label)
+
+            targets_seq2seq = torch.tensor(self.formatter.transform_label(record), dtype=torch.long)
+            targets_linear_indices = torch.full((len(self.target_cols),), -1, dtype=torch.long)
+            targets_linear_indices[:len(indices)] = torch.tensor(indices, dtype=torch.long)
+
+            self._target_cache[codes] = (targets_seq2seq, targets_linear_indices)
+
+        return self._target_cache[codes]
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+
+        epoch = int(self._epoch.item())
+        segments = self._worker_segments(epoch, worker_id, num_workers)
+        rng = random.Random(f'{self.seed}-{epoch}-{self.rank}-{worker_id}')
+
+        rows = self._iter_rows(segments, rng)
+
+        while block := list(islice(rows, self.encode_block_size)):
+            occ_descrs, langs, codes = zip(*block)
+
+            input_seqs = self._prepare_inputs(list(occ_descrs), list(langs))
+            input_ids, attention_mask = self._encode_inputs(input_seqs)
+
+            for i, input_seq in enumerate(input_seqs):
+                targets_seq2seq, targets_linear_indices = self._get_targets(codes[i])
+
+                yield {
+                    'occ1': input_seq,
+                    'input_ids': input_ids[i],
+                    'attention_mask': attention_mask[i],
+                    'targets_seq2seq': targets_seq2seq,
+                    'targets_linear_indices': targets_linear_indices,
+                }
+
+
+CANINE_DOWNSAMPLING_RATE = 4
+
+# Padding CANINE needs after the longest input of a batch for its outputs at
+# real positions to be those of the fully padded batch: its upsampling
+# convolution (kernel size 4) looks 2 positions ahead, and characters of the
+# last downsampling block get the state of the block before it
+CANINE_PADDING_MARGIN = CANINE_DOWNSAMPLING_RATE + 2
+
+
+def trim_padding(
+        batch: dict[str, Tensor],
+        pad_multiple: int = CANINE_DOWNSAMPLING_RATE,
+        margin: int = CANINE_PADDING_MARGIN,
+        ) -> dict[str, Tensor]:
+    '''
+    Trim `input_ids` and `attention_mask` of a collated batch to the length of
+    its longest member plus `margin` padding positions, rounded up to a
+    multiple of `pad_multiple`. By default this is CANINE's downsampling rate,
+    such that characters are grouped into the same downsampled positions as
+    when padding to the full length, and the margin is the padding CANINE
+    looks at beyond an input, such that encoder outputs at real positions are
+    those of the fully padded batch.
+    '''
+    attention_mask = batch['attention_mask']
+    full_len = attention_mask.shape[1]
+
+    # Inputs are right-padded, so the mask sum is the number of real tokens
+    max_len = int(attention_mask.sum(dim=1).max()) if len(attention_mask) > 0 else 0
+    length = min(full_len, -(-(max_len + margin) // pad_multiple) * pad_multiple)
+
+    if length < full_len:
+        batch['input_ids'] = batch['input_ids'][:, :length].contiguous()
+        batch['attention_mask'] = attention_mask[:, :length].contiguous()
+
+    return batch
+
+
+def collate_batch(
+        batch: list[dict[str, str | Tensor]] | dict[str, list[str] | Tensor],
+        ) -> dict[str, list[str] | Tensor]:
+    '''
+    Collate function that also accepts batches already collated by the
+    `__getitems__` of a dataset with `batched=True`, which are passed on as-is.
+    '''
+    if isinstance(batch, dict):
+        return batch
+
+    return default_collate(batch)
+
+
+def dynamic_padding_collate(
+        batch: list[dict[str, str | Tensor]] | dict[str, list[str] | Tensor],
+        pad_multiple: int = CANINE_DOWNSAMPLING_RATE,
+        margin: int = CANINE_PADDING_MARGIN,
+        ) -> dict[str, list[str] | Tensor]:
+    '''
+    `collate_fn` which pads each batch to its longest member rather than to
+    the dataset's `max_input_len`. See `trim_padding`.
+    '''
+    return trim_padding(collate_batch(batch), pad_multiple=pad_multiple, margin=margin)
+
+
+class LengthBucketBatchSampler(Sampler[list[int]]):
+    '''
+    Batch sampler grouping inputs of similar length, such that batches
+    padded by `dynamic_padding_collate` are short.
+
+    Without shuffling, batches are formed from the indices sorted by length.
+    With shuffling, indices are permuted each epoch (see `set_epoch`) and
+    split into pools of `batch_size * bucket_size_multiplier` indices. Each
+    pool is sorted by length and cut into batches, and the order of batches
+    is permuted. This keeps batches random while their members are of similar
+    length.
+
+    With `num_replicas > 1`, batches are sharded across ranks, padding by
+    repeating batches such that every rank gets the same number of batches.
+
+    If instead each rank holds its own shard of the data (see `num_replicas`
+    and `rank` of the in-memory datasets), use `sharded`, such that batches
+    are formed from the `lengths` of the shard only. As for `ShardSampler`,
+    all ranks then get the same number of batches: that of the rank with the
+    fewest if `drop_last`, else that of the rank with the most, with other
+    ranks repeating batches. This is a collective operation, so all ranks
+    must construct their sampler together.
+
+    Use `order` to map outputs back to the order of the dataset.
+    '''
+    def __init__(
+            self,
+            lengths: np.ndarray,
+            batch_size: int,
+            shuffle: bool = False,
+            drop_last: bool = False,
+            bucket_size_multiplier: int = 100,
+            seed: int = 0,
+            num_replicas: int = 1,
+            rank: int = 0,
+            sharded: bool = False,
+    ):
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f'Invalid rank {rank}, must be in [0, {num_replicas - 1}]')
+
+        if sharded and num_replicas > 1:
+            raise ValueError('Data which is already sharded should not be sharded again by the sampler')
+
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.sharded = sharded
+        self.epoch = 0
+
+        self.num_shard_batches = None
+
+        if sharded:
+            self.num_shard_batches = ShardSampler._common_num_samples(self._num_batches(), drop_last) # pylint: disable=W0212
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _num_batches(self) -> int:
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+    def _all_batches(self) -> list[np.ndarray]:
+        if self.shuffle:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            indices = rng.permutation(len(self.lengths))
+            pool_size = self.batch_size * self.bucket_size_multiplier
+            pools = [indices[i:i + pool_size] for i in range(0, len(indices), pool_size)]
+            indices = np.concatenate(
+                [pool[np.argsort(self.lengths[pool], kind='stable')] for pool in pools]
+            ) if pools else indices
+        else:
+            indices = np.argsort(self.lengths, kind='stable')
+
+        batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        return batches
+
+    def _rank_batches(self) -> list[np.ndarray]:
+        batches = self._all_batches()
+
+        if self.sharded:
+            # Repeat batches if this shard is smaller than others
+            if batches and self.num_shard_batches > len(batches):
+                batches = batches * math.ceil(self.num_shard_batches / len(batches))
+
+            return batches[:self.num_shard_batches]
+
+        if self.num_replicas == 1:
+            return batches
+
+        if self.drop_last:
+            batches = batches[:len(batches) - len(batches) % self.num_replicas]
+        else:
+            padding = -len(batches) % self.num_replicas
+            batches = batches + (batches * math.ceil(padding / max(len(batches), 1)))[:padding]
+
+        return batches[self.rank::self.num_replicas]
+
+    def order(self) -> np.ndarray:
+        ''' Dataset indices in the order they are yielded '''
+        batches = self._rank_batches()
+
+        if not batches:
+            return np.zeros(0, dtype=np.int64)
+
+        return np.concatenate(batches)
+
+    def __iter__(self):
+        for batch in self._rank_batches():
+            yield batch.tolist()
+
+    def __len__(self) -> int:
+        if self.sharded:
+            return self.num_shard_batches if len(self.lengths) > 0 else 0
+
+        num_batches = self._num_batches()
+
+        if self.num_replicas == 1:
+            return num_batches
+
+        if self.drop_last:
+            return num_batches // self.num_replicas
+
+        return math.ceil(num_batches / self.num_replicas)
+
+
+class ShardSampler(Sampler[int]):
+    '''
+    Sampler over the shard of a dataset held by one rank in distributed
+    training (see `num_replicas` and `rank` of the in-memory datasets), the
+    counterpart of `DistributedSampler` for datasets that are not replicated.
+
+    All ranks draw the same number of samples per epoch, such that DDP
+    processes stay in sync: the size of the smallest shard if `drop_last`,
+    else the size of the largest, with smaller shards repeating samples.
+    Determining this is a collective operation, so all ranks must construct
+    their sampler together. Call `set_epoch` for a reproducible reshuffle
+    each epoch.
+    '''
+    def __init__(
+            self,
+            data_source: Dataset,
+            shuffle: bool = True,
+            seed: int = 0,
+            drop_last: bool = False,
+    ):
+        self.data_source = data_source
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        self.num_samples = self._common_num_samples(len(data_source), drop_last)
+
+    @staticmethod
+    def _common_num_samples(num_samples: int, drop_last: bool) -> int:
+        if not (dist.is_available() and dist.is_initialized()):
+            return num_samples
+
+        device = torch.device('cpu')
+
+        if dist.get_backend() == 'nccl':
+            device = torch.device('cuda', torch.cuda.current_device())
+
+        num_samples = torch.tensor(num_samples, device=device)
+        dist.all_reduce(num_samples, op=dist.ReduceOp.MIN if drop_last else dist.ReduceOp.MAX)
+
+        return int(num_samples.item())
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __iter__(self):
+        size = len(self.data_source)
+
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(size, generator=generator).tolist()
+        else:
+            indices = list(range(size))
+
+        # Repeat samples if this shard is smaller than others
+        if size > 0 and self.num_samples > size:
+            indices = indices * math.ceil(self.num_samples / size)
+
+        return iter(indices[:self.num_samples])
+
+    def __len__(self) -> int:
+        return self.num_samples
+
+
 def datasets(
         n_obs_train: int,
         n_obs_val: int,
@@ -971,9 +2015,9 @@ def datasets(
     '''Function to return datasets
     '''
     # File paths for the index files
-    train_index_path = "../Data/Tmp_train/Train_index.txt"
-    val_index_path = "../Data/Tmp_train/Val_index.txt"
-    test_index_path = "../Data/Tmp_train/Test_index.txt"
+    train_index_path = "../Data/Tmp_train/Train_index.npy"
+    val_index_path = "../Data/Tmp_train/Val_index.npy"
+    test_index_path = "../Data/Tmp_train/Test_index.npy"
 
     # Instantiating OCCDataset with index file paths
     ds_train = OCCDataset(df_path="../Data/Tmp_train/Train.csv", n_obs=n_obs_train, tokenizer=tokenizer, attacker=attacker, max_len=max_len, n_classes=n_classes, index_file_path=train_index_path, alt_prob=0, model_domain=model_domain, formatter=formatter)
@@ -1014,14 +2058,32 @@ def create_data_loader(ds_train, ds_train_attack, ds_val, ds_test, batch_size):
     return data_loader_train, data_loader_train_attack, data_loader_val, data_loader_test
 
 # Save tmp_train
-def create_index_file(csv_file_path, index_file_path):
-    byte_offset = 0
-    with open(csv_file_path, 'rb') as f, open(index_file_path, 'w') as index_file:
-        next(f)  # Skip the header row
-        byte_offset = f.tell()  # Get the current position after skipping
-        for line in f:
-            index_file.write(f"{byte_offset}\n")
-            byte_offset += len(line)
+def create_index_file(csv_file_path, index_file_path, chunk_size = 2**26):
+    ''' Save the byte offset of each data row (i.e., excluding the header) of
+    a CSV file as a NumPy uint64 array in `index_file_path` (.npy), see
+    `load_byte_offsets`
+    '''
+    np.save(index_file_path, _csv_row_offsets(csv_file_path, chunk_size))
+
+
+def _csv_row_offsets(csv_file_path, chunk_size = 2**26) -> np.ndarray:
+    ''' Byte offset of each data row (i.e., excluding the header) of a CSV
+    file, found by scanning for newlines without parsing the file
+    '''
+    offsets = [np.zeros(0, dtype=np.uint64)]
+    position = 0
+
+    with open(csv_file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+            offsets.append(newlines.astype(np.uint64) + np.uint64(position + 1))
+            position += len(chunk)
+
+    # Rows start after each newline; the first row is the header and a
+    # trailing newline does not start a new row
+    offsets = np.concatenate(offsets)
+
+    return offsets[offsets < position]
 
 
 # Saves temporary data to call in training
@@ -1044,9 +2106,9 @@ def save_tmp(df_train, df_val, df_test, path = "../Data/Tmp_train/", verbose = T
     df_test.to_csv(test_file_path, index=False)
 
     # Create index files for each CSV
-    create_index_file(train_file_path, os.path.join(directory_path, "Train_index.txt"))
-    create_index_file(val_file_path, os.path.join(directory_path, "Val_index.txt"))
-    create_index_file(test_file_path, os.path.join(directory_path, "Test_index.txt"))
+    create_index_file(train_file_path, os.path.join(directory_path, "Train_index.npy"))
+    create_index_file(val_file_path, os.path.join(directory_path, "Val_index.npy"))
+    create_index_file(test_file_path, os.path.join(directory_path, "Test_index.npy"))
 
     if verbose:
         print(f"Saved tmp files to {path}")
@@ -1 +1 @@
-from .decoder import TransformerDecoder
+from .decoder import TransformerDecoder, DecoderCache, DecoderMemory, trim_memory
@@ -3,6 +3,7 @@ import math
 import torch
 
 from torch import nn, Tensor
+from torch.nn import functional as F
 
 
 class TokenEmbedding(nn.Module):
@@ -33,8 +34,136 @@ class PositionalEncoding(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.register_buffer('pos_embedding', pos_embedding)
 
-    def forward(self, token_embedding: Tensor):
-        return self.dropout(token_embedding + self.pos_embedding[:token_embedding.size(0), :])
+    def forward(self, token_embedding: Tensor, offset: int = 0):
+        seq_len = token_embedding.size(0)
+
+        return self.dropout(token_embedding + self.pos_embedding[offset:offset + seq_len, :])
+
+
+class DecoderCache:
+    '''
+    Per-layer cache of self-attention keys and values used for incremental
+    decoding. Each cached tensor has shape (B, nhead, Seq[decoded], head_dim),
+    such that a decoding step only needs to process the newest token(s).
+
+    '''
+    def __init__(self, num_layers: int):
+        self.keys: list[Tensor | None] = [None] * num_layers
+        self.values: list[Tensor | None] = [None] * num_layers
+
+    @property
+    def seq_len(self) -> int: # pylint: disable=C0116
+        if self.keys[0] is None:
+            return 0
+
+        return self.keys[0].size(2)
+
+    def update(self, layer_idx: int, key: Tensor, value: Tensor) -> tuple[Tensor, Tensor]:
+        ''' Append keys and values of new tokens for layer `layer_idx` and
+        return keys and values of the full sequence decoded so far.
+
+        '''
+        if self.keys[layer_idx] is not None:
+            key = torch.cat([self.keys[layer_idx], key], dim=2)
+            value = torch.cat([self.values[layer_idx], value], dim=2)
+
+        self.keys[layer_idx] = key
+        self.values[layer_idx] = value
+
+        return key, value
+
+    def index_select(self, index: Tensor):
+        ''' Keep (and possibly repeat) only rows `index` of the cache, e.g.,
+        to follow the surviving hypotheses of a beam search.
+
+        '''
+        self.keys = [k.index_select(0, index) if k is not None else None for k in self.keys]
+        self.values = [v.index_select(0, index) if v is not None else None for v in self.values]
+
+    def copy(self) -> 'DecoderCache':
+        ''' Copy which can be extended, e.g., to score a continuation, without
+        extending this cache. Cached tensors are shared, as they are never
+        modified in place.
+
+        '''
+        cache = DecoderCache(len(self.keys))
+        cache.keys = list(self.keys)
+        cache.values = list(self.values)
+
+        return cache
+
+
+def trim_memory(
+        memory: Tensor, # i.e., input encoded by CANINE, (B, Seq[input], Features)
+        attention_mask: Tensor, # (B, Seq[input]), 1 for real tokens, 0 for padding
+        ) -> tuple[Tensor, Tensor]:
+    '''
+    Drop trailing positions which are padding for all observations of the
+    batch and return the remaining memory along with its key padding mask,
+    which is True for padding (as expected by `nn.TransformerDecoder`).
+
+    '''
+    # Inputs are right-padded, so the mask sum is the number of real tokens
+    max_len = int(attention_mask.sum(dim=1).max()) if attention_mask.size(0) > 0 else 0
+    max_len = max(max_len, 1)
+
+    memory = memory[:, :max_len]
+    key_padding_mask = attention_mask[:, :max_len] == 0
+
+    return memory, key_padding_mask
+
+
+class DecoderMemory:
+    '''
+    Cross-attention keys and values of an encoded input, projected once per
+    decoder layer such that they can be reused across decoding steps. Each
+    tensor has shape (B, nhead, Seq[input], head_dim). The optional key
+    padding mask, (B, Seq[input]), is True for padded input positions, which
+    are then not attended to.
+
+    Decoding several continuations (branches) of each observation at once does
+    not require replicating the memory: with `num_branches=n`, the decoder
+    expects n * B rows laid out branch-major (row i * B + b is branch i of
+    observation b), and all branches of an observation share its keys and
+    values.
+
+    '''
+    def __init__(
+            self,
+            keys: list[Tensor],
+            values: list[Tensor],
+            num_branches: int = 1,
+            key_padding_mask: Tensor | None = None,
+            ):
+        self.keys = keys
+        self.values = values
+        self.num_branches = num_branches
+        self.key_padding_mask = key_padding_mask
+
+    @property
+    def batch_size(self) -> int: # pylint: disable=C0116
+        return self.keys[0].size(0)
+
+    def expand(self, num_branches: int) -> 'DecoderMemory':
+        ''' View of the same keys and values for `num_branches` branches per
+        observation. No tensors are copied.
+
+        '''
+        return DecoderMemory(self.keys, self.values, num_branches, self.key_padding_mask)
+
+    def index_select(self, index: Tensor) -> 'DecoderMemory':
+        ''' Keys and values of observations `index`, e.g., to decode a
+        varying number of rows per observation.
+
+        '''
+        return DecoderMemory(
+            [key.index_select(0, index) for key in self.keys],
+            [value.index_select(0, index) for value in self.values],
+            key_padding_mask=(
+                self.key_padding_mask.index_select(0, index)
+                if self.key_padding_mask is not None else None
+            ),
+        )
 
 
 class TransformerDecoder(nn.Module):
@@ -72,6 +201,7 @@ class TransformerDecoder(nn.Module):
             target: Tensor,
             target_mask: Tensor,
             target_padding_mask: Tensor,
+            memory_padding_mask: Tensor | None = None,
             ) -> Tensor:
         memory = memory.permute(1, 0, 2) # (B, Seq[target], Features) -> (Seq[target], B, Features)
         target = target.permute(1, 0) # (B, Seq[target]) -> (Seq[target], B)
@@ -83,6 +213,7 @@ class TransformerDecoder(nn.Module):
             tgt_mask=target_mask,
             memory_mask=None,
             tgt_key_padding_mask=target_padding_mask,
+            memory_key_padding_mask=memory_padding_mask,
             ) # (Seq[target], B, Features)
 
         return decoder_out.permute(1, 0, 2) # (B, Seq[target], Features)
@@ -93,8 +224,194 @@ class TransformerDecoder(nn.Module):
             target: Tensor,
             target_mask: Tensor,
             target_padding_mask: Tensor,
+            memory_padding_mask: Tensor | None = None,
             ) -> Tensor:
-        out = self.forward_features(memory, target, target_mask, target_padding_mask) # (Seq[target], B, Features)
+        out = self.forward_features(memory, target, target_mask, target_padding_mask, memory_padding_mask) # (Seq[target], B, Features)
         out = self.head(out) # (B, Seq[target], vocab_size)
 
         return out
+
+    def init_cache(self) -> DecoderCache: # pylint: disable=C0116
+        return DecoderCache(num_layers=len(self.decoder.layers))
+
+    def precompute_memory(
+            self,
+            memory: Tensor, # i.e., input encoded by CANINE, (B, Seq[input], Features)
+            memory_padding_mask: Tensor | None = None, # (B, Seq[input]), True for padding
+            ) -> DecoderMemory:
+        '''
+        Project `memory` to the cross-attention keys and values of each
+        decoder layer. Since these do not depend on the target, this only
+        needs to happen once per batch, however many decoding steps follow.
+
+        '''
+        batch_size, seq_len, emb_size = memory.shape
+        keys, values = [], []
+
+        for layer in self.decoder.layers:
+            attn = layer.multihead_attn
+            head_dim = emb_size // attn.num_heads
+
+            weight = attn.in_proj_weight[emb_size:]
+            bias = attn.in_proj_bias[emb_size:] if attn.in_proj_bias is not None else None
+
+            key, value = F.linear(memory, weight, bias).chunk(2, dim=-1)
+            key, value = (
+                t.reshape(batch_size, seq_len, attn.num_heads, head_dim).transpose(1, 2)
+                for t in (key, value)
+            ) # (B, nhead, Seq[input], head_dim)
+
+            keys.append(key)
+            values.append(value)
+
+        return DecoderMemory(keys, values, key_padding_mask=memory_padding_mask)
+
+    def _cross_attention_step(
+            self,
+            attn: nn.MultiheadAttention,
+            x: Tensor, # (Seq[new], n * B, Features)
+            memory: DecoderMemory,
+            layer_idx: int,
+            ) -> Tensor:
+        seq_len, num_rows, emb_size = x.shape
+        head_dim = emb_size // attn.num_heads
+        num_branches, batch_size = memory.num_branches, memory.batch_size
+
+        if num_rows != num_branches * batch_size:
+            raise ValueError(
+                f'Expected {num_branches} * {batch_size} decoder rows, got {num_rows}'
+            )
+
+        weight = attn.in_proj_weight[:emb_size]
+        bias = attn.in_proj_bias[:emb_size] if attn.in_proj_bias is not None else None
+
+        # Fold branches into the query dimension, such that all branches of an
+        # observation attend to its keys and values in one call without copies
+        query = F.linear(x, weight, bias)
+        query = query.reshape(seq_len, num_branches, batch_size, attn.num_heads, head_dim)
+        query = query.permute(2, 3, 1, 0, 4).reshape(
+            batch_size, attn.num_heads, num_branches * seq_len, head_dim,
+        ) # (B, nhead, n * Seq[new], head_dim)
+
+        # Padded input positions are not attended to
+        attn_mask = None
+
+        if memory.key_padding_mask is not None:
+            attn_mask = ~memory.key_padding_mask[:, None, None, :] # (B, 1, 1, Seq[input])
+
+        out = F.scaled_dot_product_attention(
+            query, memory.keys[layer_idx], memory.values[layer_idx],
+            attn_mask=attn_mask,
+            dropout_p=attn.dropout if self.training else 0.0,
+        ) # (B, nhead, n * Seq[new], head_dim)
+        out = out.reshape(batch_size, attn.num_heads, num_branches, seq_len, head_dim)
+        out = out.permute(3, 2, 0, 1, 4).reshape(seq_len, num_rows, emb_size)
+
+        return attn.out_proj(out)
+
+    def _self_attention_step(
+            self,
+            attn: nn.MultiheadAttention,
+            x: Tensor, # (Seq[new], B, Features)
+            cache: DecoderCache | None,
+            layer_idx: int,
+            ) -> Tensor:
+        seq_len, batch_size, emb_size = x.shape
+        head_dim = emb_size // attn.num_heads
+
+        # Same packed in-projection as `nn.MultiheadAttention`, but keys and
+        # values of previously decoded tokens are read from `cache`
+        query, key, value = F.linear(x, attn.in_proj_weight, attn.in_proj_bias).chunk(3, dim=-1)
+        query, key, value = (
+            t.reshape(seq_len, batch_size, attn.num_heads, head_dim).permute(1, 2, 0, 3)
+            for t in (query, key, value)
+        ) # (B, nhead, Seq[new], head_dim)
+
+        if cache is not None:
+            key, value = cache.update(layer_idx, key, value)
+
+        offset = key.size(2) - seq_len
+
+        # New tokens attend to all cached tokens and causally among themselves
+        attn_mask = None
+
+        if seq_len > 1:
+            attn_mask = torch.ones(
+                seq_len, offset + seq_len, dtype=torch.bool, device=x.device,
+            ).tril(diagonal=offset)
+
+        out = F.scaled_dot_product_attention(
+            query, key, value,
+            attn_mask=attn_mask,
+            dropout_p=attn.dropout if self.training else 0.0,
+        ) # (B, nhead, Seq[new], head_dim)
+        out = out.permute(2, 0, 1, 3).reshape(seq_len, batch_size, emb_size)
+
+        return attn.out_proj(out)
+
+    def _layer_step( # pylint: disable=C0116
+            self,
+            layer: nn.TransformerDecoderLayer,
+            x: Tensor, # (Seq[new], B, Features)
+            memory: DecoderMemory,
+            cache: DecoderCache | None,
+            layer_idx: int,
+            ) -> Tensor:
+        def _sa_block(x: Tensor) -> Tensor:
+            return layer.dropout1(self._self_attention_step(layer.self_attn, x, cache, layer_idx))
+
+        def _mha_block(x: Tensor) -> Tensor:
+            return layer.dropout2(self._cross_attention_step(layer.multihead_attn, x, memory, layer_idx))
+
+        def _ff_block(x: Tensor) -> Tensor:
+            return layer.dropout3(layer.linear2(layer.dropout(layer.activation(layer.linear1(x)))))
+
+        if layer.norm_first:
+            x = x + _sa_block(layer.norm1(x))
+            x = x + _mha_block(layer.norm2(x))
+            x = x + _ff_block(layer.norm3(x))
+        else:
+            x = layer.norm1(x + _sa_block(x))
+            x = layer.norm2(x + _mha_block(x))
+            x = layer.norm3(x + _ff_block(x))
+
+        return x
+
+    def forward_step(
+            self,
+            memory: Tensor | DecoderMemory, # i.e., input encoded by CANINE
+            target: Tensor,
+            cache: DecoderCache | None = None,
+            memory_padding_mask: Tensor | None = None,
+            ) -> Tensor:
+        '''
+        Incremental counterpart to `forward` for autoregressive decoding.
+        `target` (B, Seq[new]) holds only the tokens not yet processed; keys
+        and values of earlier tokens are read from `cache`, which is updated
+        in place. Equivalent to running `forward` with a causal mask on the
+        full sequence and keeping the last Seq[new] positions. Without a
+        cache, `target` is treated as the full sequence.
+
+        `memory` may be passed as a `DecoderMemory` from `precompute_memory`
+        to avoid projecting it again at every step, in which case `target`
+        may hold several branches per observation (see `DecoderMemory`).
+        `memory_padding_mask` is only used if `memory` is not precomputed.
+
+        '''
+        if not isinstance(memory, DecoderMemory):
+            memory = self.precompute_memory(memory, memory_padding_mask)
+
+        target = target.permute(1, 0) # (B, Seq[new]) -> (Seq[new], B)
+        offset = cache.seq_len if cache is not None else 0
+
+        x = self.positional_encoding(self.token_emb(target), offset=offset) # (Seq[new], B, Features)
+
+        for layer_idx, layer in enumerate(self.decoder.layers):
+            x = self._layer_step(layer, x, memory, cache, layer_idx)
+
+        if self.decoder.norm is not None:
+            x = self.decoder.norm(x)
+
+        out = self.head(x) # (Seq[new], B, vocab_size)
+
+        return out.permute(1, 0, 2) # (B, Seq[new], vocab_size)
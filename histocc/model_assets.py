@@ -22,7 +22,7 @@ from transformers import (
     AutoTokenizer,
 )
 
-from .layers import TransformerDecoder
+from .layers import TransformerDecoder, DecoderCache, DecoderMemory, trim_memory
 
 
 # Model path from domain
@@ -173,8 +173,58 @@ class Seq2SeqOccCANINE(nn.Module):
             target: Tensor,
             target_mask: Tensor,
             target_padding_mask: Tensor,
+            attention_mask: Tensor | None = None,
     ) -> Tensor:
-        out = self.decoder(memory, target, target_mask, target_padding_mask)
+        ''' If the input `attention_mask` is specified, `memory` is trimmed to
+        the longest input of the batch and remaining padding is masked out.
+
+        '''
+        memory_padding_mask = None
+
+        if attention_mask is not None:
+            memory, memory_padding_mask = trim_memory(memory, attention_mask)
+
+        out = self.decoder(memory, target, target_mask, target_padding_mask, memory_padding_mask)
+
+        return out
+
+    def init_decoder_cache(self) -> DecoderCache: # pylint: disable=C0116
+        return self.decoder.init_cache()
+
+    def precompute_memory(
+            self,
+            memory: Tensor,
+            attention_mask: Tensor | None = None,
+    ) -> DecoderMemory:
+        ''' Project encoded input to cross-attention keys and values once, for
+        reuse across decoding steps. See `TransformerDecoder.precompute_memory`.
+        If the input `attention_mask` is specified, padding is trimmed and
+        masked out as in `decode`.
+
+        '''
+        memory_padding_mask = None
+
+        if attention_mask is not None:
+            memory, memory_padding_mask = trim_memory(memory, attention_mask)
+
+        return self.decoder.precompute_memory(memory, memory_padding_mask)
+
+    def decode_incremental(
+            self,
+            memory: Tensor | DecoderMemory,
+            target: Tensor,
+            cache: DecoderCache | None = None,
+            attention_mask: Tensor | None = None,
+    ) -> Tensor:
+        ''' Decode only the newest token(s) of `target`, reading keys and
+        values of earlier tokens from `cache`. See `TransformerDecoder.forward_step`.
+        `attention_mask` is only used if `memory` is not precomputed.
+
+        '''
+        if attention_mask is not None and not isinstance(memory, DecoderMemory):
+            memory = self.precompute_memory(memory, attention_mask)
+
+        out = self.decoder.forward_step(memory, target, cache)
 
         return out
 
@@ -187,7 +237,7 @@ class Seq2SeqOccCANINE(nn.Module):
             target_padding_mask: Tensor,
     ) -> Tensor:
         memory = self.encode(input_ids, attention_mask)
-        out = self.decode(memory, target, target_mask, target_padding_mask)
+        out = self.decode(memory, target, target_mask, target_padding_mask, attention_mask)
 
         return out
     
@@ -264,7 +314,7 @@ class Seq2SeqMixerOccCANINE(Seq2SeqOccCANINE):
     ) -> tuple[Tensor, Tensor]:
         memory, pooled_memory = self.encode(input_ids, attention_mask)
 
-        out_seq2seq = self.decode(memory, target, target_mask, target_padding_mask)
+        out_seq2seq = self.decode(memory, target, target_mask, target_padding_mask, attention_mask)
 
         out_linear = self.linear_decoder(pooled_memory)
         out_linear = self.linear_decoder_drop(out_linear)
@@ -42,10 +42,13 @@ from .model_assets import (
     )
 from .dataloader import (
     OccDatasetV2FromAlreadyLoadedInputs,
+    LengthBucketBatchSampler,
+    dynamic_padding_collate,
     )
 from .formatter import (
     hisco_blocky5,
     BOS_IDX,
+    EOS_IDX,
     PAD_IDX,
     construct_general_purpose_formatter,
 )
@@ -62,14 +65,23 @@ from .utils.decoder import (
     mixer_greedy_decode,
     full_search_decoder_seq2seq_optimized,
     full_search_decoder_mixer_optimized,
+    score_candidates,
+    beam_search_decoder,
+    best_first_search_decoder,
+    flat_topk_rerank_decoder_mixer,
+    speculative_mixer_greedy_decode,
+    adaptive_decoder_mixer,
     )
+from .utils.trie import CompiledTrie
 from .seq2seq_mixer_engine import train
+from functools import partial
 from itertools import permutations
 
 
-PredType = Literal['flat', 'greedy', 'full', 'embeddings']
+PredType = Literal['flat', 'greedy', 'full', 'beam', 'rerank', 'adaptive', 'embeddings']
+AdaptiveFallbackType = Literal['greedy', 'full', 'beam']
 SystemType = Literal['hisco'] | str
-BehaviorType = Literal['good', 'fast']
+BehaviorType = Literal['good', 'fast', 'adaptive']
 ModelType = Literal['flat', 'seq2seq', 'mix']
 ModelName = Literal['OccCANINE', 'OccCANINE_s2s', 'OccCANINE_s2s_mix']
 
@@ -280,6 +292,13 @@ class OccCANINE:
 
         self.key_desc = {int(k): str(v) for k, v in self.key_desc.items()}
 
+        # Trie over all codes used in full search, built once and reused for
+        # every batch. Formatted codes used for order invariant confidence are
+        # cached on demand
+        self.trie = CompiledTrie(self.codes_list, device=self.device)
+        self._formatted_codes_cache: dict[str, np.ndarray] = {}
+        self._draft_table: torch.Tensor | None = None
+
         # Model and model type
         if skip_load:
             if model_type is None:
@@ -360,6 +379,56 @@ class OccCANINE:
 
         return codes_list
 
+    def _get_formatted_codes(self, codes_list: list[str]) -> np.ndarray:
+        """
+        Returns formatted version of `codes_list` as an array of shape
+        (len(codes_list), self.code_len), with row i being code i. Formatting
+        of each code is cached, such that repeated codes (e.g., permutations
+        of the same predicted codes) are only formatted once. Raises a
+        ValueError for codes which cannot be formatted, such as " ".
+        """
+        missing = list(dict.fromkeys(code for code in codes_list if code not in self._formatted_codes_cache))
+
+        if missing:
+            if len(self._formatted_codes_cache) >= 100_000: # Bound memory use of cache
+                self._formatted_codes_cache.clear()
+
+            # One code at a time, as self._list_of_formatted_codes drops some codes
+            for code in missing:
+                formatted = self._list_of_formatted_codes(codes_list=[code])
+
+                if len(formatted) != 1:
+                    raise ValueError(f"Code '{code}' cannot be formatted")
+
+                self._formatted_codes_cache[code] = formatted[0]
+
+        return np.stack([self._formatted_codes_cache[code] for code in codes_list])
+
+    def _get_draft_table(self) -> torch.Tensor:
+        """
+        Returns the formatted target sequence of each code in self.key, indexed as the flat
+        decoder, which is used as drafts for speculative greedy decoding. Codes which cannot
+        be formatted get a draft of only padding, which is simply rejected when verified.
+        """
+        if self._draft_table is None:
+            drafts = np.full((max(self.key) + 1, self.formatter.max_seq_len), PAD_IDX, dtype=np.int64)
+            drafts[:, 0] = BOS_IDX
+            drafts[:, -1] = EOS_IDX
+
+            for i, code in self.key.items():
+                code = str(code)
+                if not self.use_within_block_sep and len(code) == (self.code_len-1):
+                    code = code.zfill(self.code_len)
+
+                try:
+                    drafts[i] = self.formatter.transform_label(code)
+                except (KeyError, ValueError, TypeError, AssertionError):
+                    continue
+
+            self._draft_table = torch.from_numpy(drafts).to(self.device)
+
+        return self._draft_table
+
     def _initialize_model(
             self,
             model_type: ModelType,
@@ -484,6 +553,15 @@ class OccCANINE:
             k_pred: int = 5,
             deduplicate: bool = False,
             order_invariant_conf: bool = True,
+            beam_width: int = 5,
+            rerank_k: int = 20,
+            adaptive_min_conf: float = 0.9,
+            adaptive_min_margin: float = 0.0,
+            adaptive_fallback: AdaptiveFallbackType = 'full',
+            dynamic_padding: bool = False,
+            length_bucketing: bool = False,
+            greedy_early_stopping: bool = True,
+            speculative_greedy: bool = False,
     ):
         """
         Makes predictions on a batch of occupational strings.
@@ -496,17 +574,27 @@ class OccCANINE:
         - concat_in (bool, optional): Ignored
         - get_dict (bool, optional): Ignored
         - get_df (bool, optional): Ignored
-        - behavior (str): Simple argument to set prediction arguments. Should prediction be "good" or "fast"? Defaults to "good".  See details.
-        - prediction_type (str): Either 'flat', 'greedy', 'full', 'embeddings'. Overwrites 'behavior'. See details.
+        - behavior (str): Simple argument to set prediction arguments. Should prediction be "good", "fast", or "adaptive"? Defaults to "good".  See details.
+        - prediction_type (str): Either 'flat', 'greedy', 'full', 'beam', 'rerank', 'adaptive', 'embeddings'. Overwrites 'behavior'. See details.
         - k_pred (int): Maximum number of predicted occupational codes to keep
         - deduplicate (bool): If True, deduplicate (occ1, lang) pairs before prediction, but return results for all original inputs.
         - order_invariant_conf (bool): If True an order invariant confidence is computed. This takes a bit longer but - especially for cases with many observations with multiple occupations.
+        - beam_width (int): Number of hypotheses kept by prediction_type 'beam', which is also the maximum number of codes with non-zero probability. Defaults to 5.
+        - rerank_k (int): Number of candidate codes from the flat decoder scored by prediction_type 'rerank'. Defaults to 20.
+        - adaptive_min_conf (float): For prediction_type 'adaptive', observations where the top flat probability is below this are decoded by the seq2seq decoder. Defaults to 0.9.
+        - adaptive_min_margin (float): For prediction_type 'adaptive', observations where the top two flat probabilities differ by less than this are decoded by the seq2seq decoder. Defaults to 0.0 (not used).
+        - adaptive_fallback (str): For prediction_type 'adaptive', whether observations are decoded by the seq2seq decoder using a 'full' search, a 'beam' search, or 'greedy' decoding. Defaults to 'full'.
+        - dynamic_padding (bool): If True, each batch is padded to its longest string plus 6 characters (rounded up to a multiple of 4) rather than to 128 characters. This is faster, as most occupational strings are short. Defaults to False.
+        - length_bucketing (bool): If True, strings of similar length are batched together, which makes 'dynamic_padding' more effective. Results are returned in the original order. Defaults to False.
+        - greedy_early_stopping (bool): For prediction_type 'greedy', stop decoding a batch once every string has started a padding block and the remaining padding is verified in one pass through the seq2seq decoder. Predictions are those of decoding without early stopping. Defaults to True.
+        - speculative_greedy (bool): For prediction_type 'greedy' with mixer models, use the flat decoder's prediction as a draft which is verified in one pass through the seq2seq decoder and only decoded further where it is wrong. This is faster, but results are not guaranteed to be identical to those of behavior='good' (plain greedy decoding): where two digits are (nearly) tied, floating point differences between the verification pass and step-by-step decoding may change the prediction. Defaults to False.
 
         **Details.**
         *behavior*
         When 'fast' is chosen, the prediction will be based on a simple 'flat' decoder with one output neuron per possible class.
         When 'good' is chosen, the prediction will be based on a seq2seq transformer decoder.
         The 'good' option is in the order of 5-10 times slower than the 'fast' option but performance is worse.
+        When 'adaptive' is chosen (only for models with both decoders), the 'flat' decoder is used for all observations, and the seq2seq decoder only for those where the 'flat' decoder is not confident.
         See the paper for more details https://arxiv.org/abs/2402.13604
 
         *prediction_type*
@@ -514,9 +602,13 @@ class OccCANINE:
         'flat' is the simplest. This takes the pooled output and feeds it into a single layer of output neurons with one output for each HISCO code.
         'greedy' runs the seq2seq transformer decoder in a greedy fashion. I.e. picking the most likely digit at each step.
         'full' evaluates all possible digit combinations through the seq2seq decoder and returns a probability of each of all the possible HISCO codes.
+        'beam' runs a beam search through the seq2seq decoder, restricted to valid codes. It returns the probability of the 'beam_width' most likely codes found, and 0 for all other codes, at a cost close to 'greedy'.
+        'rerank' (only for models with both a flat and a seq2seq decoder) takes the 'rerank_k' most likely codes of the flat decoder and returns their probabilities through the seq2seq decoder, as 'full' would, and 0 for all other codes.
+        'adaptive' (only for models with both a flat and a seq2seq decoder) is set by behavior 'adaptive'. See self._predict_adaptive. Note that probabilities of the flat and the seq2seq decoder are on different scales, so with what="pred" a column 'decoder' states which of the two ('flat' or 'seq2seq') was used for each observation.
         Some 'prediction_type' options are not available for certain model types. This method will throw an error in those cases.
 
-        More about the 'full' prediction type in self._predict_full
+        Unless what="probs", 'full' only computes the probabilities of the 'k_pred' most likely codes, using a faster best-first search with the same result. See self._predict_full.
+        More about the 'full', 'beam', and 'rerank' prediction types in self._predict_full, self._predict_beam, and self._predict_rerank
 
         Returns:
         - Depends on the 'what' parameter. Can be logits, probabilities, predictions, a binary matrix, or a DataFrame containing the predicted classes and probabilities.
@@ -556,7 +648,7 @@ class OccCANINE:
             unique_lang = lang_list
 
         # Only override the threshold if the user did not specify one.
-        if prediction_type in ['flat', 'full']:
+        if prediction_type in ['flat', 'full', 'beam', 'rerank', 'adaptive']:
             if what == 'probs':
                 pass
             elif threshold is None:
@@ -567,26 +659,17 @@ class OccCANINE:
                 threshold = THRESHOLD_LOOKUP.get(list(unique_lang_set)[0], 0.31) 
 
         # Logits not available for seq2seq or mix models or full
-        if what == "logits" and prediction_type in ['seq2seq', 'mix', 'full']:
-            raise ValueError("Logits are not available for seq2seq or mix models or full prediction type. Use 'probs' or 'pred' instead.")
+        if what == "logits" and prediction_type in ['seq2seq', 'mix', 'full', 'beam', 'rerank', 'adaptive']:
+            raise ValueError("Logits are not available for seq2seq or mix models or full, beam, rerank, or adaptive prediction type. Use 'probs' or 'pred' instead.")
 
         # Data loader
-        dataset = OccDatasetV2FromAlreadyLoadedInputs(
-            inputs = unique_occ1,
-            lang = unique_lang,
-            fname_index=1, # Dummy argument
-            formatter = self.formatter,
-            tokenizer = self.tokenizer,
-            max_input_len=128,
-            training=False,
+        data_loader, order = self._setup_data_loader(
+            unique_occ1,
+            unique_lang,
+            dynamic_padding=dynamic_padding,
+            length_bucketing=length_bucketing,
         )
 
-        data_loader = DataLoader(
-            dataset,
-            batch_size=self.batch_size,
-            shuffle=False
-            )
-
         # Handle embeddings as output - this should also modify the prediction_type
         if what == "embeddings":
             # Set prediction type to 'flat' for embeddings
@@ -599,17 +682,47 @@ class OccCANINE:
         if prediction_type == 'flat':
             out, out_type, inputs = self._predict_flat(data_loader, what)
         elif prediction_type == 'greedy':
-            out, out_type, inputs = self._predict_greedy(data_loader, order_invariant_conf=order_invariant_conf)
+            out, out_type, inputs = self._predict_greedy(
+                data_loader,
+                order_invariant_conf=order_invariant_conf,
+                early_stopping=greedy_early_stopping,
+                speculative=speculative_greedy,
+            )
         elif prediction_type == 'full':
-            out, out_type, inputs = self._predict_full(data_loader)
+            # Only the top 'k_pred' codes are used unless all probabilities are requested
+            out, out_type, inputs = self._predict_full(data_loader, topk=None if what == 'probs' else k_pred)
+        elif prediction_type == 'beam':
+            out, out_type, inputs = self._predict_beam(data_loader, beam_width=beam_width)
+        elif prediction_type == 'rerank':
+            out, out_type, inputs = self._predict_rerank(data_loader, rerank_k=rerank_k)
+        elif prediction_type == 'adaptive':
+            out, out_type, inputs, routed = self._predict_adaptive(
+                data_loader,
+                min_conf=adaptive_min_conf,
+                min_margin=adaptive_min_margin,
+                fallback=adaptive_fallback,
+                topk=None if what == 'probs' else k_pred, # Only the top 'k_pred' codes are used unless all probabilities are requested
+                beam_width=beam_width,
+            )
         elif prediction_type == 'embeddings':
             out, out_type, inputs = self._predict_embeddings(data_loader)
         else:
             raise ValueError(f'Unsupported prediction type {prediction_type}, must be one of {PredType}')
 
+        # Undo length bucketing
+        if order is not None:
+            out, inputs = self._restore_input_order(out, inputs, order)
+
+            if prediction_type == 'adaptive':
+                routed = routed[np.argsort(order)]
+
         # Return format
         result = self._format(out, out_type, what, inputs, unique_lang[0] if unique_lang else "unk", threshold, k_pred, order_invariant_conf)
 
+        # State which decoder was used for each observation
+        if prediction_type == 'adaptive' and what == 'pred':
+            result.insert(1, 'decoder', np.where(routed, 'seq2seq', 'flat'))
+
         # If deduplicate, expand results to match original input order
         if deduplicate:
             # If result is a DataFrame, expand rows
@@ -675,6 +788,186 @@ class OccCANINE:
         # Return
         return result
 
+    def _setup_data_loader(
+            self,
+            occ1: list[str],
+            lang: list[str],
+            dynamic_padding: bool = False,
+            length_bucketing: bool = False,
+    ) -> tuple[DataLoader, np.ndarray | None]:
+        """
+        Sets up data loader for prediction. If 'length_bucketing', batches are formed from strings of
+        similar length and the order in which strings are yielded is returned, else the order is None.
+        """
+        dataset = OccDatasetV2FromAlreadyLoadedInputs(
+            inputs = occ1,
+            lang = lang,
+            fname_index=1, # Dummy argument
+            formatter = self.formatter,
+            tokenizer = self.tokenizer,
+            max_input_len=128,
+            training=False,
+        )
+
+        collate_fn = dynamic_padding_collate if dynamic_padding else None
+
+        if not length_bucketing:
+            data_loader = DataLoader(
+                dataset,
+                batch_size=self.batch_size,
+                shuffle=False,
+                collate_fn=collate_fn,
+                )
+
+            return data_loader, None
+
+        batch_sampler = LengthBucketBatchSampler(
+            lengths=dataset.input_lengths(),
+            batch_size=self.batch_size,
+            shuffle=False,
+        )
+        data_loader = DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=collate_fn,
+            )
+
+        return data_loader, batch_sampler.order()
+
+    @staticmethod
+    def _restore_input_order(out, inputs: list[str], order: np.ndarray):
+        """
+        Reorders output of the self._predict_* methods, where row i belongs to input order[i], to input order.
+        """
+        inverse = np.argsort(order)
+        inputs = [inputs[i] for i in inverse]
+
+        if isinstance(out, pd.DataFrame):
+            out = out.iloc[inverse].reset_index(drop=True)
+        else:
+            out = out[inverse]
+
+        return out, inputs
+
+    @torch.no_grad()
+    def score(
+            self,
+            occ1: str | list[str],
+            candidates: list[str] | list[list[str]],
+            lang: str | list[str] = "unk",
+    ) -> pd.DataFrame:
+        """
+        Computes the probability of specific codes for each occupational string, e.g., to validate
+        existing labels. All (string, candidate) pairs of a batch are scored in one teacher-forced
+        pass through the seq2seq decoder, i.e., without decoding step by step.
+
+        Parameters:
+        - occ1 (list or str): A list of occupational strings.
+        - candidates (list): Either one list of candidate codes per string in 'occ1', or a single list of codes which are scored for all strings.
+        - lang (str or list, optional): The language(s) of the occupational strings. Defaults to "unk" (unknown).
+
+        Returns:
+        - pd.DataFrame in long format with one row per (string, candidate) pair and columns 'row' (position of the string in 'occ1'), 'occ1', '{system}' (the candidate) and 'prob'. Probabilities are on the same scale as those of prediction_type 'full'.
+
+        Raises a ValueError if a candidate is not a code in self.key.
+        """
+        if self.model_type not in ["mix", "seq2seq"]:
+            raise TypeError(f"model_type: '{self.model_type}' does not work with scoring")
+
+        # Handle list vs str
+        if isinstance(occ1, str):
+            occ1 = [occ1]
+
+        # Same candidates for all strings
+        if all(isinstance(c, (str, int)) for c in candidates):
+            candidates = [list(candidates)] * len(occ1)
+
+        if len(candidates) != len(occ1):
+            raise ValueError("candidates must have one list of codes per string in occ1.")
+
+        # Handle lang as list or str
+        if isinstance(lang, str):
+            lang_list = [lang] * len(occ1)
+        else:
+            lang_list = list(lang)
+            if len(lang_list) != len(occ1):
+                raise ValueError("If lang is a list, it must have the same length as occ1.")
+
+        # Flatten to (string, candidate) pairs, ordered by string
+        pair_row = np.repeat(np.arange(len(occ1)), [len(c) for c in candidates])
+        pair_code = [str(code) for c in candidates for code in c]
+        pair_probs = np.zeros(len(pair_code), dtype=np.float32)
+
+        # Validate up front, rather than failing while formatting or decoding
+        known_codes = set(self.key.values())
+
+        for code in dict.fromkeys(pair_code):
+            if not self.use_within_block_sep and len(code) == (self.code_len-1):
+                code_padded = code.zfill(self.code_len)
+            else:
+                code_padded = code
+
+            if code_padded not in known_codes or not code_padded.strip():
+                raise ValueError(f"Candidate '{code}' is not a valid '{self.system}' code")
+
+        if pair_code:
+            formatted = self._get_formatted_codes(pair_code)
+
+            dataset = OccDatasetV2FromAlreadyLoadedInputs(
+                inputs = self._prep_str(occ1),
+                lang = lang_list,
+                fname_index=1, # Dummy argument
+                formatter = self.formatter,
+                tokenizer = self.tokenizer,
+                max_input_len=128,
+                training=False,
+            )
+
+            data_loader = DataLoader(
+                dataset,
+                batch_size=self.batch_size,
+                shuffle=False
+                )
+
+            model = self.model.eval()
+            total_batches = len(data_loader)
+            offset = 0
+
+            for batch_idx, batch in enumerate(data_loader, start=1):
+                input_ids = batch["input_ids"].to(self.device)
+                attention_mask = batch["attention_mask"].to(self.device)
+
+                # Pairs of the strings in this batch
+                start, end = np.searchsorted(pair_row, [offset, offset + len(input_ids)])
+
+                if end > start:
+                    memory = model.encode(input_ids, attention_mask)
+
+                    # If mixer its a tuple and then it is the first element which is relevant
+                    if isinstance(memory, tuple):
+                        memory = memory[0]
+
+                    probs = score_candidates(
+                        model = model,
+                        memory = model.precompute_memory(memory, attention_mask),
+                        row_index = torch.as_tensor(pair_row[start:end] - offset, device=self.device),
+                        candidates = torch.as_tensor(formatted[start:end], dtype=torch.long, device=self.device),
+                        start_symbol = BOS_IDX,
+                    )
+                    pair_probs[start:end] = probs.cpu().numpy()
+
+                offset += len(input_ids)
+
+                if self.verbose:
+                    print(f'\rFinished scoring for batch {batch_idx} of {total_batches}', end="", flush=True)
+
+        return pd.DataFrame({
+            'row': pair_row,
+            'occ1': [occ1[i] for i in pair_row],
+            self.system: pair_code,
+            'prob': pair_probs,
+        })
+
     def _predict_flat(self, data_loader, what = "pred"):
         """
         Makes predictions on a batch of occupational strings.
@@ -749,7 +1042,13 @@ class OccCANINE:
         return results, out_type, inputs
 
     @torch.no_grad()
-    def _predict_greedy(self, data_loader, order_invariant_conf):
+    def _predict_greedy(
+            self,
+            data_loader,
+            order_invariant_conf,
+            early_stopping: bool = True,
+            speculative: bool = False,
+    ):
         model = self.model.eval()
 
         inputs = []
@@ -768,13 +1067,14 @@ class OccCANINE:
         # calculated at bottom of batch loop
         end = time.time()
 
-        # Decoder based on model type
-        if self.model_type == "mix":
+        # Decoder based on model type. For mixer models, the flat decoder's prediction may
+        # be used as a draft, which is verified in one pass and only decoded further if wrong
+        if self.model_type == "mix" and speculative:
+            decoder = partial(speculative_mixer_greedy_decode, drafts=self._get_draft_table())
+        elif self.model_type == "mix":
             decoder = mixer_greedy_decode
-            decoder_full = full_search_decoder_mixer_optimized # Used in order invariant confidence
         elif self.model_type == "seq2seq":
             decoder = greedy_decode
-            decoder_full = full_search_decoder_seq2seq_optimized # Used in order invariant confidence
         else:
             raise TypeError(f"model_type: '{self.model_type}' does not work with the greedy prediction")
 
@@ -782,6 +1082,10 @@ class OccCANINE:
         verbose = self.verbose
         total_batches = len(data_loader)
 
+        # Stop decoding once all rows have started padding and are verified to continue
+        # with padding (not all formatters are blocky)
+        block_size = getattr(data_loader.dataset.formatter, 'block_size', None) if early_stopping else None
+
         for batch_idx, batch in enumerate(data_loader, start=1):
             input_ids = batch["input_ids"].to(self.device)
             attention_mask = batch["attention_mask"].to(self.device)
@@ -795,6 +1099,8 @@ class OccCANINE:
                 device = self.device,
                 max_len = data_loader.dataset.formatter.max_seq_len,
                 start_symbol = BOS_IDX,
+                return_memory = order_invariant_conf,
+                early_stopping_block_size = block_size,
                 )
 
             outputs_s2s = outputs[0].cpu().numpy()
@@ -802,43 +1108,12 @@ class OccCANINE:
 
             # Compute order invariant confidence
             if order_invariant_conf:
-                # Location of multiple labels
-                outputs_mapped_to_label = list(map(
-                    data_loader.dataset.formatter.clean_pred,
-                    outputs[0].cpu().numpy(),
-                ))
-
-                # Generate list of codes
-                codes_lists = [self._output_permutations(i) for i in outputs_mapped_to_label]
-
-                order_inv_probs_batch = [float(0) for i in range(len(outputs_s2s))]
-
-                for i, codes_list in enumerate(codes_lists):
-
-                    len_list = len(codes_list)
-                    if len_list > 1:
-                        # Transform to machine readable representation:
-                        codes_list_encoded = self._list_of_formatted_codes(codes_list = codes_list)
-
-                        # Prepare subset tensors for the i-th sample
-                        input_ids_i = input_ids[i].unsqueeze(0)
-                        attention_mask_i = attention_mask[i].unsqueeze(0)
-
-                        # Run the full search decoder on the current sample
-                        outputs_order_inv = decoder_full(
-                            model = model,
-                            descr = input_ids_i,
-                            input_attention_mask = attention_mask_i,
-                            device = self.device,
-                            codes_list = codes_list_encoded,
-                            start_symbol = BOS_IDX,
-                        )
-                        # Test
-                        if outputs_order_inv.shape[1] != len_list:
-                            raise ValueError(f"outputs_order_inv.shape[1] != len_list: {outputs_order_inv.shape[1]} != {len_list}")
-
-                        # Take sum of the probabilities
-                        order_inv_probs_batch[i] = float(outputs_order_inv.sum(axis=1).cpu().numpy()[0])
+                order_inv_probs_batch = self._order_invariant_conf(
+                    model=model,
+                    memory=outputs[-1],
+                    preds=outputs_s2s,
+                    formatter=data_loader.dataset.formatter,
+                )
 
             # Store input in its original string format
             inputs.extend(batch['occ1'])
@@ -886,7 +1161,7 @@ class OccCANINE:
         return preds, out_type, inputs
 
     @torch.no_grad()
-    def _predict_full(self, data_loader):
+    def _predict_full(self, data_loader, topk: int | None = None):
         """
         This is the full prediction type. This takes all the codes in self.key and runs it through a seq2seq
         decoder. As such this in the order of 330 times slower than the typical the greedy decoder. But with
@@ -895,6 +1170,13 @@ class OccCANINE:
         This rather larger increase in eval time is because the method requires, that we run all of the 1910
         HISCO codes through something akin to the greedy decoder. We achieve some speedup by only running the
         decoder on 5 digits.
+
+        If 'topk' is specified, only the probabilities of the 'topk' most likely codes are computed (all other
+        codes get 0). These are identical to those of the exhaustive search, but found by a best-first search
+        which prunes all digit combinations which cannot make it into the top 'topk', and is thus much faster.
+        Note that self.predict sets 'topk' to 'k_pred' unless what="probs", i.e., prediction_type 'full' then
+        uses the best-first search. Only the top 'k_pred' codes are formatted in that case, so the output is
+        the same as with the exhaustive search.
         """
         model = self.model.eval()
 
@@ -915,6 +1197,12 @@ class OccCANINE:
         else:
             raise TypeError(f"model_type: '{self.model_type}' does not work with the greedy prediciton")
 
+        decoder_kwargs = {'codes_list': self.codes_list}
+
+        if topk is not None:
+            decoder = best_first_search_decoder
+            decoder_kwargs = {'topk': topk}
+
         # Setup
         verbose = self.verbose
         total_batches = len(data_loader)
@@ -931,8 +1219,9 @@ class OccCANINE:
                 descr = input_ids,
                 input_attention_mask = attention_mask,
                 device = self.device,
-                codes_list = self.codes_list,
                 start_symbol = BOS_IDX,
+                trie = self.trie,
+                **decoder_kwargs,
                 )
 
 
@@ -957,6 +1246,234 @@ class OccCANINE:
 
         return results, out_type, inputs
     
+    @torch.no_grad()
+    def _predict_beam(self, data_loader, beam_width: int = 5):
+        """
+        Beam search prediction type. Runs the seq2seq decoder keeping the
+        'beam_width' most likely hypotheses, where each hypothesis is only
+        extended by digits which lead to a code in self.key (using self.trie).
+        Thus, all hypotheses are valid codes, and their sequence probabilities
+        are on the same scale as those of _predict_full. The cost is in the
+        order of 'beam_width' times that of a greedy decoder.
+
+        Output is formatted as for _predict_full, with 0 for all codes not
+        found by the search.
+        """
+        model = self.model.eval()
+
+        inputs = []
+
+        batch_time = Averager()
+        batch_time_data = Averager()
+
+        # Need to initialize first "end time", as this is
+        # calculated at bottom of batch loop
+        end = time.time()
+
+        if self.model_type not in ["mix", "seq2seq"]:
+            raise TypeError(f"model_type: '{self.model_type}' does not work with the beam prediction")
+
+        # Setup
+        verbose = self.verbose
+        total_batches = len(data_loader)
+        results = []
+
+        for batch_idx, batch in enumerate(data_loader, start=1):
+            input_ids = batch["input_ids"].to(self.device)
+            attention_mask = batch["attention_mask"].to(self.device)
+
+            batch_time_data.update(time.time() - end)
+
+            output = beam_search_decoder(
+                model = model,
+                descr = input_ids,
+                input_attention_mask = attention_mask,
+                device = self.device,
+                trie = self.trie,
+                start_symbol = BOS_IDX,
+                beam_width = beam_width,
+                )
+
+            # Store input in its original string format
+            inputs.extend(batch['occ1'])
+
+            # Store predictions
+            results.append(output.cpu().numpy())
+
+            batch_time.update(time.time() - end)
+
+            if batch_idx % 1 == 0 and verbose:
+                print(f'\rFinished prediction for batch {batch_idx} of {total_batches}', end="", flush=True)
+
+            end = time.time()
+
+        results = np.concatenate(results)
+
+        out_type = 'probs'
+
+        return results, out_type, inputs
+
+    @torch.no_grad()
+    def _predict_rerank(self, data_loader, rerank_k: int = 20):
+        """
+        Rerank prediction type, for mixer models. Takes the 'rerank_k' most
+        likely codes of the flat decoder and scores only these through the
+        seq2seq decoder, reusing the encoder pass of the flat decoder. As most
+        of the probability mass of _predict_full is typically concentrated in
+        a few codes ranked highly by the flat decoder, this is close to
+        _predict_full at a fraction of the cost.
+
+        Output is formatted as for _predict_full, with 0 for all codes not
+        among the candidates.
+        """
+        model = self.model.eval()
+
+        inputs = []
+
+        batch_time = Averager()
+        batch_time_data = Averager()
+
+        # Need to initialize first "end time", as this is
+        # calculated at bottom of batch loop
+        end = time.time()
+
+        if self.model_type != "mix":
+            raise TypeError(f"model_type: '{self.model_type}' does not work with the rerank prediction")
+
+        # Setup
+        verbose = self.verbose
+        total_batches = len(data_loader)
+        results = []
+
+        for batch_idx, batch in enumerate(data_loader, start=1):
+            input_ids = batch["input_ids"].to(self.device)
+            attention_mask = batch["attention_mask"].to(self.device)
+
+            batch_time_data.update(time.time() - end)
+
+            output = flat_topk_rerank_decoder_mixer(
+                model = model,
+                descr = input_ids,
+                input_attention_mask = attention_mask,
+                device = self.device,
+                trie = self.trie,
+                start_symbol = BOS_IDX,
+                topk = rerank_k,
+                )
+
+            # Store input in its original string format
+            inputs.extend(batch['occ1'])
+
+            # Store predictions
+            results.append(output.cpu().numpy())
+
+            batch_time.update(time.time() - end)
+
+            if batch_idx % 1 == 0 and verbose:
+                print(f'\rFinished prediction for batch {batch_idx} of {total_batches}', end="", flush=True)
+
+            end = time.time()
+
+        results = np.concatenate(results)
+
+        out_type = 'probs'
+
+        return results, out_type, inputs
+
+    @torch.no_grad()
+    def _predict_adaptive(
+            self,
+            data_loader,
+            min_conf: float = 0.9,
+            min_margin: float = 0.0,
+            fallback: AdaptiveFallbackType = 'full',
+            topk: int | None = None,
+            beam_width: int = 5,
+            ):
+        """
+        Adaptive prediction type, for mixer models. The flat decoder is used for all observations,
+        and the seq2seq decoder only for observations where the flat decoder is not confident, i.e.,
+        where its top probability is below 'min_conf' or its top two probabilities are less than
+        'min_margin' apart. Both share one encoder pass. As most occupational descriptions are easy,
+        this approaches the speed of 'flat' with most of the performance of the seq2seq decoder.
+
+        Observations decoded by the seq2seq decoder get probabilities from a full search (see
+        _predict_full, exact top 'topk' codes if 'topk' is specified), a beam search (see
+        _predict_beam), or greedy decoding, depending on 'fallback'. With greedy decoding, the
+        codes of the greedy output get the probability of the greedy sequence. Output is formatted
+        as for _predict_full.
+
+        Flat probabilities (sigmoid, independent per code) and seq2seq probabilities (of whole
+        sequences) are on different scales, so the same threshold does not mean the same for both.
+        Hence a boolean array stating which observations were decoded by the seq2seq decoder is
+        returned as a fourth element.
+        """
+        model = self.model.eval()
+
+        inputs = []
+
+        batch_time = Averager()
+        batch_time_data = Averager()
+
+        # Need to initialize first "end time", as this is
+        # calculated at bottom of batch loop
+        end = time.time()
+
+        if self.model_type != "mix":
+            raise TypeError(f"model_type: '{self.model_type}' does not work with the adaptive prediction")
+
+        # Setup
+        verbose = self.verbose
+        total_batches = len(data_loader)
+        results = []
+        routed_all = []
+
+        for batch_idx, batch in enumerate(data_loader, start=1):
+            input_ids = batch["input_ids"].to(self.device)
+            attention_mask = batch["attention_mask"].to(self.device)
+
+            batch_time_data.update(time.time() - end)
+
+            output, routed = adaptive_decoder_mixer(
+                model = model,
+                descr = input_ids,
+                input_attention_mask = attention_mask,
+                device = self.device,
+                trie = self.trie,
+                start_symbol = BOS_IDX,
+                min_conf = min_conf,
+                min_margin = min_margin,
+                fallback = fallback,
+                topk = topk,
+                beam_width = beam_width,
+                max_len = data_loader.dataset.formatter.max_seq_len,
+                )
+
+            # Store input in its original string format
+            inputs.extend(batch['occ1'])
+
+            # Store predictions
+            results.append(output.cpu().numpy())
+            routed_all.append(routed.cpu().numpy())
+
+            batch_time.update(time.time() - end)
+
+            if batch_idx % 1 == 0 and verbose:
+                print(f'\rFinished prediction for batch {batch_idx} of {total_batches}', end="", flush=True)
+
+            end = time.time()
+
+        results = np.concatenate(results)
+        routed_all = np.concatenate(routed_all)
+
+        if verbose:
+            num_routed = int(routed_all.sum())
+            print(f"\nAdaptive prediction: {len(results) - num_routed} observations decoded by the flat decoder, {num_routed} by the seq2seq decoder")
+
+        out_type = 'probs'
+
+        return results, out_type, inputs, routed_all
+
     @torch.no_grad()
     def _predict_embeddings(self, data_loader):
         """
@@ -1008,6 +1525,41 @@ class OccCANINE:
 
         return results, out_type, inputs
 
+    def _order_invariant_conf(self, model, memory, preds, formatter) -> np.ndarray:
+        """
+        Computes the order invariant confidence of a batch of greedy
+        predictions, i.e., the sum of the probabilities of all permutations
+        of the predicted codes. Permutations of all rows with multiple codes
+        are scored together in one teacher-forced pass, reusing the encoder
+        memory of the greedy pass. Rows with a single code get 0.
+        """
+        row_index = []
+        candidates = []
+
+        for i, pred in enumerate(map(formatter.clean_pred, preds)):
+            codes_list = self._output_permutations(pred)
+
+            if len(codes_list) > 1:
+                row_index.extend([i] * len(codes_list))
+                candidates.append(self._get_formatted_codes(codes_list))
+
+        order_inv_probs = torch.zeros(len(preds), dtype=torch.float, device=self.device)
+
+        if candidates:
+            row_index = torch.tensor(row_index, dtype=torch.long, device=self.device)
+            probs = score_candidates(
+                model=model,
+                memory=memory,
+                row_index=row_index,
+                candidates=torch.as_tensor(np.concatenate(candidates), dtype=torch.long, device=self.device),
+                start_symbol=BOS_IDX,
+            )
+
+            # Take sum of the probabilities
+            order_inv_probs.index_add_(0, row_index, probs)
+
+        return order_inv_probs.cpu().numpy()
+
     def _output_permutations(self, output):
         """
         This function takes an output from the model with multiple labels
@@ -1041,7 +1593,7 @@ class OccCANINE:
         """
 
         # Validate 'behavior'
-        test = behavior in ['good', 'fast']
+        test = behavior in ['good', 'fast', 'adaptive']
         if not test:
             raise NotImplementedError(f"behavior: '{behavior}' is not implemented")
 
@@ -1060,12 +1612,14 @@ class OccCANINE:
                 prediction_type = "flat"
             if behavior == "good":
                 prediction_type = "greedy"
+            if behavior == "adaptive":
+                prediction_type = "adaptive"
 
             if self.verbose:
                 print(f"Based on behavior = '{behavior}', prediction_type was automatically set to '{prediction_type}'")
 
         # Validate 'prediction_type'
-        test = prediction_type in ['flat', 'greedy', 'full']
+        test = prediction_type in ['flat', 'greedy', 'full', 'beam', 'rerank', 'adaptive']
         if not test:
             raise NotImplementedError(f"prediction_type: '{prediction_type}' is not implemented")
 
@@ -1085,13 +1639,13 @@ class OccCANINE:
         are compatible
 
         Parameters:
-        - prediction_type (str): Prediction type: 'flat', 'greedy', 'full'
+        - prediction_type (str): Prediction type: 'flat', 'greedy', 'full', 'beam', 'rerank', 'adaptive'
 
         """
         if self.model_type == "mix":
             res = True # Then all prediction types are possible
         elif self.model_type == "seq2seq":
-            if prediction_type in ['greedy', 'full']: # Valid types for seq2seq
+            if prediction_type in ['greedy', 'full', 'beam']: # Valid types for seq2seq
                 res = True
             else:
                 res = False
@@ -1117,10 +1671,10 @@ class OccCANINE:
         are compatible
 
         Parameters:
-        - behavior (str): Behavior type: 'good' or 'fast'
+        - behavior (str): Behavior type: 'good', 'fast', or 'adaptive'
 
         """
-        if not behavior in ['good', 'fast']:
+        if not behavior in ['good', 'fast', 'adaptive']:
             raise NotImplementedError(
                 """
                 This should not be possible. You did something weird to end up here.
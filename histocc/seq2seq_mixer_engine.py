@@ -11,6 +11,7 @@ from sklearn.metrics import accuracy_score
 from .formatter import PAD_IDX
 from .utils import (
     create_mask,
+    multi_hot,
     Averager,
     order_invariant_accuracy,
     update_summary,
@@ -51,6 +52,25 @@ def _save_model_checkpoint(
     torch.save(states, os.path.join(save_dir, 'last.bin'))
 
 
+def _get_targets_linear(
+        batch: dict[str, torch.Tensor],
+        num_classes: int,
+        device: torch.device,
+        ) -> torch.Tensor:
+    """Dense multi-hot flat targets on `device`.
+
+    Batches carry flat targets as padded code indices, which are expanded
+    here rather than transferring mostly-zero dense vectors. Batches with
+    dense `targets_linear` are still supported.
+    """
+    if 'targets_linear' in batch:
+        return batch['targets_linear'].to(device, non_blocking=True)
+
+    indices = batch['targets_linear_indices'].to(device, non_blocking=True)
+
+    return multi_hot(indices, num_classes)
+
+
 def train_one_epoch(
         model: Seq2SeqMixerOccCANINE,
         data_loader: torch.utils.data.DataLoader,
@@ -95,7 +115,6 @@ def train_one_epoch(
         input_ids = batch["input_ids"].to(device, non_blocking=True)
         attention_mask = batch["attention_mask"].to(device, non_blocking=True)
         targets_seq2seq = batch['targets_seq2seq'].to(device, non_blocking=True)
-        targets_linear = batch['targets_linear'].to(device, non_blocking=True)
 
         batch_time_data.update(time.time() - end)
 
@@ -113,6 +132,7 @@ def train_one_epoch(
                     target_mask=target_mask,
                     target_padding_mask=target_padding_mask,
                 )
+                targets_linear = _get_targets_linear(batch, out_linear.size(1), device)
 
                 loss = loss_fn(
                     out_seq2seq=out_seq2seq,
@@ -128,6 +148,7 @@ def train_one_epoch(
                 target_mask=target_mask,
                 target_padding_mask=target_padding_mask,
             )
+            targets_linear = _get_targets_linear(batch, out_linear.size(1), device)
 
             loss = loss_fn(
                 out_seq2seq=out_seq2seq,
@@ -256,7 +277,6 @@ def evaluate(
         input_ids = batch["input_ids"].to(device, non_blocking=True)
         attention_mask = batch["attention_mask"].to(device, non_blocking=True)
         targets_seq2seq = batch['targets_seq2seq'].to(device, non_blocking=True)
-        targets_linear = batch['targets_linear'].to(device, non_blocking=True)
 
         # Prepare target as input for seq2seq model
         target_seq2seq_input = targets_seq2seq[:, :-1]
@@ -270,6 +290,7 @@ def evaluate(
             target_mask=target_mask,
             target_padding_mask=target_padding_mask,
         )
+        targets_linear = _get_targets_linear(batch, out_linear.size(1), device)
 
         loss = loss_fn(
             out_seq2seq=out_seq2seq,
@@ -341,8 +362,8 @@ def train(
             print(f'Starting Epoch {epoch} (Step {current_step}/{total_steps} - {100*current_step/total_steps:.1f}% complete)')
             print('='*80)
         
-        # Set epoch for distributed sampler
-        if distributed and train_sampler is not None:
+        # Set epoch for distributed or length-bucketing sampler
+        if train_sampler is not None:
             train_sampler.set_epoch(epoch)
 
         current_step = train_one_epoch(
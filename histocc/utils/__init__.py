@@ -1,4 +1,5 @@
 from .masking import create_mask
+from .targets import multi_hot
 from .metrics import (
     Averager,
     seq2seq_sequence_accuracy,
@@ -6,6 +7,7 @@ from .metrics import (
 )
 from .log_util import wandb_init, update_summary
 from .decoder import greedy_decode
+from .tokenization import canine_encode
 from .io import (
     load_states,
     prepare_finetuning_data,
@@ -1,44 +1,191 @@
+from typing import Literal
+
 import torch
 
 from torch import nn, Tensor
 
 from .masking import generate_square_subsequent_mask
+from ..layers import DecoderCache, DecoderMemory
 from ..model_assets import Seq2SeqOccCANINE, Seq2SeqMixerOccCANINE, CANINEOccupationClassifier
+from ..formatter import PAD_IDX, EOS_IDX
 from ..formatter.hisco import BlockyHISCOFormatter
-from .trie import TrieNode, build_trie # For full search
+from .trie import CompiledTrie # For full search
 
 
-def greedy_decode(
+def _greedy_search(
         model: Seq2SeqOccCANINE,
-        descr: Tensor,
-        input_attention_mask: Tensor,
+        memory: Tensor,
+        batch_size: int,
         device: torch.device,
         max_len: int,
         start_symbol: int,
-        ) -> tuple[Tensor, Tensor]:
-    memory = model.encode(descr, input_attention_mask)
-    batch_size = descr.size(0)
-
+        use_cache: bool = True,
+        block_size: int | None = None,
+        input_attention_mask: Tensor | None = None,
+        ) -> tuple[Tensor, Tensor, Tensor | DecoderMemory]:
     # Initialize sequence by placing BoS symbol.
     seq = torch.ones(batch_size, 1).fill_(start_symbol).type(torch.long).to(device)
     prob_seq = torch.ones(batch_size, 1).fill_(1.0).type(torch.long).to(device)
 
+    # With `block_size`, a row is finished once it starts a padding block, as
+    # only padding should follow. Once all rows are finished, the remaining
+    # padding is verified in one call, and the loop exits if greedy decoding
+    # would indeed have continued with padding for all rows. Note that EOS
+    # does not signal a finished row, as some formatters pad within blocks
+    # using EOS
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    verify = block_size is not None
+
+    # With a cache, each step only feeds the newest token through the decoder,
+    # and cross-attention keys and values of the input are projected only once
+    if use_cache:
+        cache = model.init_decoder_cache()
+        memory = model.precompute_memory(memory, input_attention_mask)
+
+    next_input = seq
+
     for _ in range(max_len - 1):
-        target_mask = generate_square_subsequent_mask(seq.shape[1], device).type(torch.bool) # TODO do we need cast?
+        if use_cache:
+            out = model.decode_incremental(
+                memory=memory,
+                target=next_input,
+                cache=cache,
+                )[:, -1:, :]
+        else:
+            target_mask = generate_square_subsequent_mask(seq.shape[1], device).type(torch.bool) # TODO do we need cast?
 
-        out = model.decode(
-            memory=memory,
-            target=seq,
-            target_mask=target_mask,
-            target_padding_mask=None,
-            )[:, -1:, :] # Only use the prediction for the next token in seq
+            out = model.decode(
+                memory=memory,
+                target=seq,
+                target_mask=target_mask,
+                target_padding_mask=None,
+                attention_mask=input_attention_mask,
+                )[:, -1:, :] # Only use the prediction for the next token in seq
 
         next_token = torch.argmax(out, dim=2).detach()
         next_prob = torch.max(nn.functional.softmax(out, dim=2), dim=2)[0].detach()
 
+        if block_size is not None and (seq.size(1) - 1) % block_size == 0: # First token of a block
+            finished |= next_token[:, 0] == PAD_IDX
+
         # Extend sequence by adding prediction of next token.
         seq = torch.cat([seq, next_token], dim=1)
         prob_seq = torch.cat([prob_seq, next_prob], dim=1)
+        next_input = next_token
+
+        if verify and finished.all() and seq.size(1) < max_len:
+            tail, tail_prob, accepted = _verify_padding_tail(
+                model=model,
+                memory=memory,
+                seq=seq,
+                max_len=max_len,
+                cache=cache if use_cache else None,
+                input_attention_mask=input_attention_mask,
+            )
+
+            if accepted.all():
+                seq = torch.cat([seq, tail], dim=1)
+                prob_seq = torch.cat([prob_seq, tail_prob], dim=1)
+                break
+
+            # Some row does not continue with padding, so decode as usual
+            verify = False
+
+    return seq, prob_seq, memory
+
+
+def _verify_padding_tail(
+        model: Seq2SeqOccCANINE,
+        memory: Tensor | DecoderMemory,
+        seq: Tensor,
+        max_len: int,
+        cache: DecoderCache | None = None,
+        input_attention_mask: Tensor | None = None,
+        ) -> tuple[Tensor, Tensor, Tensor]:
+    '''
+    Scores padding (and EOS at the end) as the continuation of `seq`, of
+    shape (B, L), up to `max_len` in one teacher-forced call rather than step
+    by step. If `cache` is given, it holds `seq[:, :-1]` and is not modified,
+    and `memory` must be precomputed. Otherwise `seq` is decoded in full.
+
+    Returns the argmax tokens and their probabilities at positions L to
+    `max_len` - 1 and whether the tokens are the padding for each row. Where
+    they are, they are the continuation greedy decoding would produce, as
+    each of them is the argmax given the ones before it.
+
+    '''
+    batch_size, seq_len = seq.shape
+
+    fill = torch.full((batch_size, max_len - seq_len), PAD_IDX, dtype=torch.long, device=seq.device)
+    fill[:, -1] = EOS_IDX
+
+    if cache is not None:
+        out = model.decode_incremental(
+            memory=memory,
+            target=torch.cat([seq[:, -1:], fill[:, :-1]], dim=1),
+            cache=cache.copy(),
+            )
+    else:
+        target = torch.cat([seq, fill[:, :-1]], dim=1)
+        target_mask = generate_square_subsequent_mask(target.size(1), seq.device).type(torch.bool)
+
+        out = model.decode(
+            memory=memory,
+            target=target,
+            target_mask=target_mask,
+            target_padding_mask=None,
+            attention_mask=input_attention_mask,
+            )[:, seq_len - 1:]
+
+    prob, token = nn.functional.softmax(out, dim=2).max(dim=2)
+    accepted = (token == fill).all(dim=1)
+
+    return token, prob, accepted
+
+
+def greedy_decode(
+        model: Seq2SeqOccCANINE,
+        descr: Tensor,
+        input_attention_mask: Tensor,
+        device: torch.device,
+        max_len: int,
+        start_symbol: int,
+        use_cache: bool = True,
+        return_memory: bool = False,
+        early_stopping_block_size: int | None = None,
+        ) -> tuple[Tensor, Tensor]:
+    '''
+    Greedy decoding. If `return_memory`, the (projected) encoder memory is
+    returned as a third element, such that further scoring of the same inputs
+    (see `score_candidates`) need not encode them again.
+
+    If `early_stopping_block_size` is specified, decoding stops once every
+    row has started a padding block (blocks being of that size) and greedy
+    decoding is verified to continue with padding and EOS for every row. The
+    output is that of decoding without early stopping, but with fewer calls
+    to the decoder.
+
+    '''
+    memory = model.encode(descr, input_attention_mask)
+    batch_size = descr.size(0)
+
+    seq, prob_seq, memory = _greedy_search(
+        model=model,
+        memory=memory,
+        batch_size=batch_size,
+        device=device,
+        max_len=max_len,
+        start_symbol=start_symbol,
+        use_cache=use_cache,
+        block_size=early_stopping_block_size,
+        input_attention_mask=input_attention_mask,
+    )
+
+    if return_memory:
+        if not isinstance(memory, DecoderMemory):
+            memory = model.precompute_memory(memory, input_attention_mask)
+
+        return seq, prob_seq, memory
 
     return seq, prob_seq
 
@@ -51,7 +198,17 @@ def mixer_greedy_decode(
         max_len: int,
         start_symbol: int,
         linear_topk: int = 5,
+        use_cache: bool = True,
+        return_memory: bool = False,
+        early_stopping_block_size: int | None = None,
         ) -> tuple[Tensor, Tensor, Tensor, Tensor]:
+    '''
+    Greedy decoding of the seq2seq head, along with the `linear_topk` most
+    likely classes of the flat head. If `return_memory`, the (projected)
+    encoder memory is returned as a fifth element. See `greedy_decode` for
+    `early_stopping_block_size`.
+
+    '''
     memory, pooled_memory = model.encode(descr, input_attention_mask)
     batch_size = descr.size(0)
 
@@ -62,26 +219,140 @@ def mixer_greedy_decode(
     prob_linear_topk, linear_topk = prob_linear_topk.detach(), linear_topk.detach()
 
     # seq2seq output
-    # Initialize sequence by placing BoS symbol.
-    seq = torch.ones(batch_size, 1).fill_(start_symbol).type(torch.long).to(device)
-    prob_seq = torch.ones(batch_size, 1).fill_(1.0).type(torch.long).to(device)
+    seq, prob_seq, memory = _greedy_search(
+        model=model,
+        memory=memory,
+        batch_size=batch_size,
+        device=device,
+        max_len=max_len,
+        start_symbol=start_symbol,
+        use_cache=use_cache,
+        block_size=early_stopping_block_size,
+        input_attention_mask=input_attention_mask,
+    )
+
+    if return_memory:
+        if not isinstance(memory, DecoderMemory):
+            memory = model.precompute_memory(memory, input_attention_mask)
+
+        return seq, prob_seq, linear_topk, prob_linear_topk, memory
 
-    for _ in range(max_len - 1):
-        target_mask = generate_square_subsequent_mask(seq.shape[1], device).type(torch.bool) # TODO do we need cast?
+    return seq, prob_seq, linear_topk, prob_linear_topk
 
-        out = model.decode(
-            memory=memory,
-            target=seq,
-            target_mask=target_mask,
-            target_padding_mask=None,
-            )[:, -1:, :] # Only use the prediction for the next token in seq
 
-        next_token = torch.argmax(out, dim=2).detach()
-        next_prob = torch.max(nn.functional.softmax(out, dim=2), dim=2)[0].detach()
+def speculative_mixer_greedy_decode(
+        model: Seq2SeqMixerOccCANINE,
+        descr: Tensor,
+        input_attention_mask: Tensor,
+        device: torch.device,
+        max_len: int,
+        start_symbol: int,
+        drafts: Tensor,
+        linear_topk: int = 5,
+        return_memory: bool = False,
+        early_stopping_block_size: int | None = None,
+        ) -> tuple[Tensor, Tensor, Tensor, Tensor]:
+    '''
+    Drop-in replacement for `mixer_greedy_decode` which uses the top-1 class
+    of the flat head as a draft of the seq2seq output. `drafts[i]` is the
+    formatted target sequence (BoS to EOS, length `max_len`) of flat class
+    `i`. All positions of the drafts are verified in one teacher-forced call:
+    up to and including the first position where the argmax differs from the
+    draft, the greedy output is known. Only rows where that position is not
+    the last are decoded further, incrementally from that position.
+
+    Outputs are not guaranteed to be identical to those of
+    `mixer_greedy_decode`: drafts are verified by logits of a teacher-forced
+    pass over all positions, whereas greedy decoding computes them one
+    position at a time. These differ by floating point error, so where the
+    two most likely tokens are (nearly) tied, the argmax, and hence the rest
+    of the output, may differ. Probabilities differ by floating point error
+    elsewhere. See `greedy_decode` for `early_stopping_block_size`.
+
+    '''
+    memory, pooled_memory = model.encode(descr, input_attention_mask)
+    batch_size = descr.size(0)
 
-        # Extend sequence by adding prediction of next token.
-        seq = torch.cat([seq, next_token], dim=1)
-        prob_seq = torch.cat([prob_seq, next_prob], dim=1)
+    # Linear output
+    out_linear = model.linear_decoder(pooled_memory)
+    out_linear = model.linear_decoder_drop(out_linear)
+    prob_linear_topk, linear_topk = torch.sigmoid(out_linear).topk(linear_topk, axis=1)
+    prob_linear_topk, linear_topk = prob_linear_topk.detach(), linear_topk.detach()
+
+    memory = model.precompute_memory(memory, input_attention_mask)
+
+    # Verify drafts, (B, max_len)
+    draft = drafts[linear_topk[:, 0]].to(device)
+    out = model.decode_incremental(memory=memory, target=draft[:, :-1])
+    prob_max, argmax = nn.functional.softmax(out, dim=2).max(dim=2)
+
+    seq = torch.cat([draft[:, :1], argmax], dim=1)
+    prob_seq = torch.cat([torch.ones_like(prob_max[:, :1]), prob_max], dim=1)
+
+    # Number of leading positions (after BoS) known to match greedy decoding:
+    # matching draft positions and the first mismatching position
+    num_matching = (argmax == draft[:, 1:]).int().cumprod(dim=1).sum(dim=1)
+    known_len = (num_matching + 2).clamp(max=max_len)
+
+    rows = (known_len < max_len).nonzero().squeeze(1)
+
+    if len(rows) > 0:
+        # Incremental decoding from first unknown position, forcing known
+        # tokens of rows with longer known prefixes
+        sub_seq, sub_prob, sub_known_len = seq[rows], prob_seq[rows], known_len[rows]
+        sub_memory = memory.index_select(rows)
+        cache = model.init_decoder_cache()
+
+        start = int(sub_known_len.min())
+        next_input = sub_seq[:, :start]
+        finished = torch.zeros(len(rows), dtype=torch.bool, device=device)
+        verify = early_stopping_block_size is not None
+
+        if verify: # Padding blocks started before the first unknown position
+            block_starts = torch.arange(1, start, early_stopping_block_size, device=device)
+            finished = (sub_seq[:, block_starts] == PAD_IDX).any(dim=1)
+
+        for position in range(start, max_len):
+            out = model.decode_incremental(
+                memory=sub_memory,
+                target=next_input,
+                cache=cache,
+                )[:, -1, :]
+            next_prob, next_token = nn.functional.softmax(out, dim=1).max(dim=1)
+
+            is_known = position < sub_known_len
+            next_token = torch.where(is_known, sub_seq[:, position], next_token)
+            next_prob = torch.where(is_known, sub_prob[:, position], next_prob)
+
+            sub_seq[:, position] = next_token
+            sub_prob[:, position] = next_prob
+            next_input = next_token.unsqueeze(1)
+
+            if early_stopping_block_size is not None and (position - 1) % early_stopping_block_size == 0: # First token of a block
+                finished |= next_token == PAD_IDX
+
+            # As in `_greedy_search`, stop once all rows are verified to
+            # continue with padding, which is known once past forced tokens
+            if verify and finished.all() and position + 1 < max_len and bool((sub_known_len <= position + 1).all()):
+                tail, tail_prob, accepted = _verify_padding_tail(
+                    model=model,
+                    memory=sub_memory,
+                    seq=sub_seq[:, :position + 1],
+                    max_len=max_len,
+                    cache=cache,
+                )
+
+                if accepted.all():
+                    sub_seq[:, position + 1:] = tail
+                    sub_prob[:, position + 1:] = tail_prob
+                    break
+
+                verify = False
+
+        seq[rows], prob_seq[rows] = sub_seq, sub_prob
+
+    if return_memory:
+        return seq, prob_seq, linear_topk, prob_linear_topk, memory
 
     return seq, prob_seq, linear_topk, prob_linear_topk
 
@@ -141,6 +412,7 @@ def greedy_decode_for_training(
             target=seq,
             target_mask=target_mask,
             target_padding_mask=None,
+            attention_mask=input_attention_mask,
             )[:, -1:, :] # Only use the prediction for the next token in seq
 
         next_token = torch.argmax(out, dim=2).detach()
@@ -154,6 +426,142 @@ def greedy_decode_for_training(
     return output_seq
 
 
+def score_candidates(
+        model: Seq2SeqOccCANINE,
+        memory: Tensor | DecoderMemory,
+        row_index: Tensor,
+        candidates: Tensor,
+        start_symbol: int,
+        max_rows_per_call: int = 4096,
+        ) -> Tensor:
+    """
+    Teacher-forced probability of each candidate sequence given the encoded
+    input of the observation it belongs to. Candidate j, `candidates[j]`
+    (without BoS), is scored against observation `row_index[j]` of `memory`,
+    such that any number of candidates per observation are scored together
+    in flattened calls of at most `max_rows_per_call` rows.
+
+    Candidates are laid out in slots, slot i holding the i-th candidate of
+    each observation, such that the encoder memory of an observation is
+    shared by its candidates rather than copied for each of them.
+
+    Returns a tensor of shape (len(candidates),).
+    """
+    if not isinstance(memory, DecoderMemory):
+        memory = model.precompute_memory(memory)
+
+    if len(candidates) == 0:
+        return torch.empty(0, dtype=torch.float, device=candidates.device)
+
+    device = candidates.device
+
+    # Only keep observations with candidates
+    rows, row_pos = torch.unique(row_index, return_inverse=True)
+
+    if len(rows) < memory.batch_size:
+        memory = memory.index_select(rows)
+
+    # Slot of each candidate, i.e., its rank among candidates of its observation
+    counts = torch.bincount(row_pos, minlength=len(rows))
+    order = torch.argsort(row_pos, stable=True)
+    slot = torch.empty_like(row_pos)
+    slot[order] = torch.arange(len(row_pos), device=device) - (counts.cumsum(0) - counts)[row_pos[order]]
+
+    num_slots = int(counts.max())
+    slotted = torch.full(
+        (num_slots, len(rows), candidates.size(1)), PAD_IDX, dtype=torch.long, device=device,
+    )
+    slotted[slot, row_pos] = candidates.long()
+
+    probs = torch.empty((num_slots, len(rows)), dtype=torch.float, device=device)
+    slots_per_call = max(1, max_rows_per_call // len(rows))
+
+    for chunk_start in range(0, num_slots, slots_per_call):
+        chunk = slotted[chunk_start:chunk_start + slots_per_call]
+        target = torch.cat([
+            torch.full((chunk.size(0) * chunk.size(1), 1), start_symbol, dtype=torch.long, device=device),
+            chunk.reshape(-1, chunk.size(2)),
+        ], dim=1)
+
+        out = model.decode_incremental(
+            memory=memory.expand(chunk.size(0)),
+            target=target[:, :-1],
+        )
+        token_probs = torch.gather(
+            nn.functional.softmax(out, dim=2), 2, target[:, 1:].unsqueeze(2),
+        ).squeeze(2)
+        probs[chunk_start:chunk_start + chunk.size(0)] = token_probs.prod(dim=1).view(chunk.size(0), -1)
+
+    return probs[slot, row_pos]
+
+
+def _full_search_level_synchronous(
+        model: Seq2SeqOccCANINE,
+        memory: Tensor | DecoderMemory,
+        batch_size: int,
+        device: torch.device,
+        trie: CompiledTrie,
+        start_symbol: int,
+        max_rows_per_call: int = 4096,
+        ) -> Tensor:
+    """
+    Breadth-first walk of the code trie. All nodes at a given depth are
+    expanded together, by decoding their prefixes for every observation in
+    one (nodes x batch) flattened call -- split into chunks of at most
+    `max_rows_per_call` rows to bound memory. This needs one decoder call per
+    trie depth (per chunk) rather than one per trie node.
+
+    Cross-attention keys and values of `memory` are projected once and shared
+    by all nodes, rather than replicating `memory` for each node.
+    """
+    if not isinstance(memory, DecoderMemory):
+        memory = model.precompute_memory(memory)
+
+    # Probability of the prefix of each trie node for each observation
+    node_probs = torch.empty((len(trie), batch_size), dtype=torch.float, device=device)
+    node_probs[0] = 1.0
+
+    nodes_per_call = max(1, max_rows_per_call // batch_size)
+
+    for depth in range(trie.max_depth):
+        children_start, children_end = trie.level(depth + 1)
+        parents = trie.parent[children_start:children_end]
+        child_tokens = trie.token[children_start:children_end]
+
+        # Children are sorted by parent, so the nodes to expand are the
+        # unique consecutive parents
+        expand_nodes, num_children = torch.unique_consecutive(parents, return_counts=True)
+        parent_pos = torch.repeat_interleave(
+            torch.arange(len(expand_nodes), device=device), num_children,
+            )
+
+        prefixes = torch.cat([
+            torch.full((len(expand_nodes), 1), start_symbol, dtype=torch.long, device=device),
+            trie.prefix[expand_nodes, :depth],
+        ], dim=1)
+
+        # Next-token distribution of every expanded prefix, (N, B, vocab_size)
+        next_probs = []
+
+        for chunk_start in range(0, len(expand_nodes), nodes_per_call):
+            chunk = prefixes[chunk_start:chunk_start + nodes_per_call]
+
+            # Row i * B + b holds prefix of node i for observation b
+            out = model.decode_incremental(
+                memory=memory.expand(len(chunk)),
+                target=chunk.repeat_interleave(batch_size, dim=0),
+            )[:, -1, :]
+            next_probs.append(nn.functional.softmax(out, dim=1).view(len(chunk), batch_size, -1))
+
+        next_probs = torch.cat(next_probs, dim=0)
+
+        node_probs[children_start:children_end] = (
+            node_probs[parents] * next_probs[parent_pos, :, child_tokens]
+        )
+
+    return node_probs[trie.code_node].T
+
+
 def full_search_decoder_seq2seq_optimized(
         model: Seq2SeqOccCANINE,
         descr: torch.Tensor,
@@ -161,110 +569,471 @@ def full_search_decoder_seq2seq_optimized(
         device: torch.device,
         codes_list: list[list[int]],
         start_symbol: int,
-        ) -> dict:
+        max_rows_per_call: int = 4096,
+        trie: CompiledTrie | None = None,
+        ) -> Tensor:
+    memory = model.encode(descr, input_attention_mask)
+    batch_size = descr.size(0)
+
+    if trie is None:
+        trie = CompiledTrie(codes_list, device=device)
 
+    results = _full_search_level_synchronous(
+        model=model,
+        memory=model.precompute_memory(memory, input_attention_mask),
+        batch_size=batch_size,
+        device=device,
+        trie=trie,
+        start_symbol=start_symbol,
+        max_rows_per_call=max_rows_per_call,
+    )
+
+    return results
+
+
+def full_search_decoder_mixer_optimized(
+        model: Seq2SeqMixerOccCANINE,
+        descr: torch.Tensor,
+        input_attention_mask: torch.Tensor,
+        device: torch.device,
+        codes_list: list[list[int]],
+        start_symbol: int,
+        max_rows_per_call: int = 4096,
+        trie: CompiledTrie | None = None,
+        ) -> Tensor:
     memory = model.encode(descr, input_attention_mask)
+
+    # Ensure memory is a tensor
+    if isinstance(memory, tuple):
+        memory = memory[0]
+
     batch_size = descr.size(0)
 
-    # Step 1: Build Trie
-    trie = build_trie(codes_list)
+    if trie is None:
+        trie = CompiledTrie(codes_list, device=device)
+
+    # Number of decoder calls is trie depth (per chunk); before, it was
+    # trie.count_nodes() - 1, i.e., 4072 calls for HISCO
+    results = _full_search_level_synchronous(
+        model=model,
+        memory=model.precompute_memory(memory, input_attention_mask),
+        batch_size=batch_size,
+        device=device,
+        trie=trie,
+        start_symbol=start_symbol,
+        max_rows_per_call=max_rows_per_call,
+    )
 
-    # Step 2: Initialize results
-    results = torch.empty((batch_size, len(codes_list)), dtype=torch.float, device=device)
-    code_indices = {tuple(code): idx for idx, code in enumerate(codes_list)}
+    return results
 
-    # Step 3: Initialize sequences
-    seq = torch.ones(batch_size, 1).fill_(start_symbol).type(torch.long).to(device)
-    prob_seq = torch.ones(batch_size, 1).fill_(1.0).type(torch.float).to(device)
 
-    # Step 4: Decode using Trie
-    stack = [(trie, seq, prob_seq)]
+def _beam_search(
+        model: Seq2SeqOccCANINE,
+        memory: Tensor | DecoderMemory,
+        batch_size: int,
+        device: torch.device,
+        trie: CompiledTrie,
+        start_symbol: int,
+        beam_width: int = 5,
+        ) -> Tensor:
+    """
+    Beam search constrained to the codes of `trie`. At each depth, every
+    hypothesis is extended by the children of its trie node only, and the
+    `beam_width` most probable extensions of each observation are kept, such
+    that each of the (at most) `beam_width` hypotheses left at the end is a
+    valid code. Costs about `beam_width` times a greedy decode.
+
+    Returns a tensor of shape (B, trie.num_codes) with the sequence probability
+    of each code found by the search and 0 for all other codes, i.e., on the
+    same scale as the full search decoders.
+    """
+    if beam_width < 1:
+        raise ValueError(f'beam_width must be positive, got {beam_width}')
+
+    if not (trie.depth[trie.code_node] == trie.max_depth).all():
+        raise ValueError('Beam search requires all codes to be of the same length')
 
-    # n_model_calls = 0
+    if not isinstance(memory, DecoderMemory):
+        memory = model.precompute_memory(memory)
 
-    while stack:
-        node, seq, prob_seq = stack.pop()
+    cache = model.init_decoder_cache()
 
-        if node.codes:
-            for code in node.codes:
-                code_seq_probs = prob_seq[:, -1]
-                results[:, code_indices[tuple(code)]] = code_seq_probs
+    num_tokens = trie.child_table.size(1)
+    batch_pos = torch.arange(batch_size, device=device)
 
-        for number, child_node in node.children.items():
-            which_output = torch.ones(batch_size, 1).fill_(number).type(torch.long).to(device)
-            target_mask = generate_square_subsequent_mask(seq.shape[1], device).type(torch.bool)
-            out = model.decode(
-                memory=memory,
-                target=seq,
-                target_mask=target_mask,
-                target_padding_mask=None,
-            )[:, -1:, :]
-            # n_model_calls += 1
+    # Hypotheses are laid out branch-major, (num_hypotheses, B), and all start
+    # at the root
+    nodes = torch.zeros((1, batch_size), dtype=torch.long, device=device)
+    log_probs = torch.zeros((1, batch_size), dtype=torch.float, device=device)
+    next_input = torch.full((batch_size, 1), start_symbol, dtype=torch.long, device=device)
 
-            next_prob = torch.gather(torch.nn.functional.softmax(out, dim=2), 2, which_output.unsqueeze(2)).squeeze(2)
-            new_prob_seq = prob_seq * next_prob
-            new_seq = torch.cat([seq, which_output], dim=1)
-            stack.append((child_node, new_seq, new_prob_seq))
+    for _ in range(trie.max_depth):
+        num_hypotheses = nodes.size(0)
 
-    return results
+        out = model.decode_incremental(
+            memory=memory.expand(num_hypotheses),
+            target=next_input,
+            cache=cache,
+        )[:, -1, :]
 
+        # Normalize over the full vocabulary before restricting to tokens of
+        # the trie, such that scores are sequence probabilities
+        out = nn.functional.log_softmax(out, dim=1)[:, :num_tokens].view(num_hypotheses, batch_size, num_tokens)
 
-def full_search_decoder_mixer_optimized(
-        model: Seq2SeqMixerOccCANINE,
+        # Only extensions to children in the trie are valid
+        children = trie.child_table[nodes] # (num_hypotheses, B, num_tokens)
+        scores = (log_probs.unsqueeze(2) + out).masked_fill(children < 0, float('-inf'))
+        scores = scores.permute(1, 0, 2).reshape(batch_size, num_hypotheses * num_tokens)
+
+        log_probs, flat_idx = scores.topk(min(beam_width, scores.size(1)), dim=1)
+        log_probs, flat_idx = log_probs.T, flat_idx.T # (num_hypotheses, B)
+        hypothesis, token = flat_idx // num_tokens, flat_idx % num_tokens
+
+        # Invalid extensions (if fewer than `beam_width` valid ones exist)
+        # point at the root with probability 0
+        nodes = children[hypothesis, batch_pos, token].masked_fill(torch.isinf(log_probs), 0)
+
+        cache.index_select((hypothesis * batch_size + batch_pos).reshape(-1))
+        next_input = token.reshape(-1, 1)
+
+    # Scatter to nodes, then gather for each code, as duplicated codes share a node
+    node_probs = torch.zeros((batch_size, len(trie)), dtype=torch.float, device=device)
+    node_probs.scatter_(1, nodes.T, log_probs.T.exp())
+
+    return node_probs[:, trie.code_node]
+
+
+def beam_search_decoder(
+        model: Seq2SeqOccCANINE | Seq2SeqMixerOccCANINE,
         descr: torch.Tensor,
         input_attention_mask: torch.Tensor,
         device: torch.device,
-        codes_list: list[list[int]],
+        trie: CompiledTrie,
         start_symbol: int,
-        ) -> dict:
+        beam_width: int = 5,
+        ) -> Tensor:
     memory = model.encode(descr, input_attention_mask)
-    
+
     # Ensure memory is a tensor
     if isinstance(memory, tuple):
         memory = memory[0]
 
-    batch_size = descr.size(0)
+    results = _beam_search(
+        model=model,
+        memory=model.precompute_memory(memory, input_attention_mask),
+        batch_size=descr.size(0),
+        device=device,
+        trie=trie,
+        start_symbol=start_symbol,
+        beam_width=beam_width,
+    )
 
-    # Step 1: Build Trie
-    trie = build_trie(codes_list)
+    return results
 
-    # Step 2: Initialize results
-    results = torch.empty((batch_size, len(codes_list)), dtype=torch.float, device=device)
-    code_indices = {tuple(code): idx for idx, code in enumerate(codes_list)}
 
-    # Step 3: Initialize sequences
-    seq = torch.ones(batch_size, 1).fill_(start_symbol).type(torch.long).to(device)
-    prob_seq = torch.ones(batch_size, 1).fill_(1.0).type(torch.float).to(device)
+def _best_first_search(
+        model: Seq2SeqOccCANINE,
+        memory: Tensor | DecoderMemory,
+        batch_size: int,
+        device: torch.device,
+        trie: CompiledTrie,
+        start_symbol: int,
+        topk: int = 5,
+        nodes_per_step: int = 8,
+        ) -> Tensor:
+    """
+    Exact top-k search over the codes of `trie`. Open trie nodes are expanded
+    most probable prefix first, `nodes_per_step` nodes per observation per
+    decoder call. As the probability of a prefix bounds that of any code
+    below it, any node whose prefix probability is below the k-th most
+    probable code found so far is pruned, such that typically only a small
+    fraction of the trie is expanded.
+
+    Returns a tensor of shape (B, trie.num_codes) with the probabilities of
+    the `topk` most probable codes, identical to those of the full search
+    decoders, and 0 for all other codes.
+    """
+    if not isinstance(memory, DecoderMemory):
+        memory = model.precompute_memory(memory)
 
-    # Step 4: Decode using Trie
-    stack = [(trie, seq, prob_seq)]
+    num_tokens = trie.child_table.size(1)
+    is_code_node = torch.zeros(len(trie), dtype=torch.bool, device=device)
+    is_code_node[trie.code_node] = True
+    has_children = trie.child_ptr[1:] > trie.child_ptr[:-1]
 
-    # n_model_calls = 0
+    # Prefix probability of open nodes, -1 for nodes which are not open
+    open_probs = torch.full((batch_size, len(trie)), -1.0, dtype=torch.float, device=device)
+    open_probs[:, 0] = 1.0
 
-    while stack:
-        node, seq, prob_seq = stack.pop()
+    # Probability of each code node found so far, 0 if not found
+    code_probs = torch.zeros((batch_size, len(trie)), dtype=torch.float, device=device)
 
-        if node.codes:
-            for code in node.codes:
-                code_seq_probs = prob_seq[:, -1]
-                results[:, code_indices[tuple(code)]] = code_seq_probs
+    batch_pos = torch.arange(batch_size, device=device)
+    steps = min(nodes_per_step, len(trie))
 
-        for number, child_node in node.children.items():
-            which_output = torch.ones(batch_size, 1).fill_(number).type(torch.long).to(device)
-            target_mask = generate_square_subsequent_mask(seq.shape[1], device).type(torch.bool)
-            out = model.decode(
-                memory=memory,
-                target=seq,
-                target_mask=target_mask,
-                target_padding_mask=None,
-            )[:, -1:, :]
-            # n_model_calls += 1
+    while (open_probs >= 0).any():
+        # Most probable open nodes of each observation, (steps, B)
+        probs, nodes = open_probs.topk(steps, dim=1)
+        probs, nodes = probs.T, nodes.T
+        valid = probs >= 0
+
+        open_probs[batch_pos, nodes] = -1.0 # Close expanded nodes
+
+        # Decode prefixes of all nodes at once. Prefixes are right-padded to
+        # equal length, which does not affect earlier positions
+        depth = trie.depth[nodes].masked_fill(~valid, 0)
+        max_depth = int(depth.max())
+        prefixes = torch.cat([
+            torch.full((nodes.numel(), 1), start_symbol, dtype=torch.long, device=device),
+            trie.prefix[nodes.reshape(-1), :max_depth].clamp(min=0),
+        ], dim=1)
+
+        out = model.decode_incremental(
+            memory=memory.expand(steps),
+            target=prefixes,
+        )
+        out = out[torch.arange(nodes.numel(), device=device), depth.reshape(-1)]
+
+        # Normalize over the full vocabulary before restricting to tokens of
+        # the trie, such that probabilities match those of the full search
+        next_probs = nn.functional.softmax(out, dim=1)[:, :num_tokens].view(steps, batch_size, num_tokens)
+
+        # Probability of each child of the expanded nodes
+        children = trie.child_table[nodes] # (steps, B, num_tokens)
+        child_probs = probs.unsqueeze(2) * next_probs
+        is_child = (children >= 0) & valid.unsqueeze(2)
+        children = children.clamp(min=0)
+
+        child_batch_pos = batch_pos.view(1, -1, 1).expand_as(children)[is_child]
+        children, child_probs = children[is_child], child_probs[is_child]
+
+        found = is_code_node[children]
+        code_probs[child_batch_pos[found], children[found]] = child_probs[found]
+
+        expand = has_children[children]
+        open_probs[child_batch_pos[expand], children[expand]] = child_probs[expand]
+
+        # Prune nodes which cannot lead to a code in the top-k found so far
+        if code_probs.size(1) >= topk:
+            bound = code_probs.topk(topk, dim=1).values[:, -1:]
+            open_probs = open_probs.masked_fill(open_probs < bound, -1.0)
+
+    results = code_probs[:, trie.code_node]
+
+    # Keep only the top-k (more codes may have been found along the way)
+    keep = results.topk(min(topk, results.size(1)), dim=1).indices
+    topk_results = torch.zeros_like(results)
+    topk_results.scatter_(1, keep, results.gather(1, keep))
+
+    return topk_results
+
+
+def best_first_search_decoder(
+        model: Seq2SeqOccCANINE | Seq2SeqMixerOccCANINE,
+        descr: torch.Tensor,
+        input_attention_mask: torch.Tensor,
+        device: torch.device,
+        trie: CompiledTrie,
+        start_symbol: int,
+        topk: int = 5,
+        nodes_per_step: int = 8,
+        ) -> Tensor:
+    memory = model.encode(descr, input_attention_mask)
+
+    # Ensure memory is a tensor
+    if isinstance(memory, tuple):
+        memory = memory[0]
+
+    results = _best_first_search(
+        model=model,
+        memory=model.precompute_memory(memory, input_attention_mask),
+        batch_size=descr.size(0),
+        device=device,
+        trie=trie,
+        start_symbol=start_symbol,
+        topk=topk,
+        nodes_per_step=nodes_per_step,
+    )
+
+    return results
 
-            next_prob = torch.gather(torch.nn.functional.softmax(out, dim=2), 2, which_output.unsqueeze(2)).squeeze(2)
-            new_prob_seq = prob_seq * next_prob
-            new_seq = torch.cat([seq, which_output], dim=1)
-            stack.append((child_node, new_seq, new_prob_seq))
 
-    # print(n_model_calls) # 4073 is equal to trie.count_nodes(): Compared to len(codes_list)*5 = 9595
+def flat_topk_rerank_decoder_mixer(
+        model: Seq2SeqMixerOccCANINE,
+        descr: torch.Tensor,
+        input_attention_mask: torch.Tensor,
+        device: torch.device,
+        trie: CompiledTrie,
+        start_symbol: int,
+        topk: int = 20,
+        ) -> Tensor:
+    """
+    Full search restricted to the `topk` most likely codes of the flat head
+    of a mixer model, which is computed from the same encoder pass. The
+    candidate codes of all observations are scored through the seq2seq
+    decoder in one teacher-forced call, sharing the encoder memory of each
+    observation across its candidates. Assumes class `i` of the flat head
+    corresponds to code `i` of `trie`.
+
+    Returns a tensor of shape (B, trie.num_codes) with the sequence probability
+    of each candidate code, i.e., as the full search decoders, and 0 for all
+    other codes.
+    """
+    if not (trie.depth[trie.code_node] == trie.max_depth).all():
+        raise ValueError('Scoring flat head candidates requires all codes to be of the same length')
+
+    memory, pooled_memory = model.encode(descr, input_attention_mask)
+    batch_size = descr.size(0)
+
+    out_linear = model.linear_decoder(pooled_memory)
+    topk = min(topk, trie.num_codes)
+    candidates = out_linear[:, :trie.num_codes].topk(topk, dim=1).indices.T # (topk, B)
+
+    # Tokens of each candidate, laid out candidate-major, (topk * B, code length)
+    codes = trie.prefix[trie.code_node[candidates.reshape(-1)]]
+    target = torch.cat([
+        torch.full((codes.size(0), 1), start_symbol, dtype=torch.long, device=device),
+        codes,
+    ], dim=1)
+
+    out = model.decode_incremental(
+        memory=model.precompute_memory(memory, input_attention_mask).expand(topk),
+        target=target[:, :-1],
+    )
+    token_probs = torch.gather(
+        nn.functional.softmax(out, dim=2), 2, target[:, 1:].unsqueeze(2),
+    ).squeeze(2)
+
+    results = torch.zeros((batch_size, trie.num_codes), dtype=torch.float, device=device)
+    results.scatter_(1, candidates.T, token_probs.prod(dim=1).view(topk, batch_size).T)
+
+    return results
+
+
+def _greedy_to_code_probs(
+        seq: Tensor,
+        prob_seq: Tensor,
+        trie: CompiledTrie,
+        ) -> Tensor:
+    '''
+    Converts the output of `_greedy_search` to a tensor of shape
+    (B, trie.num_codes), where each code found in a block of the greedy
+    sequence gets the probability of the whole sequence (the product of its
+    token probabilities), and all other codes get 0. Blocks which are not a
+    code in `trie`, such as padding, are ignored.
+
+    '''
+    batch_size, max_len = seq.shape
+    block_size = trie.max_depth
+    num_blocks = (max_len - 2) // block_size
+    width = trie.child_table.size(1)
+
+    blocks = seq[:, 1:1 + num_blocks * block_size].reshape(batch_size, num_blocks, block_size)
+
+    # Walk the trie one depth at a time for all blocks, -1 once off the trie
+    nodes = torch.zeros((batch_size, num_blocks), dtype=torch.long, device=seq.device)
+
+    for depth in range(block_size):
+        tokens = blocks[:, :, depth]
+        valid = (nodes >= 0) & (tokens < width)
+        nodes = torch.where(
+            valid,
+            trie.child_table[nodes.clamp(min=0), tokens.clamp(max=width - 1)],
+            -1,
+        )
+
+    node_code = torch.full((len(trie),), -1, dtype=torch.long, device=seq.device)
+    node_code[trie.code_node] = torch.arange(trie.num_codes, device=seq.device)
+    codes = torch.where(nodes >= 0, node_code[nodes.clamp(min=0)], -1)
+
+    seq_probs = prob_seq.float().prod(dim=1)
+    rows, cols = (codes >= 0).nonzero(as_tuple=True)
+
+    results = torch.zeros((batch_size, trie.num_codes), dtype=torch.float, device=seq.device)
+    results[rows, codes[rows, cols]] = seq_probs[rows]
 
     return results
+
+
+def adaptive_decoder_mixer(
+        model: Seq2SeqMixerOccCANINE,
+        descr: torch.Tensor,
+        input_attention_mask: torch.Tensor,
+        device: torch.device,
+        trie: CompiledTrie,
+        start_symbol: int,
+        min_conf: float = 0.9,
+        min_margin: float = 0.0,
+        fallback: Literal['greedy', 'full', 'beam'] = 'full',
+        topk: int | None = None,
+        beam_width: int = 5,
+        max_len: int | None = None,
+        ) -> tuple[Tensor, Tensor]:
+    """
+    Cascade of the flat and seq2seq heads of a mixer model. The flat head is
+    used for all observations, and the seq2seq decoder only for those where
+    the flat head is not confident, i.e., where its top-1 probability is below
+    `min_conf` or the margin between its top-1 and top-2 probabilities is
+    below `min_margin`. The encoder pass is shared by both heads.
+
+    The seq2seq decoder either runs a full search (`fallback='full'`; exact
+    top-k only if `topk` is specified), a beam search (`fallback='beam'`), or
+    greedy decoding (`fallback='greedy'`, which requires `max_len`), in which
+    case each code of the greedy output gets the probability of the whole
+    greedy sequence (see `_greedy_to_code_probs`). Assumes class `i` of the
+    flat head corresponds to code `i` of `trie`.
+
+    Returns a tensor of shape (B, trie.num_codes) with probabilities from the
+    flat head (sigmoid) for confident observations and from the seq2seq
+    decoder for all others, and a boolean tensor of shape (B,) indicating
+    which observations were decoded by the seq2seq decoder. Note that the
+    two are on different scales: flat probabilities are independent per
+    code, whereas seq2seq probabilities are of sequences and sum to at most 1
+    per observation.
+    """
+    if fallback not in ['greedy', 'full', 'beam']:
+        raise ValueError(f"fallback must be 'greedy', 'full', or 'beam', got '{fallback}'")
+
+    if fallback == 'greedy' and max_len is None:
+        raise ValueError("max_len must be specified when fallback is 'greedy'")
+
+    memory, pooled_memory = model.encode(descr, input_attention_mask)
+
+    probs = torch.sigmoid(model.linear_decoder(pooled_memory))[:, :trie.num_codes]
+    top2 = probs.topk(min(2, probs.size(1)), dim=1).values
+    margin = top2[:, 0] - top2[:, 1] if top2.size(1) > 1 else top2[:, 0]
+
+    routed = (top2[:, 0] < min_conf) | (margin < min_margin)
+
+    if routed.any() and fallback == 'greedy':
+        seq, prob_seq, _ = _greedy_search(
+            model=model,
+            memory=memory[routed],
+            batch_size=int(routed.sum()),
+            device=device,
+            max_len=max_len,
+            start_symbol=start_symbol,
+            input_attention_mask=input_attention_mask[routed],
+        )
+        probs[routed] = _greedy_to_code_probs(seq, prob_seq, trie)
+
+    elif routed.any():
+        kwargs = {
+            'model': model,
+            'memory': model.precompute_memory(memory[routed], input_attention_mask[routed]),
+            'batch_size': int(routed.sum()),
+            'device': device,
+            'trie': trie,
+            'start_symbol': start_symbol,
+        }
+
+        if fallback == 'beam':
+            probs_s2s = _beam_search(beam_width=beam_width, **kwargs)
+        elif topk is not None:
+            probs_s2s = _best_first_search(topk=topk, **kwargs)
+        else:
+            probs_s2s = _full_search_level_synchronous(**kwargs)
+
+        probs[routed] = probs_s2s
+
+    return probs, routed
@@ -0,0 +1,107 @@
+"""
+Shared-memory storage of dataset arrays for use across DataLoader workers.
+
+Python objects (e.g., strings in an object array or a list) carry reference
+counts, so merely reading them in a forked DataLoader worker writes to their
+memory pages, which are then copied; over an epoch, each worker ends up with
+its own copy of the data. Strings are therefore stored as one buffer of UTF-8
+bytes plus offsets, and NumPy arrays are backed by tensors in shared memory,
+which are passed to (forked or spawned) workers by handle rather than copied.
+
+"""
+
+
+from collections.abc import Iterable
+
+import numpy as np
+import torch
+
+
+class SharedArrays:
+    '''
+    Mixin keeping NumPy array attributes in shared memory. After
+    `self._share_arrays(*names)`, each named attribute is a NumPy view of a
+    shared-memory tensor. When pickled (e.g., to DataLoader workers), only the
+    tensors are passed on, and the views are restored on the receiving side.
+    '''
+    _shared: dict[str, torch.Tensor]
+
+    def _share_arrays(self, *names: str) -> None:
+        if '_shared' not in self.__dict__:
+            self._shared = {}
+
+        for name in names:
+            array = np.asarray(getattr(self, name))
+            dtype = torch.from_numpy(np.empty(0, dtype=array.dtype)).dtype
+
+            # Copy into a tensor allocated in shared memory (arrays may be
+            # read-only, e.g., if backed by a `bytes` object)
+            tensor = torch.empty(array.shape, dtype=dtype).share_memory_()
+            tensor.numpy()[...] = array
+
+            self._shared[name] = tensor
+            setattr(self, name, tensor.numpy())
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+
+        for name in state.get('_shared', {}):
+            del state[name]
+
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+
+        for name, tensor in state.get('_shared', {}).items():
+            setattr(self, name, tensor.numpy())
+
+
+class StringArray(SharedArrays):
+    '''
+    Immutable array of strings stored as UTF-8 bytes and offsets in shared
+    memory. Supports `len`, indexing by an integer (returning a `str`) or by
+    an array of integers (returning a `list[str]`), and `random.choice`.
+
+    Parameters
+    ----------
+    values : Iterable[str]
+        Strings to store.
+
+    '''
+    def __init__(self, values: Iterable[str]):
+        encoded = [value.encode('utf-8') for value in values]
+
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)), out=self.offsets[1:])
+        self.data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+        self._share_arrays('offsets', 'data')
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def _get(self, item: int) -> str:
+        return self.data[self.offsets[item]:self.offsets[item + 1]].tobytes().decode('utf-8')
+
+    def __getitem__(self, item: int | np.ndarray | list[int]) -> str | list[str]:
+        if isinstance(item, (int, np.integer)):
+            if item < 0:
+                item += len(self)
+
+            if not 0 <= item < len(self):
+                raise IndexError(f'index {item} out of range for StringArray of length {len(self)}')
+
+            return self._get(int(item))
+
+        return [self[int(i)] for i in np.asarray(item).ravel()]
+
+    def lengths(self) -> np.ndarray:
+        ''' Number of characters of each string '''
+        return np.fromiter(map(len, self), dtype=np.int64, count=len(self))
+
+    def tolist(self) -> list[str]: # pylint: disable=C0116
+        return [self._get(i) for i in range(len(self))]
+
+    def __iter__(self):
+        return (self._get(i) for i in range(len(self)))
@@ -0,0 +1,58 @@
+"""
+Expansion of compact target representations into the dense targets used by
+the loss functions.
+
+Flat (multi-label) targets are transported from the data loader as padded
+lists of class indices, which are expanded into multi-hot matrices only once
+on the device the loss is computed on.
+
+"""
+
+
+import torch
+
+from torch import Tensor
+
+
+def multi_hot(
+        indices: Tensor,
+        num_classes: int,
+        pad_idx: int = -1,
+        dtype: torch.dtype = torch.float,
+        ) -> Tensor:
+    """
+    Expand padded class indices into a multi-hot matrix.
+
+    Parameters
+    ----------
+    indices : Tensor
+        Class indices of shape [BATCH_SIZE, MAX_NUM_CODES], where rows with
+        fewer codes are padded with `pad_idx`.
+    num_classes : int
+        Number of classes, i.e., width of the resulting matrix.
+    pad_idx : int
+        Index used to denote padding. Must be outside [0, `num_classes`).
+    dtype : torch.dtype
+        Type of the resulting matrix.
+
+    Returns
+    -------
+    Tensor
+        Matrix of shape [BATCH_SIZE, `num_classes`] on the same device as
+        `indices`, with ones at the positions of the (non-padding) indices of
+        each row and zeros elsewhere.
+
+    """
+    valid = indices != pad_idx
+    target = torch.zeros(indices.size(0), num_classes, dtype=dtype, device=indices.device)
+
+    # Padding is scattered as zeros onto class 0, which the max-reduction
+    # leaves untouched; duplicate indices simply yield a single one
+    target.scatter_reduce_(
+        dim=1,
+        index=torch.where(valid, indices, 0).long(),
+        src=valid.to(dtype),
+        reduce='amax',
+    )
+
+    return target
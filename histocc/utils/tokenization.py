@@ -0,0 +1,102 @@
+"""
+Vectorized encoding of input strings for CANINE.
+
+CANINE operates directly on Unicode codepoints, so tokenization amounts to
+mapping each character to its codepoint and wrapping the sequence in the
+CLS/SEP private-use codepoints. This lets us encode a full batch of strings
+in one NumPy pass instead of calling `CanineTokenizer.encode_plus` one string
+at a time.
+
+"""
+
+
+from collections.abc import Iterable
+
+import numpy as np
+
+from transformers import CanineTokenizer
+
+
+CANINE_PAD = 0
+CANINE_CLS = 0xE000
+CANINE_SEP = 0xE001
+
+
+def _as_str_list(texts: Iterable[str]) -> list[str]:
+    # Arrow arrays/chunked arrays (and pandas/NumPy containers) expose
+    # conversions to Python lists; avoid hard dependency on `pyarrow`
+    if hasattr(texts, 'to_pylist'):
+        return texts.to_pylist()
+
+    if hasattr(texts, 'tolist'):
+        return texts.tolist()
+
+    return list(texts)
+
+
+def canine_encode(
+        texts: Iterable[str],
+        max_length: int,
+        ) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Encode strings to CANINE input ids and attention masks.
+
+    Output matches `CanineTokenizer.encode_plus(text, add_special_tokens=True,
+    padding='max_length', max_length=max_length, truncation=True)` for a
+    tokenizer without added tokens, i.e. `[CLS] + codepoints[:max_length - 2]
+    + [SEP]` followed by padding.
+
+    Parameters
+    ----------
+    texts : Iterable[str]
+        Strings to encode, e.g. a list or an Arrow string array.
+    max_length : int
+        Length to pad/truncate to, including CLS and SEP.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        `input_ids` and `attention_mask`, both int32 of shape
+        `(len(texts), max_length)`.
+
+    """
+    if max_length < 2:
+        raise ValueError(f'max_length must be at least 2 to fit CLS and SEP, got {max_length}')
+
+    texts = _as_str_list(texts)
+    num_texts = len(texts)
+
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=num_texts)
+    lengths = np.minimum(lengths, max_length - 2)
+
+    input_ids = np.zeros((num_texts, max_length), dtype=np.int32)
+    width = int(lengths.max()) if num_texts > 0 else 0
+
+    if width > 0:
+        # Fixed-width UTF-32 array: NumPy truncates longer strings and
+        # zero-fills shorter ones, so viewing the buffer as uint32 yields
+        # the codepoints directly (zero-fill coincides with CANINE_PAD)
+        codepoints = np.array(texts, dtype=f'<U{width}').view(np.uint32)
+        input_ids[:, 1:width + 1] = codepoints.reshape(num_texts, width)
+
+    rows = np.arange(num_texts)
+    input_ids[:, 0] = CANINE_CLS
+    input_ids[rows, lengths + 1] = CANINE_SEP
+
+    attention_mask = (np.arange(max_length) < (lengths + 2)[:, None]).astype(np.int32)
+
+    return input_ids, attention_mask
+
+
+def supports_canine_encode(tokenizer) -> bool:
+    """
+    Whether `canine_encode` reproduces `tokenizer` exactly. This holds for a
+    `CanineTokenizer` where every added token is one of its special tokens,
+    since CANINE's special token ids equal their codepoints. Tokenizers
+    extended through `update_tokenizer` (or non-CANINE tokenizers) must use
+    `tokenizer.encode_plus`.
+    """
+    if not isinstance(tokenizer, CanineTokenizer):
+        return False
+
+    return set(tokenizer.get_added_vocab()) <= set(tokenizer.all_special_tokens)
@@ -1,5 +1,9 @@
 from collections import defaultdict
 
+import torch
+
+import numpy as np
+
 
 class TrieNode:
     def __init__(self):
@@ -45,3 +49,107 @@ def build_trie(codes_list):
         node.codes.append(code)
 
     return root
+
+
+class CompiledTrie:
+    '''
+    Array-backed version of the trie built by `build_trie`, meant to be built
+    once and reused across batches. Nodes are numbered breadth-first and the
+    children of each node are stored contiguously, sorted by token. Hence the
+    nodes at each depth occupy a contiguous range, which allows vectorized
+    traversal one depth at a time.
+
+    Parameters
+    ----------
+    codes_list : list[list[int]]
+        Formatted codes, e.g., as returned by `OccCANINE._list_of_formatted_codes`.
+    device : torch.device | str
+        Which device to store the arrays at.
+
+    Attributes
+    ----------
+    parent : Tensor
+        Index of the parent of each node, -1 for the root. Non-decreasing.
+    token : Tensor
+        Token leading into each node, -1 for the root.
+    depth : Tensor
+        Depth of each node, 0 for the root.
+    prefix : Tensor
+        Tokens on the path from the root to each node, of shape
+        (num_nodes, max_depth), right-padded with -1.
+    code_node : Tensor
+        Index of the node at which each code in `codes_list` ends.
+    child_ptr : Tensor
+        Children of node `i` are nodes `child_ptr[i]` to `child_ptr[i + 1]`.
+    child_table : Tensor
+        Dense lookup of children, of shape (num_nodes, max_token + 1), such that
+        `child_table[i, t]` is the child of node `i` reached by token `t`, or -1.
+    level_ptr : list[int]
+        Nodes at depth `d` are nodes `level_ptr[d]` to `level_ptr[d + 1]`.
+
+    '''
+    def __init__(
+            self,
+            codes_list: list[list[int]],
+            device: torch.device | str = 'cpu', # pylint: disable=E1101
+    ):
+        codes = [tuple(int(number) for number in code) for code in codes_list]
+        max_depth = max((len(code) for code in codes), default=0)
+
+        node_of_prefix = {(): 0}
+        parent = [-1]
+        token = [-1]
+        depth = [0]
+        level_ptr = [0, 1]
+
+        for current_depth in range(1, max_depth + 1):
+            prefixes = {code[:current_depth] for code in codes if len(code) >= current_depth}
+
+            # Sorting on (parent, token) keeps children of each node contiguous
+            for prefix in sorted(prefixes, key=lambda p: (node_of_prefix[p[:-1]], p[-1])):
+                node_of_prefix[prefix] = len(parent)
+                parent.append(node_of_prefix[prefix[:-1]])
+                token.append(prefix[-1])
+                depth.append(current_depth)
+
+            level_ptr.append(len(parent))
+
+        prefix = np.full((len(parent), max_depth), -1, dtype=np.int64)
+
+        for node_prefix, node in node_of_prefix.items():
+            prefix[node, :len(node_prefix)] = node_prefix
+
+        parent = np.array(parent, dtype=np.int64)
+        child_ptr = 1 + np.searchsorted(parent[1:], np.arange(len(parent) + 1), side='left')
+
+        child_table = np.full((len(parent), max(token) + 1), -1, dtype=np.int64)
+        child_table[parent[1:], token[1:]] = np.arange(1, len(parent))
+
+        self.num_nodes = len(parent)
+        self.num_codes = len(codes)
+        self.max_depth = max_depth
+        self.level_ptr = level_ptr
+
+        self.parent = torch.from_numpy(parent).to(device)
+        self.token = torch.tensor(token, dtype=torch.long, device=device)
+        self.depth = torch.tensor(depth, dtype=torch.long, device=device)
+        self.prefix = torch.from_numpy(prefix).to(device)
+        self.child_ptr = torch.from_numpy(child_ptr).to(device)
+        self.child_table = torch.from_numpy(child_table).to(device)
+        self.code_node = torch.tensor(
+            [node_of_prefix[code] for code in codes], dtype=torch.long, device=device,
+        )
+
+    def __len__(self) -> int:
+        return self.num_nodes
+
+    def level(self, depth: int) -> tuple[int, int]:
+        ''' Range of nodes (start, end) at depth `depth`
+        '''
+        return self.level_ptr[depth], self.level_ptr[depth + 1]
+
+    def to(self, device: torch.device | str) -> 'CompiledTrie': # pylint: disable=C0116
+        for name in ('parent', 'token', 'depth', 'prefix', 'child_ptr', 'child_table', 'code_node'):
+            setattr(self, name, getattr(self, name).to(device))
+
+        return self
@@ -0,0 +1,159 @@
+"""
+Test batched fetching of samples through `__getitems__`.
+"""
+import unittest
+import sys
+import os
+import random
+import tempfile
+
+import numpy as np
+import pandas as pd
+import torch
+
+from torch.utils.data import DataLoader
+from transformers import CanineTokenizer
+
+# Add parent directory to path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from histocc.attacker import AttackerClass
+from histocc.dataloader import (
+    OccDatasetMixerInMemMultipleFiles,
+    OccDatasetV2InMem,
+    collate_batch,
+    dynamic_padding_collate,
+)
+from histocc.formatter import hisco_blocky5
+
+
+class TestBatchedFetch(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.tmpdir.name, 'data.csv')
+
+        pd.DataFrame({
+            'occ1': ['farmer', 'fisherman and farmer', 'nan', 'smith', 'day labourer'],
+            'lang': ['en', 'en', 'da', 'de', 'unk'],
+            'code1': ['10', '20', '30', '2', '10'],
+            'code2': [np.nan, '10', np.nan, np.nan, '30'],
+            'code3': [np.nan] * 5,
+            'code4': [np.nan] * 5,
+            'code5': [np.nan] * 5,
+        }).to_csv(self.fname, index=False)
+
+        self.common = {
+            'formatter': hisco_blocky5(),
+            'tokenizer': CanineTokenizer(),
+            'max_input_len': 32,
+        }
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _assert_batches_equal(self, batch, reference):
+        self.assertEqual(batch.keys(), reference.keys())
+
+        for key, value in reference.items():
+            if isinstance(value, torch.Tensor):
+                torch.testing.assert_close(batch[key], value)
+            else:
+                self.assertEqual(list(batch[key]), list(value))
+
+    def _check_matches_per_sample(self, dataset, dataset_batched):
+        for collate_fn in (collate_batch, dynamic_padding_collate):
+            with self.subTest(collate_fn=collate_fn.__name__):
+                reference = next(iter(DataLoader(dataset, batch_size=4, collate_fn=collate_fn)))
+                batch = next(iter(DataLoader(dataset_batched, batch_size=4, collate_fn=collate_fn)))
+
+                self._assert_batches_equal(batch, reference)
+
+    def test_mixer(self):
+        kwargs = {
+            'fnames_data': [self.fname],
+            'num_classes_flat': 2000,
+            'training': False,
+            **self.common,
+        }
+        self._check_matches_per_sample(
+            OccDatasetMixerInMemMultipleFiles(**kwargs),
+            OccDatasetMixerInMemMultipleFiles(batched=True, **kwargs),
+        )
+
+    def test_in_mem(self):
+        kwargs = {
+            'fname_data': self.fname,
+            'fname_index': '',
+            'training': False,
+            **self.common,
+        }
+        self._check_matches_per_sample(
+            OccDatasetV2InMem(**kwargs),
+            OccDatasetV2InMem(batched=True, **kwargs),
+        )
+
+    def test_training_batch(self):
+        dataset = OccDatasetMixerInMemMultipleFiles(
+            fnames_data=[self.fname],
+            num_classes_flat=2000,
+            training=True,
+            alt_prob=1.0,
+            unk_lang_prob=0.5,
+            batched=True,
+            **self.common,
+        )
+        batch = dataset.__getitems__([0, 2, 4])
+
+        self.assertEqual(len(batch['occ1']), 3)
+        self.assertEqual(batch['input_ids'].shape, (3, 32))
+        self.assertEqual(batch['targets_seq2seq'].shape, (3, dataset.formatter.max_seq_len))
+        torch.testing.assert_close(
+            batch['targets_seq2seq'],
+            torch.from_numpy(dataset.targets_seq2seq[[0, 2, 4]].astype(np.int64)),
+        )
+
+    def test_training_batch_random_source(self):
+        ''' Batched augmentation draws from `random` only, as per-sample
+        augmentation does, such that seeding it makes both reproducible
+        '''
+        dataset = OccDatasetMixerInMemMultipleFiles(
+            fnames_data=[self.fname],
+            num_classes_flat=2000,
+            training=True,
+            alt_prob=1.0,
+            unk_lang_prob=0.5,
+            batched=True,
+            **self.common,
+        )
+        occ_descrs, langs = ['farmer'] * 50, ['en'] * 50
+        outputs = []
+
+        for torch_seed in (0, 1):
+            torch.manual_seed(torch_seed)
+            random.seed(0)
+            outputs.append(dataset._prepare_inputs(occ_descrs, langs)) # pylint: disable=W0212
+
+        self.assertListEqual(outputs[0], outputs[1])
+        self.assertTrue(any(x.startswith('unk[SEP]') for x in outputs[0]))
+        self.assertTrue(any(x.startswith('en[SEP]') for x in outputs[0]))
+
+
+class TestAttackBatch(unittest.TestCase):
+    strings = ['farmer', 'fisherman and farmer', 'smith']
+
+    def test_no_alteration(self):
+        attacker = AttackerClass(alt_prob=0.0)
+
+        self.assertEqual(attacker.attack_batch(self.strings), self.strings)
+
+    def test_alters_copy(self):
+        attacker = AttackerClass(alt_prob=1.0, n_trans=2)
+        strings = list(self.strings)
+        altered = attacker.attack_batch(strings)
+
+        self.assertEqual(len(altered), len(strings))
+        self.assertEqual(strings, self.strings)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+"""
+Test memory-mapped, byte-offset based reading of CSV rows.
+"""
+import unittest
+import sys
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# Add parent directory to path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from histocc.dataloader import (
+    MmapCSVRows,
+    create_index_file,
+    labels_to_bin,
+    load_byte_offsets,
+    record_to_bin,
+    _na_float,
+)
+
+
+class TestMmapCSVRows(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fname_data = os.path.join(self.tmpdir.name, 'data.csv')
+        self.fname_index = os.path.join(self.tmpdir.name, 'data_index.npy')
+
+        self.frame = pd.DataFrame({
+            'occ1': ['farmer', 'smith, blacksmith', 'nan', '42', 'he said "hello"', 'æøå'],
+            'lang': ['en', 'en', 'da', 'unk', 'en', 'da'],
+            'code1': ['10', '20', '30', '2', '10', '5'],
+            'code2': [np.nan, '10', np.nan, np.nan, np.nan, '7'],
+        })
+        self.frame.to_csv(self.fname_data, index=False)
+        create_index_file(self.fname_data, self.fname_index)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _rows(self) -> MmapCSVRows:
+        return MmapCSVRows(
+            self.fname_data,
+            byte_offsets=load_byte_offsets(self.fname_index),
+            colnames=list(self.frame.columns),
+            converters={'occ1': str},
+        )
+
+    def test_index(self):
+        offsets = np.load(self.fname_index)
+
+        self.assertEqual(offsets.dtype, np.uint64)
+        self.assertEqual(len(offsets), len(self.frame))
+
+        with open(self.fname_data, 'rb') as file:
+            header_length = len(file.readline())
+
+        self.assertEqual(offsets[0], header_length)
+
+    def test_matches_frame(self):
+        rows = self._rows()
+
+        self.assertEqual(len(rows), len(self.frame))
+
+        for item in range(len(self.frame)):
+            row = rows[item]
+            expected = self.frame.iloc[item]
+
+            for col in self.frame.columns:
+                if pd.isna(expected[col]):
+                    self.assertTrue(pd.isna(row[col]))
+                else:
+                    self.assertEqual(row[col], expected[col])
+
+    def test_legacy_text_index(self):
+        fname_index_txt = os.path.join(self.tmpdir.name, 'data_index.txt')
+        offsets = load_byte_offsets(self.fname_index)
+
+        with open(fname_index_txt, 'w', encoding='utf-8') as file:
+            file.writelines(f'{offset}\n' for offset in offsets)
+
+        np.testing.assert_array_equal(load_byte_offsets(fname_index_txt), offsets)
+
+    def test_pickle(self):
+        rows = self._rows()
+        first = rows[0]
+
+        restored = pickle.loads(pickle.dumps(rows))
+
+        self.assertEqual(restored[0], first)
+
+
+class TestRecordToBin(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fname_data = os.path.join(self.tmpdir.name, 'data.csv')
+        self.fname_index = os.path.join(self.tmpdir.name, 'data_index.npy')
+
+        self.frame = pd.DataFrame({
+            'occ1': ['farmer', 'no occupation, smith', 'fisher'],
+            'lang': ['en', 'en', 'da'],
+            'code1': ['10', '2', '0'],
+            'code2': [np.nan, '20', np.nan],
+            'code3': [np.nan, '30', np.nan],
+            'code4': [np.nan] * 3,
+            'code5': [np.nan] * 3,
+        })
+        self.frame.to_csv(self.fname_data, index=False)
+        create_index_file(self.fname_data, self.fname_index)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_matches_labels_to_bin(self):
+        ''' Labels of records read as by `OCCDataset` should match those of
+        the 1-row data frames previously built from them.
+        '''
+        colnames = list(self.frame.columns)
+        rows = MmapCSVRows(
+            self.fname_data,
+            byte_offsets=load_byte_offsets(self.fname_index),
+            colnames=colnames,
+            converters={
+                'occ1': str,
+                'lang': str,
+                **{col: _na_float for col in colnames if col.startswith('code')},
+            },
+        )
+
+        for item in range(len(self.frame)):
+            record = rows[item]
+            expected = labels_to_bin(pd.DataFrame([record], columns=colnames), max_value=50)
+
+            np.testing.assert_array_equal(record_to_bin(record, max_value=50), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
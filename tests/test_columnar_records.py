@@ -0,0 +1,70 @@
+"""
+Test column-wise record storage of in-memory datasets.
+"""
+import unittest
+import sys
+import os
+
+import numpy as np
+import pandas as pd
+
+# Add parent directory to path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from histocc.dataloader import ColumnarRecords
+from histocc.formatter import hisco_blocky5
+
+
+class TestColumnarRecords(unittest.TestCase):
+    target_cols = ['code1', 'code2', 'code3', 'code4', 'code5']
+
+    def setUp(self):
+        self.frame = pd.DataFrame({
+            'occ1': ['farmer', 'fisherman and farmer', 'nan', ''],
+            'lang': ['en', 'en', 'da', 'unk'],
+            'code1': ['10', '20', '30', '2'],
+            'code2': [np.nan, '10', np.nan, np.nan],
+            'code3': [np.nan] * 4,
+            'code4': [np.nan] * 4,
+            'code5': [np.nan] * 4,
+        })
+        self.records = ColumnarRecords(self.frame, self.target_cols)
+
+    def test_matches_frame(self):
+        self.assertEqual(len(self.records), len(self.frame))
+
+        for item in range(len(self.frame)):
+            record = self.records[item]
+            row = self.frame.iloc[item]
+
+            self.assertEqual(record['occ1'], row.occ1)
+            self.assertEqual(record['lang'], row.lang)
+
+            for col in self.target_cols:
+                if pd.isna(row[col]):
+                    self.assertTrue(pd.isna(record[col]))
+                else:
+                    self.assertEqual(record[col], row[col])
+
+    def test_compact_dtypes(self):
+        self.assertEqual(self.records.lang_codes.dtype, np.int16)
+        self.assertEqual(self.records.target_codes.dtype, np.int16)
+        self.assertEqual(self.records.target_codes.shape, (len(self.frame), len(self.target_cols)))
+
+    def test_transform_label(self):
+        formatter = hisco_blocky5()
+
+        for item in range(len(self.frame)):
+            np.testing.assert_array_equal(
+                formatter.transform_label(self.records[item]),
+                formatter.transform_label(self.frame.iloc[item]),
+            )
+
+    def test_input_lengths(self):
+        expected = [len(f'{lang}[SEP]{occ1}') for lang, occ1 in zip(self.frame.lang, self.frame.occ1)]
+
+        np.testing.assert_array_equal(self.records.input_lengths(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,747 @@
+import unittest
+
+from unittest import mock
+
+from types import SimpleNamespace
+
+import torch
+
+from torch import nn, Tensor
+
+from histocc.formatter import BOS_IDX, EOS_IDX, PAD_IDX, hisco_blocky5
+from histocc.layers import TransformerDecoder
+from histocc.model_assets import Seq2SeqOccCANINE, Seq2SeqMixerOccCANINE
+from histocc.utils.decoder import (
+    greedy_decode,
+    mixer_greedy_decode,
+    full_search_decoder_seq2seq_optimized,
+    full_search_decoder_mixer_optimized,
+    score_candidates,
+    beam_search_decoder,
+    best_first_search_decoder,
+    flat_topk_rerank_decoder_mixer,
+    speculative_mixer_greedy_decode,
+    adaptive_decoder_mixer,
+)
+from histocc.utils.masking import generate_square_subsequent_mask
+from histocc.utils.trie import CompiledTrie, build_trie
+
+
+class _TinyEncoder(nn.Module):
+    ''' Small stand-in for CANINE, such that decoders can be tested without
+    downloading any weights.
+
+    '''
+    def __init__(self, hidden_size: int):
+        super().__init__()
+        self.embedding = nn.Embedding(256, hidden_size)
+
+    def forward(self, input_ids: Tensor, attention_mask: Tensor) -> SimpleNamespace:
+        hidden = self.embedding(input_ids)
+        pooled = (hidden * attention_mask.unsqueeze(-1)).sum(dim=1) / attention_mask.sum(dim=1, keepdim=True)
+
+        return SimpleNamespace(last_hidden_state=hidden, pooler_output=pooled)
+
+
+def _init_tiny(model: Seq2SeqOccCANINE, num_classes: list[int], hidden_size: int):
+    nn.Module.__init__(model)
+
+    model.seq_len = len(num_classes)
+    model.vocab_size = max(num_classes) + 1
+    model.dropout_rate = 0.0
+
+    model.encoder = _TinyEncoder(hidden_size)
+    model.decoder = TransformerDecoder(
+        num_decoder_layers=3,
+        emb_size=hidden_size,
+        nhead=4,
+        vocab_size=model.vocab_size,
+        dim_feedforward=2 * hidden_size,
+        dropout=0.0,
+    )
+
+
+class TinySeq2SeqOccCANINE(Seq2SeqOccCANINE):
+    def __init__(self, num_classes: list[int], hidden_size: int = 32): # pylint: disable=W0231
+        _init_tiny(self, num_classes, hidden_size)
+
+
+class TinySeq2SeqMixerOccCANINE(Seq2SeqMixerOccCANINE):
+    def __init__(self, num_classes: list[int], num_classes_flat: int, hidden_size: int = 32): # pylint: disable=W0231
+        _init_tiny(self, num_classes, hidden_size)
+
+        self.linear_decoder = nn.Linear(hidden_size, num_classes_flat)
+        self.linear_decoder_drop = nn.Dropout(p=0.0)
+
+
+class AbstractTestDecoder(unittest.TestCase):
+    batch_size = 4
+    input_len = 16
+    sample_codes = ['61110', '64100', '61115', '95120', '95190', '-1', '-2']
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+        self.formatter = hisco_blocky5()
+        self.device = torch.device('cpu')
+
+        self.model = TinySeq2SeqOccCANINE(self.formatter.num_classes).eval()
+        self.mixer = TinySeq2SeqMixerOccCANINE(self.formatter.num_classes, num_classes_flat=20).eval()
+
+        self.input_ids = torch.randint(0, 256, (self.batch_size, self.input_len))
+        self.attention_mask = torch.ones(self.batch_size, self.input_len, dtype=torch.long)
+
+        self.codes_list = [self.formatter.transform_label(code)[1:6] for code in self.sample_codes]
+
+        # Peaked next-token distributions, such that sequence probabilities
+        # are not all negligible
+        with torch.no_grad():
+            for model in (self.model, self.mixer):
+                model.decoder.head.weight.mul_(4.0)
+
+    def _assert_probs_close(self, probs: Tensor, reference: Tensor):
+        ''' Compare probabilities relative to their magnitude, as sequence
+        probabilities may be far below any sensible absolute tolerance.
+        '''
+        self.assertTrue(torch.allclose(probs, reference, rtol=1e-4, atol=0.0))
+
+    def _reference_code_probs(self, model: Seq2SeqOccCANINE) -> Tensor:
+        ''' Teacher-forced probability of each code in `self.codes_list`,
+        scored one code at a time.
+        '''
+        memory = model.encode(self.input_ids, self.attention_mask)
+
+        if isinstance(memory, tuple):
+            memory = memory[0]
+
+        probs = []
+
+        for code in self.codes_list:
+            target = torch.tensor([BOS_IDX, *code], dtype=torch.long).repeat(self.batch_size, 1)
+            out = model.decode(
+                memory=memory,
+                target=target[:, :-1],
+                target_mask=generate_square_subsequent_mask(target.size(1) - 1, self.device),
+                target_padding_mask=None,
+            )
+            token_probs = torch.gather(out.softmax(dim=2), 2, target[:, 1:].unsqueeze(2)).squeeze(2)
+            probs.append(token_probs.prod(dim=1))
+
+        return torch.stack(probs, dim=1)
+
+    def _add_mass_outside_trie(self, model: Seq2SeqOccCANINE, trie: CompiledTrie):
+        ''' Put substantial probability on tokens which no code of `trie`
+        uses (e.g., EOS), such that decoders must normalize over the full
+        vocabulary rather than over tokens of the trie only.
+        '''
+        num_tokens = trie.child_table.size(1)
+        self.assertLess(num_tokens, model.vocab_size)
+
+        model.decoder.head.bias[num_tokens:] += 3.0
+
+
+class TestCompiledTrie(AbstractTestDecoder):
+    def test_matches_trie(self):
+        trie = CompiledTrie(self.codes_list)
+
+        self.assertEqual(len(trie), build_trie(self.codes_list).count_nodes())
+        self.assertEqual(trie.max_depth, 5)
+
+        # Path to node at which each code ends spells out that code
+        for code, node in zip(self.codes_list, trie.code_node):
+            self.assertListEqual(trie.prefix[node].tolist(), [int(x) for x in code])
+
+        # Children of each node are contiguous and point back to their parent
+        for node in range(len(trie)):
+            children = range(trie.child_ptr[node], trie.child_ptr[node + 1])
+            self.assertTrue(all(trie.parent[child] == node for child in children))
+
+        # Nodes of each depth are contiguous
+        for depth in range(trie.max_depth + 1):
+            start, end = trie.level(depth)
+            self.assertTrue((trie.depth[start:end] == depth).all())
+
+
+class TestIncrementalDecoding(AbstractTestDecoder):
+    @torch.no_grad()
+    def test_forward_step_matches_forward(self):
+        ''' Logits from feeding one token at a time through the cache should
+        match those of a full teacher-forced pass with a causal mask.
+        '''
+        memory = self.model.encode(self.input_ids, self.attention_mask)
+        target = torch.randint(0, self.model.vocab_size, (self.batch_size, 10))
+        target[:, 0] = BOS_IDX
+
+        out_full = self.model.decode(
+            memory=memory,
+            target=target,
+            target_mask=generate_square_subsequent_mask(target.size(1), self.device),
+            target_padding_mask=None,
+        )
+
+        cache = self.model.init_decoder_cache()
+        out_steps = torch.cat([
+            self.model.decode_incremental(memory, target[:, i:i + 1], cache)
+            for i in range(target.size(1))
+        ], dim=1)
+
+        self.assertTrue(torch.allclose(out_full, out_steps, atol=1e-5))
+
+        # Feeding several new tokens at once should give the same result
+        cache = self.model.init_decoder_cache()
+        out_chunks = torch.cat([
+            self.model.decode_incremental(memory, target[:, :4], cache),
+            self.model.decode_incremental(memory, target[:, 4:], cache),
+        ], dim=1)
+
+        self.assertTrue(torch.allclose(out_full, out_chunks, atol=1e-5))
+
+    @torch.no_grad()
+    def test_precomputed_memory_branches(self):
+        ''' Decoding several branches per observation against precomputed
+        memory should match replicating the memory for each branch.
+        '''
+        num_branches = 3
+
+        memory = self.model.encode(self.input_ids, self.attention_mask)
+        target = torch.randint(0, self.model.vocab_size, (num_branches * self.batch_size, 6))
+        target[:, 0] = BOS_IDX
+
+        out_ref = self.model.decode(
+            memory=memory.repeat(num_branches, 1, 1),
+            target=target,
+            target_mask=generate_square_subsequent_mask(target.size(1), self.device),
+            target_padding_mask=None,
+        )
+        out = self.model.decode_incremental(
+            self.model.precompute_memory(memory).expand(num_branches),
+            target,
+        )
+
+        self.assertTrue(torch.allclose(out_ref, out, atol=1e-5))
+
+    @torch.no_grad()
+    def test_greedy_decode_parity(self):
+        kwargs = {
+            'descr': self.input_ids,
+            'input_attention_mask': self.attention_mask,
+            'device': self.device,
+            'max_len': self.formatter.max_seq_len,
+            'start_symbol': BOS_IDX,
+        }
+
+        seq_ref, prob_ref = greedy_decode(self.model, use_cache=False, **kwargs)
+        seq, prob = greedy_decode(self.model, use_cache=True, **kwargs)
+
+        self.assertTrue(torch.equal(seq, seq_ref))
+        self._assert_probs_close(prob, prob_ref)
+
+        seq_ref, prob_ref, *linear_ref = mixer_greedy_decode(self.mixer, use_cache=False, **kwargs)
+        seq, prob, *linear = mixer_greedy_decode(self.mixer, use_cache=True, **kwargs)
+
+        self.assertTrue(torch.equal(seq, seq_ref))
+        self._assert_probs_close(prob, prob_ref)
+        self.assertTrue(torch.equal(linear[0], linear_ref[0]))
+
+    @torch.no_grad()
+    def test_greedy_decode_early_stopping(self):
+        ''' Early stopping should not change the output of greedy decoding
+        without a cache, whether or not rows start a padding block and
+        whether or not greedy decoding continues with padding after it.
+        '''
+        kwargs = {
+            'descr': self.input_ids,
+            'input_attention_mask': self.attention_mask,
+            'device': self.device,
+            'max_len': self.formatter.max_seq_len,
+            'start_symbol': BOS_IDX,
+        }
+        block_size = self.formatter.block_size
+
+        for pad_bias in (0.0, -1e4, 1e4):
+            self.model.decoder.head.bias[PAD_IDX] = pad_bias
+            seq_ref, prob_ref = greedy_decode(self.model, use_cache=False, **kwargs)
+
+            for use_cache in (True, False):
+                with self.subTest(pad_bias=pad_bias, use_cache=use_cache):
+                    seq, prob = greedy_decode(
+                        self.model, use_cache=use_cache, early_stopping_block_size=block_size, **kwargs,
+                    )
+
+                    self.assertTrue(torch.equal(seq, seq_ref))
+                    self._assert_probs_close(prob, prob_ref)
+
+    @torch.no_grad()
+    def test_greedy_decode_early_stopping_terminates(self):
+        ''' Once all rows start a padding block and greedy decoding would
+        continue with padding, the rest should be verified in one call.
+        Here the padding is PAD up to and including the last position.
+        '''
+        kwargs = {
+            'descr': self.input_ids,
+            'input_attention_mask': self.attention_mask,
+            'device': self.device,
+            'max_len': self.formatter.max_seq_len,
+            'start_symbol': BOS_IDX,
+        }
+        self.model.decoder.head.bias[PAD_IDX] = 1e4
+
+        seq_ref, prob_ref = greedy_decode(self.model, use_cache=False, **kwargs)
+
+        num_calls = 0
+        decode_incremental = self.model.decode_incremental
+
+        def counting_decode_incremental(*args, **kwargs):
+            nonlocal num_calls
+            num_calls += 1
+            return decode_incremental(*args, **kwargs)
+
+        with mock.patch('histocc.utils.decoder.EOS_IDX', PAD_IDX), \
+                mock.patch.object(self.model, 'decode_incremental', counting_decode_incremental):
+            seq, prob = greedy_decode(self.model, early_stopping_block_size=self.formatter.block_size, **kwargs)
+
+        self.assertEqual(num_calls, 2)
+        self.assertTrue(torch.equal(seq, seq_ref))
+        self._assert_probs_close(prob, prob_ref)
+
+
+class TestMemoryPadding(AbstractTestDecoder):
+    lengths = [16, 10, 5, 12]
+
+    def setUp(self):
+        super().setUp()
+
+        # Right-padded inputs of different lengths, none as long as the input
+        self.input_len = 20
+        self.input_ids = torch.randint(0, 256, (self.batch_size, self.input_len))
+        self.attention_mask = (torch.arange(self.input_len) < torch.tensor(self.lengths).unsqueeze(1)).long()
+
+    @torch.no_grad()
+    def test_matches_unpadded(self):
+        ''' Decoding a padded batch with its attention mask should match
+        decoding each observation on its own without any padding.
+        '''
+        memory = self.model.encode(self.input_ids, self.attention_mask)
+        target = torch.randint(0, self.model.vocab_size, (self.batch_size, 6))
+        target[:, 0] = BOS_IDX
+        target_mask = generate_square_subsequent_mask(target.size(1), self.device)
+
+        out = self.model.decode(memory, target, target_mask, None, self.attention_mask)
+        out_incremental = self.model.decode_incremental(
+            self.model.precompute_memory(memory, self.attention_mask), target,
+        )
+
+        for row, length in enumerate(self.lengths):
+            out_ref = self.model.decode(memory[row:row + 1, :length], target[row:row + 1], target_mask, None)
+
+            self.assertTrue(torch.allclose(out[row:row + 1], out_ref, atol=1e-5))
+            self.assertTrue(torch.allclose(out_incremental[row:row + 1], out_ref, atol=1e-5))
+
+    @torch.no_grad()
+    def test_padding_does_not_affect_decoding(self):
+        kwargs = {
+            'input_attention_mask': self.attention_mask,
+            'device': self.device,
+            'max_len': self.formatter.max_seq_len,
+            'start_symbol': BOS_IDX,
+        }
+        input_ids_other_padding = self.input_ids.masked_fill(self.attention_mask == 0, 0)
+
+        seq_ref, prob_ref = greedy_decode(self.model, descr=self.input_ids, use_cache=False, **kwargs)
+        seq, prob = greedy_decode(self.model, descr=input_ids_other_padding, **kwargs)
+
+        self.assertTrue(torch.equal(seq, seq_ref))
+        self._assert_probs_close(prob, prob_ref)
+
+        del kwargs['max_len']
+        results_ref = full_search_decoder_seq2seq_optimized(
+            self.model, self.input_ids, codes_list=self.codes_list, **kwargs,
+        )
+        results = full_search_decoder_seq2seq_optimized(
+            self.model, input_ids_other_padding, codes_list=self.codes_list, **kwargs,
+        )
+
+        self._assert_probs_close(results, results_ref)
+
+
+class TestSpeculativeDecoding(AbstractTestDecoder):
+    def _check_parity(self, drafts: Tensor, **kwargs):
+        kwargs = {
+            'descr': self.input_ids,
+            'input_attention_mask': self.attention_mask,
+            'device': self.device,
+            'max_len': self.formatter.max_seq_len,
+            'start_symbol': BOS_IDX,
+            **kwargs,
+        }
+
+        ref = mixer_greedy_decode(self.mixer, **kwargs)
+        out = speculative_mixer_greedy_decode(self.mixer, drafts=drafts, **kwargs)
+
+        self.assertTrue(torch.equal(out[0], ref[0]))
+        self._assert_probs_close(out[1], ref[1])
+        self.assertTrue(torch.equal(out[2], ref[2]))
+
+    @torch.no_grad()
+    def test_matches_greedy(self):
+        seq_ref, *_ = mixer_greedy_decode(
+            self.mixer,
+            descr=self.input_ids,
+            input_attention_mask=self.attention_mask,
+            device=self.device,
+            max_len=self.formatter.max_seq_len,
+            start_symbol=BOS_IDX,
+        )
+
+        # Drafts which are wrong from the start, and drafts which are right
+        # for (at least) the first observation
+        wrong_drafts = torch.stack([
+            torch.from_numpy(self.formatter.transform_label(self.sample_codes[i % len(self.sample_codes)])).long()
+            for i in range(20)
+        ])
+        right_drafts = seq_ref[:1].repeat(20, 1)
+
+        for drafts in (wrong_drafts, right_drafts):
+            for block_size in (None, self.formatter.block_size):
+                with self.subTest(block_size=block_size):
+                    self._check_parity(drafts, early_stopping_block_size=block_size)
+
+        # Every row starts a padding block right away
+        self.mixer.decoder.head.bias[PAD_IDX] = 1e4
+        self._check_parity(wrong_drafts, early_stopping_block_size=self.formatter.block_size)
+
+    @torch.no_grad()
+    def test_token_equality_peaked(self):
+        ''' On a strongly peaked model (no near-ties between tokens), the
+        speculative decoder should return exactly the tokens of greedy
+        decoding, for drafts which are right, partly right, and wrong.
+        '''
+        self.mixer.decoder.head.weight.mul_(5.0)
+
+        batch_size = 32
+        self.input_ids = torch.randint(0, 256, (batch_size, self.input_len))
+        self.attention_mask = torch.ones(batch_size, self.input_len, dtype=torch.long)
+
+        kwargs = {
+            'descr': self.input_ids,
+            'input_attention_mask': self.attention_mask,
+            'device': self.device,
+            'max_len': self.formatter.max_seq_len,
+            'start_symbol': BOS_IDX,
+        }
+        seq_ref, prob_ref, linear_ref, _ = mixer_greedy_decode(self.mixer, **kwargs)
+
+        # Draft of the top-1 flat class of row i is the greedy output of row
+        # i, with the later half of the drafts corrupted from position 3
+        drafts = torch.stack([
+            torch.from_numpy(self.formatter.transform_label(self.sample_codes[i % len(self.sample_codes)])).long()
+            for i in range(20)
+        ])
+        top1 = linear_ref[:, 0]
+        drafts[top1] = seq_ref
+        corrupt = top1[batch_size // 2:]
+        drafts[corrupt, 3:-1] = (drafts[corrupt, 3:-1] + 1) % self.mixer.vocab_size
+
+        seq, prob, linear, _ = speculative_mixer_greedy_decode(self.mixer, drafts=drafts, **kwargs)
+
+        self.assertTrue(torch.equal(seq, seq_ref))
+        self.assertTrue(torch.equal(linear, linear_ref))
+        self._assert_probs_close(prob, prob_ref)
+
+
+class TestFullSearchDecoding(AbstractTestDecoder):
+    @torch.no_grad()
+    def test_full_search_matches_reference(self):
+        for model, decoder in (
+            (self.model, full_search_decoder_seq2seq_optimized),
+            (self.mixer, full_search_decoder_mixer_optimized),
+        ):
+            reference = self._reference_code_probs(model)
+
+            # Large chunks (one call per depth) and one node per call
+            for max_rows_per_call in (4096, self.batch_size):
+                with self.subTest(decoder=decoder.__name__, max_rows_per_call=max_rows_per_call):
+                    results = decoder(
+                        model=model,
+                        descr=self.input_ids,
+                        input_attention_mask=self.attention_mask,
+                        device=self.device,
+                        codes_list=self.codes_list,
+                        start_symbol=BOS_IDX,
+                        max_rows_per_call=max_rows_per_call,
+                    )
+
+                    self.assertEqual(results.shape, reference.shape)
+                    self._assert_probs_close(results, reference)
+
+
+class TestBeamSearchDecoding(AbstractTestDecoder):
+    @torch.no_grad()
+    def test_beam_search(self):
+        trie = CompiledTrie(self.codes_list)
+
+        for model in (self.model, self.mixer):
+            reference = self._reference_code_probs(model)
+
+            # A beam at least as wide as the number of codes is exhaustive
+            with self.subTest(model=type(model).__name__, beam_width='exhaustive'):
+                results = beam_search_decoder(
+                    model=model,
+                    descr=self.input_ids,
+                    input_attention_mask=self.attention_mask,
+                    device=self.device,
+                    trie=trie,
+                    start_symbol=BOS_IDX,
+                    beam_width=len(self.codes_list),
+                )
+
+                self.assertEqual(results.shape, reference.shape)
+                self._assert_probs_close(results, reference)
+
+            # Narrower beams only return valid codes, with exact probabilities
+            for beam_width in (1, 2):
+                with self.subTest(model=type(model).__name__, beam_width=beam_width):
+                    results = beam_search_decoder(
+                        model=model,
+                        descr=self.input_ids,
+                        input_attention_mask=self.attention_mask,
+                        device=self.device,
+                        trie=trie,
+                        start_symbol=BOS_IDX,
+                        beam_width=beam_width,
+                    )
+                    found = results > 0
+
+                    self.assertTrue((found.sum(dim=1) == beam_width).all())
+                    self._assert_probs_close(results[found], reference[found])
+
+    @torch.no_grad()
+    def test_normalizes_over_full_vocabulary(self):
+        trie = CompiledTrie(self.codes_list)
+        self._add_mass_outside_trie(self.model, trie)
+        reference = self._reference_code_probs(self.model)
+
+        results = beam_search_decoder(
+            model=self.model,
+            descr=self.input_ids,
+            input_attention_mask=self.attention_mask,
+            device=self.device,
+            trie=trie,
+            start_symbol=BOS_IDX,
+            beam_width=len(self.codes_list),
+        )
+
+        self._assert_probs_close(results, reference)
+
+
+class TestBestFirstSearchDecoding(AbstractTestDecoder):
+    @torch.no_grad()
+    def test_matches_full_search_topk(self):
+        trie = CompiledTrie(self.codes_list)
+
+        for model in (self.model, self.mixer):
+            reference = self._reference_code_probs(model)
+
+            for topk, nodes_per_step in ((1, 1), (3, 1), (3, 4), (len(self.codes_list), 8)):
+                with self.subTest(model=type(model).__name__, topk=topk, nodes_per_step=nodes_per_step):
+                    results = best_first_search_decoder(
+                        model=model,
+                        descr=self.input_ids,
+                        input_attention_mask=self.attention_mask,
+                        device=self.device,
+                        trie=trie,
+                        start_symbol=BOS_IDX,
+                        topk=topk,
+                        nodes_per_step=nodes_per_step,
+                    )
+
+                    ref_probs, ref_codes = reference.topk(topk, dim=1)
+                    probs, codes = results.topk(topk, dim=1)
+
+                    self.assertTrue(torch.equal(codes, ref_codes))
+                    self._assert_probs_close(probs, ref_probs)
+                    self.assertTrue(((results > 0).sum(dim=1) == topk).all())
+
+    @torch.no_grad()
+    def test_normalizes_over_full_vocabulary(self):
+        trie = CompiledTrie(self.codes_list)
+        self._add_mass_outside_trie(self.model, trie)
+        reference = self._reference_code_probs(self.model)
+        topk = 3
+
+        results = best_first_search_decoder(
+            model=self.model,
+            descr=self.input_ids,
+            input_attention_mask=self.attention_mask,
+            device=self.device,
+            trie=trie,
+            start_symbol=BOS_IDX,
+            topk=topk,
+        )
+
+        ref_probs, ref_codes = reference.topk(topk, dim=1)
+        probs, codes = results.topk(topk, dim=1)
+
+        self.assertTrue(torch.equal(codes, ref_codes))
+        self._assert_probs_close(probs, ref_probs)
+
+
+class TestRerankDecoding(AbstractTestDecoder):
+    @torch.no_grad()
+    def test_matches_full_search_on_candidates(self):
+        trie = CompiledTrie(self.codes_list)
+        reference = self._reference_code_probs(self.mixer)
+
+        for topk in (3, len(self.codes_list)):
+            with self.subTest(topk=topk):
+                results = flat_topk_rerank_decoder_mixer(
+                    model=self.mixer,
+                    descr=self.input_ids,
+                    input_attention_mask=self.attention_mask,
+                    device=self.device,
+                    trie=trie,
+                    start_symbol=BOS_IDX,
+                    topk=topk,
+                )
+                found = results > 0
+
+                self.assertEqual(results.shape, reference.shape)
+                self.assertTrue((found.sum(dim=1) == topk).all())
+                self._assert_probs_close(results[found], reference[found])
+
+
+class TestAdaptiveDecoding(AbstractTestDecoder):
+    @torch.no_grad()
+    def test_routing(self):
+        trie = CompiledTrie(self.codes_list)
+        reference = self._reference_code_probs(self.mixer)
+
+        kwargs = {
+            'model': self.mixer,
+            'descr': self.input_ids,
+            'input_attention_mask': self.attention_mask,
+            'device': self.device,
+            'trie': trie,
+            'start_symbol': BOS_IDX,
+        }
+
+        # Nothing routed, i.e., flat head only
+        _, pooled_memory = self.mixer.encode(self.input_ids, self.attention_mask)
+        flat_probs = torch.sigmoid(self.mixer.linear_decoder(pooled_memory))[:, :len(self.codes_list)]
+
+        probs, routed = adaptive_decoder_mixer(min_conf=0.0, **kwargs)
+
+        self.assertFalse(routed.any())
+        self.assertTrue(torch.allclose(probs, flat_probs))
+
+        # Everything routed, i.e., seq2seq decoder only
+        probs, routed = adaptive_decoder_mixer(min_conf=1.1, **kwargs)
+
+        self.assertTrue(routed.all())
+        self._assert_probs_close(probs, reference)
+
+        probs, routed = adaptive_decoder_mixer(min_conf=1.1, fallback='beam', beam_width=2, **kwargs)
+        beam_probs = beam_search_decoder(beam_width=2, **kwargs)
+
+        self._assert_probs_close(probs, beam_probs)
+
+        # Some routed, based on margin
+        top2 = flat_probs.topk(2, dim=1).values
+        margin = top2[:, 0] - top2[:, 1]
+        min_margin = float(margin.median())
+
+        probs, routed = adaptive_decoder_mixer(min_conf=0.0, min_margin=min_margin, **kwargs)
+
+        self.assertTrue(torch.equal(routed, margin < min_margin))
+        self._assert_probs_close(probs[routed], reference[routed])
+        self.assertTrue(torch.allclose(probs[~routed], flat_probs[~routed]))
+
+    @torch.no_grad()
+    def test_greedy_fallback(self):
+        ''' Routed observations should get the probability of their greedy
+        sequence for the codes it contains, and confident ones should keep
+        their flat probabilities, in input order.
+        '''
+        trie = CompiledTrie(self.codes_list)
+        kwargs = {
+            'model': self.mixer,
+            'descr': self.input_ids,
+            'input_attention_mask': self.attention_mask,
+            'device': self.device,
+            'start_symbol': BOS_IDX,
+        }
+
+        seq, prob_seq, _, _ = mixer_greedy_decode(max_len=self.formatter.max_seq_len, **kwargs)
+        seq_probs = prob_seq.float().prod(dim=1)
+
+        _, pooled_memory = self.mixer.encode(self.input_ids, self.attention_mask)
+        flat_probs = torch.sigmoid(self.mixer.linear_decoder(pooled_memory))[:, :len(self.codes_list)]
+        min_conf = float(flat_probs.max(dim=1).values.median())
+
+        probs, routed = adaptive_decoder_mixer(
+            trie=trie,
+            min_conf=min_conf,
+            fallback='greedy',
+            max_len=self.formatter.max_seq_len,
+            **kwargs,
+        )
+
+        self.assertTrue(routed.any())
+        self.assertFalse(routed.all())
+        self.assertTrue(torch.allclose(probs[~routed], flat_probs[~routed]))
+
+        block_size = self.formatter.block_size
+
+        for row in routed.nonzero().squeeze(1).tolist():
+            blocks = seq[row, 1:-1].view(-1, block_size).tolist()
+            expected = torch.zeros(len(self.codes_list))
+
+            for idx, code in enumerate(self.codes_list):
+                if list(code) in blocks:
+                    expected[idx] = seq_probs[row]
+
+            self._assert_probs_close(probs[row], expected)
+
+        with self.assertRaises(ValueError):
+            adaptive_decoder_mixer(trie=trie, min_conf=1.1, fallback='greedy', **kwargs)
+
+
+class TestScoreCandidates(AbstractTestDecoder):
+    @torch.no_grad()
+    def test_matches_reference(self):
+        ''' Scoring every code for every observation in flattened calls should
+        match scoring one code at a time, also when reusing the memory
+        returned by greedy decoding.
+        '''
+        reference = self._reference_code_probs(self.model)
+
+        _, _, memory = greedy_decode(
+            self.model,
+            descr=self.input_ids,
+            input_attention_mask=self.attention_mask,
+            device=self.device,
+            max_len=self.formatter.max_seq_len,
+            start_symbol=BOS_IDX,
+            return_memory=True,
+        )
+
+        num_codes = len(self.codes_list)
+        row_index = torch.arange(self.batch_size).repeat_interleave(num_codes)
+        candidates = torch.tensor(self.codes_list, dtype=torch.long).repeat(self.batch_size, 1)
+
+        for max_rows_per_call in (4096, 3):
+            with self.subTest(max_rows_per_call=max_rows_per_call):
+                probs = score_candidates(
+                    model=self.model,
+                    memory=memory,
+                    row_index=row_index,
+                    candidates=candidates,
+                    start_symbol=BOS_IDX,
+                    max_rows_per_call=max_rows_per_call,
+                )
+
+                self._assert_probs_close(probs.view(self.batch_size, num_codes), reference)
+
+
+if __name__ == '__main__':
+    unittest.main()
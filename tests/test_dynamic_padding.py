@@ -0,0 +1,226 @@
+"""
+Test dynamic padding collate function and length-bucketed batch sampler.
+"""
+import unittest
+import sys
+import os
+
+import numpy as np
+import torch
+
+from torch import nn
+from transformers import CanineConfig, CanineModel
+
+# Add parent directory to path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from histocc.dataloader import (
+    CANINE_DOWNSAMPLING_RATE,
+    CANINE_PADDING_MARGIN,
+    LengthBucketBatchSampler,
+    dynamic_padding_collate,
+    trim_padding,
+)
+from histocc.formatter import BOS_IDX, hisco_blocky5
+from histocc.layers import TransformerDecoder
+from histocc.model_assets import Seq2SeqOccCANINE
+from histocc.utils.masking import generate_square_subsequent_mask
+
+
+def _item(length: int, max_len: int = 16) -> dict:
+    attention_mask = torch.zeros(max_len, dtype=torch.long)
+    attention_mask[:length] = 1
+    input_ids = torch.arange(1, max_len + 1) * attention_mask
+
+    return {'occ1': 'x' * length, 'input_ids': input_ids, 'attention_mask': attention_mask}
+
+
+class TinyCanineSeq2SeqOccCANINE(Seq2SeqOccCANINE):
+    ''' Seq2seq model with a small, randomly initialized CANINE encoder, such
+    that the effect of padding on CANINE can be tested without downloading
+    any weights.
+
+    '''
+    def __init__(self, num_classes: list[int], hidden_size: int = 32): # pylint: disable=W0231
+        nn.Module.__init__(self)
+
+        self.seq_len = len(num_classes)
+        self.vocab_size = max(num_classes) + 1
+        self.dropout_rate = 0.0
+
+        self.encoder = CanineModel(CanineConfig(
+            hidden_size=hidden_size,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            intermediate_size=2 * hidden_size,
+            hidden_dropout_prob=0.0,
+            attention_probs_dropout_prob=0.0,
+            max_position_embeddings=256,
+            num_hash_functions=4,
+            num_hash_buckets=256,
+            downsampling_rate=CANINE_DOWNSAMPLING_RATE,
+            upsampling_kernel_size=4,
+        ))
+        self.decoder = TransformerDecoder(
+            num_decoder_layers=2,
+            emb_size=hidden_size,
+            nhead=4,
+            vocab_size=self.vocab_size,
+            dim_feedforward=2 * hidden_size,
+            dropout=0.0,
+        )
+
+
+class TestDynamicPadding(unittest.TestCase):
+    def test_pads_to_multiple_of_longest(self):
+        batch = dynamic_padding_collate([_item(3), _item(6), _item(2)], margin=0)
+
+        self.assertEqual(batch['input_ids'].shape, (3, 8))
+        self.assertEqual(batch['attention_mask'].shape, (3, 8))
+        self.assertEqual(batch['attention_mask'].sum().item(), 11)
+        self.assertEqual(batch['occ1'], ['xxx', 'xxxxxx', 'xx'])
+
+    def test_keeps_real_tokens(self):
+        items = [_item(5), _item(9)]
+        full = dynamic_padding_collate(items, pad_multiple=1, margin=0)
+        reference = torch.stack([item['input_ids'] for item in items])
+
+        torch.testing.assert_close(full['input_ids'], reference[:, :9])
+
+    def test_keeps_margin(self):
+        batch = dynamic_padding_collate([_item(8, max_len=32), _item(3, max_len=32)])
+
+        self.assertEqual(batch['input_ids'].shape, (2, 16))
+        self.assertGreaterEqual(batch['input_ids'].shape[1] - 8, CANINE_PADDING_MARGIN)
+
+    def test_never_longer_than_input(self):
+        batch = trim_padding({
+            'input_ids': torch.ones(2, 10, dtype=torch.long),
+            'attention_mask': torch.ones(2, 10, dtype=torch.long),
+        })
+
+        self.assertEqual(batch['input_ids'].shape, (2, 10))
+
+
+class TestCaninePaddingInvariance(unittest.TestCase):
+    full_len = 64
+    lengths = [5, 11, 16, 3, 14] # Longest is a multiple of the downsampling rate
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+        self.formatter = hisco_blocky5()
+        self.model = TinyCanineSeq2SeqOccCANINE(self.formatter.num_classes).eval()
+
+        self.attention_mask = (torch.arange(self.full_len) < torch.tensor(self.lengths).unsqueeze(1)).long()
+        self.input_ids = torch.randint(1, 1000, (len(self.lengths), self.full_len)) * self.attention_mask
+
+        self.target = torch.randint(0, self.model.vocab_size, (len(self.lengths), 6))
+        self.target[:, 0] = BOS_IDX
+
+    def _forward(self, batch: dict[str, torch.Tensor]) -> tuple[torch.Tensor, torch.Tensor]:
+        memory = self.model.encode(batch['input_ids'], batch['attention_mask'])
+        logits = self.model.decode(
+            memory=memory,
+            target=self.target,
+            target_mask=generate_square_subsequent_mask(self.target.size(1), torch.device('cpu')),
+            target_padding_mask=None,
+            attention_mask=batch['attention_mask'],
+        )
+
+        return memory, logits
+
+    @torch.no_grad()
+    def test_outputs_unchanged_at_real_positions(self):
+        ''' Encoder outputs at real positions, and hence decoder logits, of
+        a dynamically padded batch should match those of the fully padded
+        batch.
+        '''
+        full = {'input_ids': self.input_ids, 'attention_mask': self.attention_mask}
+        trimmed = trim_padding(dict(full))
+
+        self.assertLess(trimmed['input_ids'].shape[1], self.full_len)
+
+        memory_full, logits_full = self._forward(full)
+        memory_trimmed, logits_trimmed = self._forward(trimmed)
+
+        for row, length in enumerate(self.lengths):
+            torch.testing.assert_close(memory_trimmed[row, :length], memory_full[row, :length], rtol=1e-4, atol=1e-5)
+
+        torch.testing.assert_close(logits_trimmed, logits_full, rtol=1e-4, atol=1e-5)
+
+
+class TestLengthBucketBatchSampler(unittest.TestCase):
+    lengths = np.random.default_rng(0).integers(5, 60, size=103)
+
+    def test_sorted_without_shuffle(self):
+        sampler = LengthBucketBatchSampler(self.lengths, batch_size=10)
+        batches = list(sampler)
+
+        self.assertEqual(len(batches), len(sampler))
+        self.assertTrue(np.all(np.diff(self.lengths[sampler.order()]) >= 0))
+        np.testing.assert_array_equal(np.sort(sampler.order()), np.arange(len(self.lengths)))
+
+    def test_restore_order(self):
+        sampler = LengthBucketBatchSampler(self.lengths, batch_size=10)
+        order = sampler.order()
+
+        # Outputs produced in sampler order mapped back to dataset order
+        outputs = self.lengths[order]
+        np.testing.assert_array_equal(outputs[np.argsort(order)], self.lengths)
+
+    def test_shuffle_depends_on_epoch(self):
+        sampler = LengthBucketBatchSampler(self.lengths, batch_size=10, shuffle=True, bucket_size_multiplier=2)
+
+        sampler.set_epoch(0)
+        order_0 = sampler.order()
+        sampler.set_epoch(1)
+        order_1 = sampler.order()
+
+        np.testing.assert_array_equal(np.sort(order_0), np.arange(len(self.lengths)))
+        np.testing.assert_array_equal(np.sort(order_1), np.arange(len(self.lengths)))
+        self.assertFalse(np.array_equal(order_0, order_1))
+
+    def test_drop_last(self):
+        sampler = LengthBucketBatchSampler(self.lengths, batch_size=10, shuffle=True, drop_last=True)
+        batches = list(sampler)
+
+        self.assertEqual(len(batches), len(sampler))
+        self.assertTrue(all(len(batch) == 10 for batch in batches))
+
+    def test_shards_across_ranks(self):
+        samplers = [
+            LengthBucketBatchSampler(self.lengths, batch_size=10, num_replicas=3, rank=rank)
+            for rank in range(3)
+        ]
+        batches = [list(sampler) for sampler in samplers]
+
+        for sampler, rank_batches in zip(samplers, batches):
+            self.assertEqual(len(rank_batches), len(sampler))
+
+        # Every rank gets the same number of batches and all indices are covered
+        self.assertEqual(len({len(rank_batches) for rank_batches in batches}), 1)
+        covered = np.unique(np.concatenate([sampler.order() for sampler in samplers]))
+        np.testing.assert_array_equal(covered, np.arange(len(self.lengths)))
+
+    def test_sharded(self):
+        ''' Batches of data held by this rank only, repeated up to the number
+        of batches shared by all ranks
+        '''
+        sampler = LengthBucketBatchSampler(self.lengths, batch_size=10, shuffle=True, sharded=True)
+        self.assertEqual(len(list(sampler)), len(sampler))
+        np.testing.assert_array_equal(np.sort(sampler.order()), np.arange(len(self.lengths)))
+
+        # As if another rank holds a larger shard
+        sampler.num_shard_batches = 25
+        batches = list(sampler)
+
+        self.assertEqual(len(batches), 25)
+        self.assertTrue(all(np.array_equal(a, b) for a, b in zip(batches[:11], batches[11:22])))
+
+        with self.assertRaises(ValueError):
+            LengthBucketBatchSampler(self.lengths, batch_size=10, sharded=True, num_replicas=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
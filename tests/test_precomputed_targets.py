@@ -0,0 +1,125 @@
+"""
+Test that targets precomputed by the mixer dataset match per-sample encoding.
+"""
+import unittest
+import sys
+import os
+import glob
+import tempfile
+
+import numpy as np
+import pandas as pd
+import torch
+
+from transformers import CanineTokenizer
+
+# Add parent directory to path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from histocc.dataloader import OccDatasetMixerInMemMultipleFiles
+from histocc.formatter import hisco_blocky5
+from histocc.utils import multi_hot
+
+
+class TestPrecomputedTargets(unittest.TestCase):
+    num_classes_flat = 2000
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.formatter = hisco_blocky5()
+        self.tokenizer = CanineTokenizer()
+
+        self.frames = [
+            pd.DataFrame({
+                'occ1': ['farmer', 'fisherman and farmer', 'farmer'],
+                'lang': ['en', 'en', 'da'],
+                'code1': ['10', '20', '10'],
+                'code2': [np.nan, '10', np.nan],
+                'code3': [np.nan] * 3,
+                'code4': [np.nan] * 3,
+                'code5': [np.nan] * 3,
+            }),
+            pd.DataFrame({
+                'occ1': ['smith', 'nan'],
+                'lang': ['de', 'unk'],
+                'code1': ['30', '2'],
+                'code2': ['20', np.nan],
+                'code3': ['10', np.nan],
+                'code4': [np.nan] * 2,
+                'code5': [np.nan] * 2,
+            }),
+        ]
+        self.fnames = []
+
+        for i, frame in enumerate(self.frames):
+            fname = os.path.join(self.tmpdir.name, f'data_{i}.csv')
+            frame.to_csv(fname, index=False)
+            self.fnames.append(fname)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _dataset(self, **kwargs) -> OccDatasetMixerInMemMultipleFiles:
+        return OccDatasetMixerInMemMultipleFiles(
+            fnames_data=self.fnames,
+            formatter=self.formatter,
+            tokenizer=self.tokenizer,
+            max_input_len=32,
+            num_classes_flat=self.num_classes_flat,
+            training=False,
+            **kwargs,
+        )
+
+    def test_matches_per_sample_encoding(self):
+        dataset = self._dataset()
+        frame = pd.concat(self.frames)
+
+        self.assertEqual(dataset.targets_seq2seq.dtype, np.uint8)
+        self.assertEqual(dataset.targets_seq2seq.shape, (len(frame), self.formatter.max_seq_len))
+        self.assertEqual(dataset.targets_linear.shape, (len(frame), 5))
+
+        for item in range(len(frame)):
+            row = frame.iloc[item]
+            sample = dataset[item]
+
+            np.testing.assert_array_equal(
+                sample['targets_seq2seq'].numpy(),
+                self.formatter.transform_label(row),
+            )
+            np.testing.assert_array_equal(
+                multi_hot(sample['targets_linear_indices'][None], self.num_classes_flat)[0].numpy(),
+                dataset._get_target_linear(row), # pylint: disable=W0212
+            )
+
+    def test_cache(self):
+        dataset = self._dataset(cache_targets=True)
+        cache_files = glob.glob(os.path.join(self.tmpdir.name, '*.targets-*.npz'))
+
+        self.assertEqual(len(cache_files), len(self.fnames))
+
+        cached = self._dataset(cache_targets=True)
+
+        np.testing.assert_array_equal(cached.targets_seq2seq, dataset.targets_seq2seq)
+        np.testing.assert_array_equal(cached.targets_linear, dataset.targets_linear)
+
+
+class TestMultiHot(unittest.TestCase):
+    def test_expands_padded_indices(self):
+        indices = torch.tensor([
+            [3, -1, -1],
+            [0, 4, -1],
+            [-1, -1, -1],
+            [2, 2, 1], # duplicates
+        ])
+        expected = torch.tensor([
+            [0, 0, 0, 1, 0],
+            [1, 0, 0, 0, 1],
+            [0, 0, 0, 0, 0],
+            [0, 1, 1, 0, 0],
+        ], dtype=torch.float)
+
+        torch.testing.assert_close(multi_hot(indices, 5), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+"""
+Test rank-sharded loading of training data and the accompanying sampler.
+"""
+import unittest
+import sys
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from transformers import CanineTokenizer
+
+# Add parent directory to path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from histocc.dataloader import (
+    OccDatasetMixerInMemMultipleFiles,
+    ShardSampler,
+    _read_data_shard,
+)
+from histocc.formatter import hisco_blocky5
+
+
+class TestReadDataShard(unittest.TestCase):
+    num_replicas = 3
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.frame = pd.DataFrame({
+            'occ1': [f'occupation {i}' for i in range(20)] + ['nan'],
+            'lang': ['en'] * 21,
+            'code1': [str(10 * (i % 4)) for i in range(21)],
+        })
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _check_shards(self, fname: str):
+        shards = [
+            _read_data_shard(
+                fname,
+                num_replicas=self.num_replicas,
+                rank=rank,
+                usecols=['occ1', 'lang', 'code1'],
+                dtype={'lang': str, 'code1': str},
+                converters={'occ1': lambda x: x},
+            )
+            for rank in range(self.num_replicas)
+        ]
+
+        # Shards are disjoint and together make up the data
+        occ1 = sorted(sum((shard['occ1'].tolist() for shard in shards), []))
+        self.assertListEqual(occ1, sorted(self.frame['occ1']))
+
+        return shards
+
+    def test_csv(self):
+        fname = os.path.join(self.tmpdir.name, 'data.csv')
+        self.frame.to_csv(fname, index=False)
+
+        shards = self._check_shards(fname)
+
+        self.assertListEqual([len(shard) for shard in shards], [7, 7, 7])
+        self.assertListEqual(shards[1]['occ1'].tolist(), self.frame['occ1'].iloc[7:14].tolist())
+
+    def test_csv_uneven(self):
+        fname = os.path.join(self.tmpdir.name, 'data.csv')
+        self.frame.iloc[:20].to_csv(fname, index=False)
+
+        shards = [
+            _read_data_shard(fname, num_replicas=self.num_replicas, rank=rank, usecols=['occ1'])
+            for rank in range(self.num_replicas)
+        ]
+
+        self.assertListEqual([len(shard) for shard in shards], [6, 7, 7])
+        self.assertListEqual(
+            sum((shard['occ1'].tolist() for shard in shards), []),
+            self.frame['occ1'].iloc[:20].tolist(),
+        )
+
+    def test_parquet(self):
+        try:
+            import pyarrow # pylint: disable=C0415,W0611
+        except ImportError:
+            self.skipTest('pyarrow not installed')
+
+        fname = os.path.join(self.tmpdir.name, 'data.parquet')
+        self.frame.to_parquet(fname, row_group_size=4, index=False)
+
+        shards = self._check_shards(fname)
+        lengths = [len(shard) for shard in shards]
+
+        self.assertLessEqual(max(lengths) - min(lengths), 4)
+
+    def test_mixer_dataset(self):
+        fname = os.path.join(self.tmpdir.name, 'data.csv')
+        self.frame.assign(code2=np.nan, code3=np.nan, code4=np.nan, code5=np.nan).to_csv(fname, index=False)
+
+        datasets = [
+            OccDatasetMixerInMemMultipleFiles(
+                fnames_data=[fname],
+                formatter=hisco_blocky5(),
+                tokenizer=CanineTokenizer(),
+                max_input_len=32,
+                num_classes_flat=2000,
+                training=False,
+                num_replicas=self.num_replicas,
+                rank=rank,
+            )
+            for rank in range(self.num_replicas)
+        ]
+
+        self.assertEqual(sum(len(dataset) for dataset in datasets), len(self.frame))
+        self.assertListEqual(datasets[2].records.occ1.tolist(), self.frame['occ1'].iloc[14:].tolist())
+
+
+class TestShardSampler(unittest.TestCase):
+    data = list(range(10))
+
+    def test_permutation_per_epoch(self):
+        sampler = ShardSampler(self.data, shuffle=True, seed=1)
+
+        sampler.set_epoch(0)
+        order_0 = list(sampler)
+        sampler.set_epoch(1)
+        order_1 = list(sampler)
+        sampler.set_epoch(0)
+
+        self.assertEqual(len(sampler), len(self.data))
+        self.assertListEqual(sorted(order_0), self.data)
+        self.assertNotEqual(order_0, order_1)
+        self.assertListEqual(list(sampler), order_0)
+
+    def test_common_num_samples(self):
+        sampler = ShardSampler(self.data, shuffle=False)
+
+        # As if another rank holds a larger shard
+        sampler.num_samples = 25
+        indices = list(sampler)
+
+        self.assertEqual(len(indices), 25)
+        self.assertListEqual(indices[:10], self.data)
+        self.assertListEqual(indices[10:20], self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
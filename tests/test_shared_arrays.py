@@ -0,0 +1,80 @@
+"""
+Test shared-memory storage of dataset arrays.
+"""
+import unittest
+import sys
+import os
+import pickle
+import random
+
+import numpy as np
+
+# Add parent directory to path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from histocc.utils.shared import SharedArrays, StringArray
+
+
+class _Arrays(SharedArrays):
+    def __init__(self):
+        self.codes = np.arange(12, dtype=np.int16).reshape(4, 3)
+        self.other = [1, 2, 3]
+        self._share_arrays('codes')
+
+
+class TestStringArray(unittest.TestCase):
+    values = ['farmer', '', 'smith, blacksmith', 'æøå', 'nan', '农民']
+
+    def test_indexing(self):
+        array = StringArray(self.values)
+
+        self.assertEqual(len(array), len(self.values))
+        self.assertListEqual(array.tolist(), self.values)
+        self.assertListEqual(list(array), self.values)
+        self.assertEqual(array[3], 'æøå')
+        self.assertEqual(array[np.int64(-1)], '农民')
+        self.assertListEqual(array[np.array([5, 0, 0])], ['农民', 'farmer', 'farmer'])
+        self.assertIn(random.choice(array), self.values)
+
+        with self.assertRaises(IndexError):
+            array[len(self.values)] # pylint: disable=W0104
+
+    def test_lengths(self):
+        array = StringArray(self.values)
+
+        self.assertListEqual(array.lengths().tolist(), [len(value) for value in self.values])
+
+    def test_shared_memory(self):
+        array = StringArray(self.values)
+
+        for name in ('offsets', 'data'):
+            self.assertTrue(array._shared[name].is_shared()) # pylint: disable=W0212
+
+    def test_pickle(self):
+        array = StringArray(self.values)
+        restored = pickle.loads(pickle.dumps(array))
+
+        self.assertListEqual(restored.tolist(), self.values)
+
+    def test_empty(self):
+        array = StringArray([])
+
+        self.assertEqual(len(array), 0)
+        self.assertListEqual(array[np.array([], dtype=np.int64)], [])
+
+
+class TestSharedArrays(unittest.TestCase):
+    def test_share_and_pickle(self):
+        arrays = _Arrays()
+
+        self.assertIsInstance(arrays.codes, np.ndarray)
+        self.assertEqual(arrays.codes.dtype, np.int16)
+
+        restored = pickle.loads(pickle.dumps(arrays))
+
+        np.testing.assert_array_equal(restored.codes, np.arange(12).reshape(4, 3))
+        self.assertListEqual(restored.other, [1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+"""
+Test streaming of Parquet files through `OccDatasetMixerStreaming`.
+"""
+import unittest
+import sys
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import torch
+
+from transformers import CanineTokenizer
+
+# Add parent directory to path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from histocc.dataloader import OccDatasetMixerStreaming
+from histocc.formatter import hisco_blocky5
+
+
+class TestOccDatasetMixerStreaming(unittest.TestCase):
+    num_rows = [23, 17]
+    row_group_size = 5
+
+    def setUp(self):
+        try:
+            import pyarrow # pylint: disable=C0415,W0611
+        except ImportError:
+            self.skipTest('pyarrow not installed')
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fnames = []
+        self.frames = []
+        codes = ['10', '20', '30', '2']
+
+        for i, num_rows in enumerate(self.num_rows):
+            frame = pd.DataFrame({
+                'occ1': [f'occupation {i} {j}' for j in range(num_rows)],
+                'lang': ['en'] * num_rows,
+                'code1': [codes[j % len(codes)] for j in range(num_rows)],
+                'code2': [codes[0] if j % 3 == 0 else None for j in range(num_rows)],
+                'code3': [None] * num_rows,
+                'code4': [None] * num_rows,
+                'code5': [None] * num_rows,
+            })
+            fname = os.path.join(self.tmpdir.name, f'data_{i}.parquet')
+            frame.to_parquet(fname, row_group_size=self.row_group_size, index=False)
+
+            self.fnames.append(fname)
+            self.frames.append(frame)
+
+        self.frame = pd.concat(self.frames, ignore_index=True)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _dataset(self, **kwargs) -> OccDatasetMixerStreaming:
+        params = {
+            'fnames_data': self.fnames,
+            'formatter': hisco_blocky5(),
+            'tokenizer': CanineTokenizer(),
+            'max_input_len': 32,
+            'num_classes_flat': 2000,
+            'training': False,
+            **kwargs,
+        }
+
+        return OccDatasetMixerStreaming(**params)
+
+    def test_yields_all_rows_in_order(self):
+        dataset = self._dataset()
+        samples = list(dataset)
+        formatter = hisco_blocky5()
+
+        self.assertEqual(len(samples), len(self.frame))
+        self.assertEqual(len(dataset), len(self.frame))
+
+        for sample, (_, row) in zip(samples, self.frame.iterrows()):
+            self.assertEqual(sample['occ1'], f'{row.lang}[SEP]{row.occ1}')
+            np.testing.assert_array_equal(sample['targets_seq2seq'].numpy(), formatter.transform_label(row))
+
+            expected = [int(row.code1)] + ([] if pd.isna(row.code2) else [int(row.code2)])
+            indices = sample['targets_linear_indices']
+            self.assertEqual(indices[indices >= 0].tolist(), expected)
+
+    def test_shuffle_depends_on_epoch(self):
+        dataset = self._dataset(shuffle=True, shuffle_buffer_size=8)
+
+        dataset.set_epoch(0)
+        order_0 = [sample['occ1'] for sample in dataset]
+        dataset.set_epoch(1)
+        order_1 = [sample['occ1'] for sample in dataset]
+
+        self.assertEqual(sorted(order_0), sorted(order_1))
+        self.assertEqual(len(set(order_0)), len(self.frame))
+        self.assertNotEqual(order_0, order_1)
+
+    def test_shards_across_ranks(self):
+        datasets = [self._dataset(shuffle=True, num_replicas=3, rank=rank) for rank in range(3)]
+        samples = [[sample['occ1'] for sample in dataset] for dataset in datasets]
+
+        for dataset, rank_samples in zip(datasets, samples):
+            self.assertEqual(len(rank_samples), len(dataset))
+
+        # Same number of samples on every rank, and no row is seen twice.
+        # Only the remainder of splitting all rows evenly is dropped
+        self.assertEqual(len({len(rank_samples) for rank_samples in samples}), 1)
+        all_samples = sum(samples, [])
+        self.assertEqual(len(all_samples), len(set(all_samples)))
+        self.assertEqual(len(all_samples), len(self.frame) - len(self.frame) % 3)
+
+    def test_splits_across_workers(self):
+        dataset = self._dataset(shuffle=True, num_replicas=2, rank=1)
+        num_workers = 3
+
+        worker_segments = sum((
+            dataset._worker_segments(0, worker_id, num_workers) # pylint: disable=W0212
+            for worker_id in range(num_workers)
+        ), [])
+
+        self.assertEqual(sorted(worker_segments), sorted(dataset._rank_segments(0))) # pylint: disable=W0212
+        self.assertEqual(sum(stop - start for _, start, stop in worker_segments), len(dataset))
+
+    def test_data_loader(self):
+        dataset = self._dataset(shuffle=True, shuffle_buffer_size=4)
+        batches = list(torch.utils.data.DataLoader(dataset, batch_size=8))
+
+        self.assertEqual(sum(len(batch['occ1']) for batch in batches), len(self.frame))
+        self.assertEqual(batches[0]['input_ids'].shape, (8, 32))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+Test that the vectorized CANINE encoder matches `CanineTokenizer.encode_plus`.
+"""
+import unittest
+import sys
+import os
+
+import numpy as np
+
+from transformers import CanineTokenizer
+
+# Add parent directory to path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from histocc.utils.tokenization import (
+    CANINE_CLS,
+    CANINE_SEP,
+    canine_encode,
+    supports_canine_encode,
+)
+
+
+class TestCanineEncode(unittest.TestCase):
+    TEXTS = [
+        'en[SEP]farmer',
+        'unk[SEP]',
+        '',
+        'da[SEP]smed og landmand',
+        'de[SEP]Müller, Bäcker & Schuhmacher',
+        'xx[SEP]\U0001F600 emoji æøå',
+        'no[SEP]' + 'tjenestepike ' * 20, # longer than max_length
+        'se[SEP]a\x00b', # embedded NUL shares the padding id but not the mask
+    ]
+
+    def setUp(self):
+        self.tokenizer = CanineTokenizer()
+
+    def _reference(self, texts: list[str], max_length: int) -> tuple[np.ndarray, np.ndarray]:
+        input_ids, attention_mask = [], []
+
+        for text in texts:
+            encoded = self.tokenizer.encode_plus(
+                text,
+                add_special_tokens=True,
+                padding='max_length',
+                max_length=max_length,
+                return_token_type_ids=False,
+                return_attention_mask=True,
+                truncation=True,
+            )
+            input_ids.append(encoded['input_ids'])
+            attention_mask.append(encoded['attention_mask'])
+
+        return np.array(input_ids), np.array(attention_mask)
+
+    def test_matches_tokenizer(self):
+        for max_length in (2, 3, 16, 128):
+            with self.subTest(max_length=max_length):
+                input_ids, attention_mask = canine_encode(self.TEXTS, max_length)
+                ref_input_ids, ref_attention_mask = self._reference(self.TEXTS, max_length)
+
+                self.assertEqual(input_ids.dtype, np.int32)
+                self.assertEqual(attention_mask.dtype, np.int32)
+                np.testing.assert_array_equal(input_ids, ref_input_ids)
+                np.testing.assert_array_equal(attention_mask, ref_attention_mask)
+
+    def test_special_tokens(self):
+        input_ids, attention_mask = canine_encode(['ab'], 6)
+
+        np.testing.assert_array_equal(input_ids[0], [CANINE_CLS, ord('a'), ord('b'), CANINE_SEP, 0, 0])
+        np.testing.assert_array_equal(attention_mask[0], [1, 1, 1, 1, 0, 0])
+
+    def test_empty_batch(self):
+        input_ids, attention_mask = canine_encode([], 8)
+
+        self.assertEqual(input_ids.shape, (0, 8))
+        self.assertEqual(attention_mask.shape, (0, 8))
+
+    def test_arrow_input(self):
+        try:
+            import pyarrow as pa # pylint: disable=C0415
+        except ImportError:
+            self.skipTest('pyarrow not installed')
+
+        input_ids, attention_mask = canine_encode(pa.array(self.TEXTS), 32)
+        ref_input_ids, ref_attention_mask = canine_encode(self.TEXTS, 32)
+
+        np.testing.assert_array_equal(input_ids, ref_input_ids)
+        np.testing.assert_array_equal(attention_mask, ref_attention_mask)
+
+    def test_supports_canine_encode(self):
+        self.assertTrue(supports_canine_encode(self.tokenizer))
+
+        self.tokenizer.add_tokens(['landmand'])
+        self.assertFalse(supports_canine_encode(self.tokenizer))
+
+
+if __name__ == '__main__':
+    unittest.main()
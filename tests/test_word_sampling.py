@@ -0,0 +1,151 @@
+"""
+Test drawing of random words for insertion by `AttackerClass`.
+"""
+import unittest
+import sys
+import os
+import collections
+import random
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from transformers import CanineTokenizer
+
+# Add parent directory to path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from histocc.attacker import AttackerClass, build_word_freq_table
+from histocc.dataloader import OccDatasetMixerInMemMultipleFiles
+from histocc.formatter import hisco_blocky5
+
+
+class TestWordFreqSampling(unittest.TestCase):
+    word_freq_table = pd.DataFrame({
+        'word': ['farmer', 'nan', 'smith', 'never'],
+        'freq': [6, 3, 1, 0],
+    })
+
+    def test_frequencies(self):
+        random.seed(0)
+        attacker = AttackerClass(word_freq_table=self.word_freq_table)
+        num_draws = 20_000
+
+        counts = collections.Counter(attacker._draw_word() for _ in range(num_draws)) # pylint: disable=W0212
+
+        self.assertNotIn('never', counts)
+        self.assertAlmostEqual(counts['farmer'] / num_draws, 0.6, delta=0.02)
+        self.assertAlmostEqual(counts['nan'] / num_draws, 0.3, delta=0.02)
+        self.assertAlmostEqual(counts['smith'] / num_draws, 0.1, delta=0.02)
+
+    def test_draws_in_blocks(self):
+        attacker = AttackerClass(word_freq_table=self.word_freq_table)
+        attacker.word_block_size = 8
+
+        for _ in range(10):
+            attacker._draw_word() # pylint: disable=W0212
+
+        self.assertEqual(len(attacker._word_block), 8) # pylint: disable=W0212
+        self.assertEqual(attacker._word_block_pos, 2) # pylint: disable=W0212
+
+    def test_reproducible(self):
+        draws = []
+
+        for _ in range(2):
+            random.seed(1)
+            attacker = AttackerClass(word_freq_table=self.word_freq_table)
+            draws.append([attacker._draw_word() for _ in range(50)]) # pylint: disable=W0212
+
+        self.assertListEqual(draws[0], draws[1])
+
+    def test_insert_random_word(self):
+        attacker = AttackerClass(word_freq_table=self.word_freq_table)
+        words = attacker.insert_random_word('fisherman and farmer').split()
+
+        self.assertEqual(len(words), 4)
+
+    def test_negative_freq(self):
+        with self.assertRaises(ValueError):
+            AttackerClass(word_freq_table=pd.DataFrame({'word': ['a', 'b'], 'freq': [1, -1]}))
+
+
+class TestBuildWordFreqTable(unittest.TestCase):
+    texts = ['farmer', 'fisherman and farmer', 'farmer', 'nan']
+
+    def test_counts(self):
+        expected = {'farmer': 3, 'fisherman': 1, 'and': 1, 'nan': 1}
+
+        for texts in (self.texts, pd.Series(self.texts)):
+            table = build_word_freq_table(texts)
+
+            self.assertListEqual(list(table.columns), ['word', 'freq'])
+            self.assertDictEqual(dict(zip(table['word'], table['freq'])), expected)
+
+    def test_attacker_vocabulary(self):
+        attacker = AttackerClass(df=pd.DataFrame({'occ1': self.texts}))
+
+        self.assertListEqual(sorted(attacker.word_list), ['and', 'farmer', 'fisherman', 'nan'])
+        self.assertIsNone(attacker.word_cdf)
+
+
+class TestMixerVocabulary(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fnames = []
+
+        for i in range(2):
+            fname = os.path.join(self.tmpdir.name, f'data_{i}.csv')
+            pd.DataFrame({
+                'occ1': ['farmer', f'fisherman {i}', 'nan'],
+                'lang': ['en'] * 3,
+                'code1': ['10', '20', '30'],
+                'code2': [np.nan] * 3,
+                'code3': [np.nan] * 3,
+                'code4': [np.nan] * 3,
+                'code5': [np.nan] * 3,
+            }).to_csv(fname, index=False)
+            self.fnames.append(fname)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _dataset(self, **kwargs) -> OccDatasetMixerInMemMultipleFiles:
+        params = {
+            'fnames_data': self.fnames,
+            'formatter': hisco_blocky5(),
+            'tokenizer': CanineTokenizer(),
+            'max_input_len': 32,
+            'num_classes_flat': 2000,
+            **kwargs,
+        }
+
+        return OccDatasetMixerInMemMultipleFiles(**params)
+
+    def test_no_vocabulary_when_not_training(self):
+        dataset = self._dataset(training=False)
+
+        self.assertFalse(hasattr(dataset.attacker, 'word_list'))
+
+    def test_cached_word_freq(self):
+        dataset = self._dataset(training=True, cache_word_freq=True)
+        expected = ['0', '1', 'farmer', 'fisherman', 'nan']
+
+        self.assertListEqual(sorted(dataset.attacker.word_list), expected)
+
+        fnames_cache = [dataset._word_freq_cache_fname(fname) for fname in self.fnames] # pylint: disable=W0212
+
+        for fname_cache in fnames_cache:
+            self.assertTrue(os.path.isfile(fname_cache))
+
+        # Usable as --fn-word-freq
+        table = pd.read_csv(fnames_cache[0], converters={'word': lambda x: x})
+        self.assertDictEqual(dict(zip(table['word'], table['freq'])), {'farmer': 1, 'fisherman': 1, '0': 1, 'nan': 1})
+
+        # Second run reads the cached frequencies
+        dataset = self._dataset(training=True, cache_word_freq=True)
+        self.assertListEqual(sorted(dataset.attacker.word_list), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
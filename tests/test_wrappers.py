@@ -3,6 +3,7 @@ import unittest
 
 import torch
 
+import numpy as np
 import pandas as pd
 
 from histocc import OccCANINE, DATASETS
@@ -31,7 +32,7 @@ class AbstractTestWrapperOccCANINE(unittest.TestCase):
         },
         'mix': {
             'pred_type': ['flat', 'greedy', 'full'],
-            'behavior_type': ['fast', 'good'],
+            'behavior_type': ['fast', 'good', 'adaptive'],
         },
     }
 
@@ -96,6 +97,57 @@ class AbstractTestWrapperOccCANINE(unittest.TestCase):
                         sample_outputs,
                     )
 
+        # Test scoring of specific codes, which should match full search for
+        # the most likely codes of each string
+        if 'full' in supported_settings['pred_type']:
+            with self.subTest(msg='Scoring candidates'):
+                probs = wrapper.predict(sample_inputs, prediction_type='full', what='probs')
+                topk = np.argsort(probs, axis=1)[:, ::-1][:, :3]
+                candidates = [[wrapper.key[i] for i in row] for row in topk]
+
+                scores = wrapper.score(sample_inputs, candidates)
+
+                self.assertEqual(len(scores), len(sample_inputs) * 3)
+                self.assertListEqual(list(scores[wrapper.system]), [code for row in candidates for code in row])
+                self.assertTrue(np.allclose(
+                    scores['prob'],
+                    np.take_along_axis(probs, topk, axis=1).reshape(-1),
+                    rtol=1e-4,
+                    atol=0.0,
+                ))
+
+            with self.subTest(msg='Scoring unknown candidates'):
+                with self.assertRaises(ValueError):
+                    wrapper.score(sample_inputs, ['not a code'])
+
+            # Unless all probabilities are requested, full search only
+            # computes the top codes by a best-first search
+            with self.subTest(msg='Full search of top codes'):
+                k_pred = 3
+                pred = wrapper.predict(sample_inputs, prediction_type='full', what='pred', k_pred=k_pred, threshold=0.0)
+
+                for j, column in enumerate(topk.T, start=1):
+                    self.assertListEqual(list(pred[f'{wrapper.system}_{j}']), [wrapper.key[i] for i in column])
+                    self.assertTrue(np.allclose(
+                        pred[f'prob_{j}'],
+                        probs[np.arange(len(probs)), column],
+                        rtol=1e-4,
+                        atol=0.0,
+                    ))
+
+        # Test that length-bucketed batching returns results in input order
+        with self.subTest(msg='Length bucketing'):
+            prediction_type = 'full' if 'full' in supported_settings['pred_type'] else 'flat'
+            probs = wrapper.predict(sample_inputs, prediction_type=prediction_type, what='probs')
+            probs_bucketed = wrapper.predict(
+                sample_inputs,
+                prediction_type=prediction_type,
+                what='probs',
+                length_bucketing=True,
+                )
+
+            self.assertTrue(np.allclose(probs, probs_bucketed, atol=1e-5))
+
         for prediction_type in supported_settings['pred_type']:
             for behavior in supported_settings['behavior_type']:
                 with self.subTest(prediction_type=prediction_type):
@@ -18,6 +18,11 @@ import pandas as pd
 
 from histocc import (
     OccDatasetMixerInMemMultipleFiles,
+    OccDatasetMixerStreaming,
+    LengthBucketBatchSampler,
+    ShardSampler,
+    collate_batch,
+    dynamic_padding_collate,
     load_tokenizer,
     Seq2SeqMixerOccCANINE,
     BlockOrderInvariantLoss,
@@ -90,6 +95,12 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument('--batch-size', type=int, default=512)
     parser.add_argument('--num-workers', type=int, default=0)
     parser.add_argument('--pin-memory', action='store_true', default=False)
+    parser.add_argument('--dynamic-padding', action='store_true', default=False, help='Pad each batch to its longest input rather than to --max-len')
+    parser.add_argument('--length-bucketing', action='store_true', default=False, help='Batch inputs of similar length together. Most useful with --dynamic-padding')
+    parser.add_argument('--streaming', action='store_true', default=False, help='Stream --train-data (Parquet files) row group by row group instead of loading it into memory')
+    parser.add_argument('--shuffle-buffer-size', type=int, default=100_000, help='Number of rows mixed in the shuffle buffer when using --streaming')
+    parser.add_argument('--cache-targets', action='store_true', default=False, help='Cache encoded targets next to the data files to skip encoding them on later runs')
+    parser.add_argument('--cache-word-freq', action='store_true', default=False, help='Save word frequencies of the training data next to the data files (reusable as --fn-word-freq) to skip counting them on later runs')
 
     # Model and optimizer parameters
     parser.add_argument('--learning-rate', type=float, default=2e-05)
@@ -123,25 +134,50 @@ def setup_datasets(
         formatter: BlockyHISCOFormatter | BlockyOCC1950Formatter | BlockyFormatter,
         tokenizer: CanineTokenizer,
         num_classes_flat: int,
-) -> tuple[OccDatasetMixerInMemMultipleFiles, OccDatasetMixerInMemMultipleFiles]:
+        num_replicas: int = 1,
+        rank: int = 0,
+) -> tuple[OccDatasetMixerInMemMultipleFiles | OccDatasetMixerStreaming, OccDatasetMixerInMemMultipleFiles]:
     if args.fn_word_freq is not None:
         word_freq_table = pd.read_csv(args.fn_word_freq, converters={'word': lambda x: x}) # Ensure 'nan' is not treated as NaN
     else:
         word_freq_table = None
 
-    dataset_train = OccDatasetMixerInMemMultipleFiles(
-        fnames_data=args.train_data,
-        formatter=formatter,
-        tokenizer=tokenizer,
-        max_input_len=args.max_len,
-        num_classes_flat=num_classes_flat,
-        training=True,
-        alt_prob=args.augmentation_prob,
-        n_trans=args.num_transformations,
-        unk_lang_prob=args.unk_lang_prob,
-        target_cols=args.target_col_naming,
-        word_freq_table=word_freq_table,
-    )
+    if args.streaming:
+        dataset_train = OccDatasetMixerStreaming(
+            fnames_data=args.train_data,
+            formatter=formatter,
+            tokenizer=tokenizer,
+            max_input_len=args.max_len,
+            num_classes_flat=num_classes_flat,
+            training=True,
+            alt_prob=args.augmentation_prob,
+            n_trans=args.num_transformations,
+            unk_lang_prob=args.unk_lang_prob,
+            target_cols=args.target_col_naming,
+            word_freq_table=word_freq_table,
+            shuffle_buffer_size=args.shuffle_buffer_size,
+            num_replicas=num_replicas,
+            rank=rank,
+        )
+    else:
+        dataset_train = OccDatasetMixerInMemMultipleFiles(
+            fnames_data=args.train_data,
+            formatter=formatter,
+            tokenizer=tokenizer,
+            max_input_len=args.max_len,
+            num_classes_flat=num_classes_flat,
+            training=True,
+            alt_prob=args.augmentation_prob,
+            n_trans=args.num_transformations,
+            unk_lang_prob=args.unk_lang_prob,
+            target_cols=args.target_col_naming,
+            word_freq_table=word_freq_table,
+            cache_targets=args.cache_targets,
+            batched=True,
+            num_replicas=num_replicas,
+            rank=rank,
+            cache_word_freq=args.cache_word_freq,
+        )
 
     dataset_val = OccDatasetMixerInMemMultipleFiles(
         fnames_data=args.val_data,
@@ -151,6 +187,8 @@ def setup_datasets(
         num_classes_flat=num_classes_flat,
         training=False,
         target_cols=args.target_col_naming,
+        cache_targets=args.cache_targets,
+        batched=True,
     )
 
     return dataset_train, dataset_val
@@ -220,22 +258,78 @@ def main():
         model_domain='Multilingual_CANINE',
     )
 
-    # Datasets
+    # Datasets. In distributed training, each rank loads only its own shard
+    # of the training data
     dataset_train, dataset_val = setup_datasets(
         args=args,
         formatter=formatter,
         tokenizer=tokenizer,
         num_classes_flat=num_classes_flat,
+        num_replicas=world_size if distributed else 1,
+        rank=local_rank if distributed else 0,
     )
 
     # Data loaders with distributed samplers if needed
-    if distributed:
-        train_sampler = DistributedSampler(
-            dataset_train,
+    collate_fn = dynamic_padding_collate if args.dynamic_padding else collate_batch
+
+    if args.streaming:
+        # Streamed data is shuffled and sharded across ranks by the dataset
+        # itself, which is reshuffled through its `set_epoch`
+        train_sampler = dataset_train
+        val_sampler = DistributedSampler(
+            dataset_val,
             num_replicas=world_size,
             rank=local_rank,
+            shuffle=False,
+        ) if distributed else None
+        data_loader_train = DataLoader(
+            dataset_train,
+            batch_size=args.batch_size,
+            collate_fn=collate_fn,
+            num_workers=args.num_workers,
+            pin_memory=args.pin_memory,
+        )
+        data_loader_val = DataLoader(
+            dataset_val,
+            batch_size=args.batch_size,
+            sampler=val_sampler,
+            collate_fn=collate_fn,
+            num_workers=args.num_workers,
+            pin_memory=args.pin_memory,
+        )
+    elif args.length_bucketing:
+        # Training batches are formed within the shard of each rank, while
+        # validation batches are sharded across ranks by the sampler itself
+        train_sampler = LengthBucketBatchSampler(
+            lengths=dataset_train.input_lengths(),
+            batch_size=args.batch_size,
             shuffle=True,
+            sharded=distributed,
+        )
+        val_sampler = LengthBucketBatchSampler(
+            lengths=dataset_val.input_lengths(),
+            batch_size=args.batch_size,
+            shuffle=False,
+            num_replicas=world_size,
+            rank=local_rank if distributed else 0,
+        )
+        data_loader_train = DataLoader(
+            dataset_train,
+            batch_sampler=train_sampler,
+            collate_fn=collate_fn,
+            num_workers=args.num_workers,
+            pin_memory=args.pin_memory,
+        )
+        data_loader_val = DataLoader(
+            dataset_val,
+            batch_sampler=val_sampler,
+            collate_fn=collate_fn,
+            num_workers=args.num_workers,
+            pin_memory=args.pin_memory,
         )
+    elif distributed:
+        # Training data is already sharded across ranks
+        train_sampler = ShardSampler(dataset_train, shuffle=True)
         val_sampler = DistributedSampler(
             dataset_val,
             num_replicas=world_size,
@@ -246,6 +340,7 @@ def main():
             dataset_train,
             batch_size=args.batch_size,
             sampler=train_sampler,
+            collate_fn=collate_fn,
             num_workers=args.num_workers,
             pin_memory=args.pin_memory,
         )
@@ -253,6 +348,7 @@ def main():
             dataset_val,
             batch_size=args.batch_size,
             sampler=val_sampler,
+            collate_fn=collate_fn,
             num_workers=args.num_workers,
             pin_memory=args.pin_memory,
         )
@@ -262,6 +358,7 @@ def main():
             dataset_train,
             batch_size=args.batch_size,
             shuffle=True,
+            collate_fn=collate_fn,
             num_workers=args.num_workers,
             pin_memory=args.pin_memory,
         )
@@ -269,6 +366,7 @@ def main():
             dataset_val,
             batch_size=args.batch_size,
             shuffle=False,
+            collate_fn=collate_fn,
             num_workers=args.num_workers,
             pin_memory=args.pin_memory,
         )